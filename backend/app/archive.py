@@ -0,0 +1,357 @@
+"""
+评论保留策略与冷存储归档
+
+超过保留期（App.retention_months，未设置时使用 RETENTION_MONTHS）的评论按自然月
+写入压缩的 NDJSON 文件：
+
+    {ARCHIVE_DIR}/app_{app_id}/{YYYY-MM}/part-{时间戳}.ndjson.zst
+
+安装了 zstandard 时使用 zstd 压缩，否则退化为 gzip。文件落盘后再分批从 reviews
+表删除，同一事务内把被删除评论计入 review_monthly_rollups，保证月度统计覆盖已归档
+的月份。全部删除后执行分步的 incremental_vacuum 回收空间。
+
+已归档评论的去重字段（平台、作者、时间）保存在 archived_review_keys：抓取写入时与 reviews 一起用于去重，
+已归档的评论再次被抓到（全量抓取、回填、重新解析）时不会重复写入；月度汇总按它去重，每条评论只计入一次。
+"""
+import gzip
+import io
+import json
+import os
+import shutil
+import time
+import traceback
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from sqlalchemy import func, insert
+
+from .config import ARCHIVE_DIR, ARCHIVE_BATCH_SIZE, PURGE_BATCH_PAUSE, RETENTION_MONTHS, VACUUM_STEP_PAGES
+from .database import SessionLocal
+from .logger import setup_logger
+from .models import App, ArchivedReviewKey, Review, ReviewContent, ReviewRollup
+from .records import normalize_time
+from . import compression, search
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - 未安装时使用 gzip
+    zstandard = None
+
+logger = setup_logger("archive")
+
+ARCHIVE_SUFFIXES = (".ndjson.zst", ".ndjson.gz")
+KEY_QUERY_CHUNK = 500  # 去重查询每次最多带的时间数（SQLite 的参数个数有上限）
+
+
+def _month_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1)
+
+
+def _add_months(dt: datetime, months: int) -> datetime:
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def retention_cutoff(months: int, now: Optional[datetime] = None) -> datetime:
+    """保留最近 months 个自然月（含当月），更早的评论需要归档"""
+    return _add_months(_month_start(now or datetime.now()), -(months - 1))
+
+
+def app_archive_dir(app_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, f"app_{app_id}")
+
+
+def _open_writer(path: str):
+    if zstandard is not None:
+        raw = open(path, "wb")
+        return io.TextIOWrapper(zstandard.ZstdCompressor(level=10).stream_writer(raw), encoding="utf-8")
+    return gzip.open(path, "wt", encoding="utf-8")
+
+
+def _open_reader(path: str):
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"读取 {path} 需要安装 zstandard")
+        raw = open(path, "rb")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(raw), encoding="utf-8")
+    return gzip.open(path, "rt", encoding="utf-8")
+
+
+def _review_record(review) -> Dict:
+    return {
+        "id": review.id,
+        "app_id": review.app_id,
+        "platform": review.platform,
+        "rating": review.rating,
+        "content": compression.decode(review.codec, review.dict_id, review.data),
+        "author": review.author,
+        "created_at": review.created_at.isoformat(),
+        "country": review.country,
+    }
+
+
+def _write_month(db, app_id: int, start: datetime, end: datetime) -> Optional[int]:
+    """把一个月的评论写入归档文件，返回写入的最大评论 ID（没有评论时返回 None）"""
+    month_dir = os.path.join(app_archive_dir(app_id), start.strftime("%Y-%m"))
+    os.makedirs(month_dir, exist_ok=True)
+    suffix = ARCHIVE_SUFFIXES[0] if zstandard is not None else ARCHIVE_SUFFIXES[1]
+    path = os.path.join(month_dir, f"part-{datetime.now().strftime('%Y%m%d%H%M%S%f')}{suffix}")
+    tmp_path = path + ".tmp"
+
+    last_id = 0
+    written = 0
+    with _open_writer(tmp_path) as writer:
+        while True:
+            batch = db.query(
+                Review.id, Review.app_id, Review.platform, Review.rating, Review.author, Review.created_at,
+                Review.country, ReviewContent.codec, ReviewContent.dict_id, ReviewContent.data,
+            ).outerjoin(ReviewContent, ReviewContent.review_id == Review.id).filter(
+                Review.app_id == app_id,
+                Review.created_at >= start,
+                Review.created_at < end,
+                Review.id > last_id,
+            ).order_by(Review.id).limit(ARCHIVE_BATCH_SIZE).all()
+            if not batch:
+                break
+            for review in batch:
+                writer.write(json.dumps(_review_record(review), ensure_ascii=False) + "\n")
+            last_id = batch[-1].id
+            written += len(batch)
+            db.commit()  # 结束读事务，避免长时间占用数据库
+
+    if not written:
+        os.remove(tmp_path)
+        return None
+    os.replace(tmp_path, path)
+    logger.info(f"已归档 {written} 条评论到 {path}")
+    return last_id
+
+
+def archived_keys(db, app_id: int, times: List[datetime]) -> Set[Tuple[str, Optional[str], datetime]]:
+    """这些时间的评论中已归档的 (平台, 作者, 时间)"""
+    keys = set()
+    for i in range(0, len(times), KEY_QUERY_CHUNK):
+        keys.update(
+            (row.platform, row.author, row.created_at)
+            for row in db.query(ArchivedReviewKey.platform, ArchivedReviewKey.author, ArchivedReviewKey.created_at)
+            .filter(ArchivedReviewKey.app_id == app_id, ArchivedReviewKey.created_at.in_(times[i:i + KEY_QUERY_CHUNK]))
+        )
+    return keys
+
+
+def _add_to_rollups(db, app_id: int, month: str, rows: List) -> None:
+    """把归档的评论计入月度汇总并记录去重字段；已计入的评论（按平台、作者、时间）跳过，重复调用不会重复计数"""
+    counted = archived_keys(db, app_id, sorted({row.created_at for row in rows}))
+    by_platform: Dict[str, List[float]] = {}
+    keys = []
+    for row in rows:
+        key = (row.platform, row.author, row.created_at)
+        if key in counted:
+            continue
+        counted.add(key)
+        keys.append({"app_id": app_id, "platform": row.platform, "author": row.author, "created_at": row.created_at})
+        by_platform.setdefault(row.platform, []).append(row.rating)
+    if keys:
+        db.execute(insert(ArchivedReviewKey.__table__), keys)
+    for platform, ratings in by_platform.items():
+        rollup = db.query(ReviewRollup).filter(
+            ReviewRollup.app_id == app_id,
+            ReviewRollup.platform == platform,
+            ReviewRollup.month == month,
+        ).first()
+        if not rollup:
+            rollup = ReviewRollup(app_id=app_id, platform=platform, month=month, review_count=0, rating_sum=0,
+                                  star_1=0, star_2=0, star_3=0, star_4=0, star_5=0)
+            db.add(rollup)
+        rollup.review_count += len(ratings)
+        rollup.rating_sum += sum(ratings)
+        for rating in ratings:
+            star = min(max(int(round(rating)), 1), 5)
+            setattr(rollup, f"star_{star}", getattr(rollup, f"star_{star}") + 1)
+
+
+def _delete_archived(db, app_id: int, start: datetime, end: datetime, max_id: int) -> int:
+    """分批删除已写入归档的评论，并计入月度汇总"""
+    month = start.strftime("%Y-%m")
+    deleted = 0
+    while True:
+        rows = db.query(Review.id, Review.platform, Review.rating, Review.author, Review.created_at).filter(
+            Review.app_id == app_id,
+            Review.created_at >= start,
+            Review.created_at < end,
+            Review.id <= max_id,
+        ).order_by(Review.id).limit(ARCHIVE_BATCH_SIZE).all()
+        if not rows:
+            break
+        ids = [row.id for row in rows]
+        _add_to_rollups(db, app_id, month, rows)
+        search.unindex_app(db.connection(), app_id, ids)
+        db.query(ReviewContent).filter(ReviewContent.review_id.in_(ids)).delete(synchronize_session=False)
+        db.query(Review).filter(Review.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        deleted += len(ids)
+        if PURGE_BATCH_PAUSE:
+            time.sleep(PURGE_BATCH_PAUSE)
+    return deleted
+
+
+def incremental_vacuum(db) -> int:
+    """分步回收空闲页，每步一个短事务；数据库未开启 auto_vacuum=INCREMENTAL 时不做任何事"""
+    bind = db.get_bind()
+    if bind.dialect.name != "sqlite":
+        return 0
+    raw = bind.raw_connection()
+    freed = 0
+    try:
+        cursor = raw.cursor()
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        while True:
+            free_pages = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free_pages:
+                break
+            step = min(free_pages, VACUUM_STEP_PAGES)
+            # sqlite3 的 execute 每次只回收一页，executescript 才会把语句执行完
+            raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({step})")
+            freed += step
+            if PURGE_BATCH_PAUSE:
+                time.sleep(PURGE_BATCH_PAUSE)
+    finally:
+        raw.close()
+    return freed
+
+
+def archive_app(db, app: App, now: Optional[datetime] = None) -> int:
+    """按保留策略归档单个应用的评论，返回归档条数"""
+    months = app.retention_months if app.retention_months is not None else RETENTION_MONTHS
+    if not months or months <= 0:
+        return 0
+    cutoff = retention_cutoff(months, now)
+    oldest = db.query(func.min(Review.created_at)).filter(Review.app_id == app.id).scalar()
+    if not oldest or oldest >= cutoff:
+        return 0
+
+    logger.info(f"开始归档应用评论: app_id={app.id}, cutoff={cutoff:%Y-%m-%d}")
+    total = 0
+    start = _month_start(oldest)
+    while start < cutoff:
+        end = _add_months(start, 1)
+        max_id = _write_month(db, app.id, start, end)
+        if max_id is not None:
+            total += _delete_archived(db, app.id, start, end, max_id)
+        start = end
+    logger.info(f"应用评论归档完成: app_id={app.id}, archived={total}")
+    return total
+
+
+def apply_retention():
+    """对所有应用执行保留策略（定时任务入口）"""
+    db = SessionLocal()
+    try:
+        total = 0
+        for app in db.query(App).filter(App.deleted_at.is_(None)).all():
+            try:
+                total += archive_app(db, app)
+            except Exception as e:
+                logger.error(f"归档应用 {app.id} 的评论失败: {str(e)}\n{traceback.format_exc()}")
+                db.rollback()
+        if total:
+            freed = incremental_vacuum(db)
+            logger.info(f"归档完成，共 {total} 条评论，回收 {freed} 页")
+    finally:
+        db.close()
+
+
+def iter_archived_reviews(app_id: int) -> Iterator[Dict]:
+    """按月份顺序读取应用的归档评论，同一评论（按平台、作者、时间）只返回一次"""
+    base = app_archive_dir(app_id)
+    if not os.path.isdir(base):
+        return
+    seen = set()
+    for month in sorted(os.listdir(base)):
+        month_dir = os.path.join(base, month)
+        for name in sorted(os.listdir(month_dir)):
+            if not name.endswith(ARCHIVE_SUFFIXES):
+                continue
+            with _open_reader(os.path.join(month_dir, name)) as reader:
+                for line in reader:
+                    record = json.loads(line)
+                    record["created_at"] = datetime.fromisoformat(record["created_at"])
+                    key = (record["platform"], record["author"], normalize_time(record["created_at"]))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    yield record
+
+
+def monthly_stats(db, app_id: int, country: Optional[str] = None) -> List[Dict]:
+    """
+    按月、平台汇总评论数与平均评分，已归档的月份来自 review_monthly_rollups
+    :param country: 只统计该国家/地区的评论；月度汇总不区分国家，因此只包含未归档的评论
+    """
+    stats: Dict = {}
+
+    def add(month, platform, count, rating_sum):
+        item = stats.setdefault((month, platform), {"month": month, "platform": platform, "count": 0, "rating_sum": 0.0})
+        item["count"] += count
+        item["rating_sum"] += rating_sum or 0
+
+    if country is None:
+        for rollup in db.query(ReviewRollup).filter(ReviewRollup.app_id == app_id):
+            add(rollup.month, rollup.platform, rollup.review_count, rollup.rating_sum)
+
+    month_expr = func.strftime("%Y-%m", Review.created_at)
+    live = db.query(month_expr, Review.platform, func.count(Review.id), func.sum(Review.rating)).filter(
+        Review.app_id == app_id
+    )
+    if country is not None:
+        live = live.filter(Review.country == country)
+    live = live.group_by(month_expr, Review.platform)
+    for month, platform, count, rating_sum in live:
+        add(month, platform, count, rating_sum)
+
+    result = []
+    for key in sorted(stats):
+        item = stats[key]
+        result.append({
+            "month": item["month"],
+            "platform": item["platform"],
+            "count": item["count"],
+            "average_rating": round(item["rating_sum"] / item["count"], 2) if item["count"] else 0,
+        })
+    return result
+
+
+def rebuild_index(db, app_id: int) -> int:
+    """按归档文件重建应用的去重字段和月度汇总（升级前归档的数据没有去重字段），返回归档评论数"""
+    db.query(ArchivedReviewKey).filter(ArchivedReviewKey.app_id == app_id).delete(synchronize_session=False)
+    db.query(ReviewRollup).filter(ReviewRollup.app_id == app_id).delete(synchronize_session=False)
+    total = 0
+    batch: List[Dict] = []
+
+    def flush():
+        # 同一批按月份分组计入汇总
+        by_month: Dict[str, List] = {}
+        for record in batch:
+            by_month.setdefault(record.created_at.strftime("%Y-%m"), []).append(record)
+        for month, rows in by_month.items():
+            _add_to_rollups(db, app_id, month, rows)
+        db.flush()
+        batch.clear()
+
+    for record in iter_archived_reviews(app_id):
+        batch.append(SimpleNamespace(**record))
+        total += 1
+        if len(batch) >= ARCHIVE_BATCH_SIZE:
+            flush()
+    flush()
+    db.commit()
+    return total
+
+
+def purge_archive(db, app_id: int) -> None:
+    """删除应用的归档文件、去重字段和月度汇总（删除应用时调用）"""
+    db.query(ReviewRollup).filter(ReviewRollup.app_id == app_id).delete(synchronize_session=False)
+    db.query(ArchivedReviewKey).filter(ArchivedReviewKey.app_id == app_id).delete(synchronize_session=False)
+    shutil.rmtree(app_archive_dir(app_id), ignore_errors=True)
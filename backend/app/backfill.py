@@ -0,0 +1,251 @@
+"""
+历史评论全量抓取（backfill）
+
+按页从新到旧抓取应用的全部历史评论，每页写入后立即提交，并把下一页的位置保存到
+backfill_checkpoints（App Store 为 offset，Play 为各星级分区的 continuation token）。任务中断（进程重启、
+抓取失败）后重新执行会从保存的位置继续。应用设置了多个国家/地区时逐个国家抓取，检查点中分别记录
+各国家的位置和是否完成：
+
+    {"countries": {"us": {"cursor": {...}, "done": false}, "jp": {"cursor": null, "done": true}}}
+
+全量抓取在抓取队列的 backfill 通道中以最低优先级执行，每个任务最多抓取 BACKFILL_PAGES_PER_TASK
+页后重新排队，让出工作线程；请求速率由 BACKFILL_REQUESTS_PER_MINUTE 单独限制（按每页实际发出的请求数），
+不占用自适应轮询的每小时请求预算。抓取方式与其他抓取相同，由 scrapers.backends.select 选择。
+"""
+import json
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from .config import BACKFILL_PAGES_PER_TASK, BACKFILL_REQUESTS_PER_MINUTE, STORE_REQUEST_PROCESSES
+from .database import SessionLocal
+from .deadline import Deadline
+from .exceptions import ReviewFetchError
+from .logger import setup_logger
+from .models import App, BackfillCheckpoint
+from .scrapers import backends, play_store
+from .sync import save_reviews
+from . import circuit, ingestion, polling, runs
+
+logger = setup_logger("backfill")
+
+
+class RateLimiter:
+    """两次请求之间至少间隔 60 / per_minute 秒"""
+
+    def __init__(self, per_minute: float):
+        self.interval = 60 / per_minute if per_minute > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, requests: int = 1) -> None:
+        """等到可以发出请求，并为之后的 requests 个请求占用间隔"""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval * requests
+        if delay > 0:
+            time.sleep(delay)
+
+
+# 每个进程各自限速，按进程数均分
+limiter = RateLimiter(BACKFILL_REQUESTS_PER_MINUTE / STORE_REQUEST_PROCESSES)
+
+
+def _load_progress(checkpoint: BackfillCheckpoint, countries: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    应用当前各国家的进度：新增的国家从最新的评论开始，已移除的国家不再抓取；
+    按国家记录之前的检查点只有主要国家的位置
+    """
+    cursor = json.loads(checkpoint.cursor) if checkpoint.cursor else None
+    if cursor is not None and "countries" in cursor:
+        saved = cursor["countries"]
+    else:
+        saved = {countries[0]: {"cursor": cursor, "done": False}} if cursor is not None else {}
+    done = checkpoint.status == "done"
+    return {code: saved.get(code, {"cursor": None, "done": done}) for code in countries}
+
+
+def checkpoint_to_dict(checkpoint: BackfillCheckpoint, countries: List[str]) -> Dict[str, Any]:
+    progress = _load_progress(checkpoint, countries)
+    return {
+        "platform": checkpoint.platform,
+        "status": checkpoint.status,
+        "pages": checkpoint.pages,
+        "fetched": checkpoint.fetched,
+        "new_count": checkpoint.new_count,
+        "error": checkpoint.error,
+        "started_at": checkpoint.started_at,
+        "updated_at": checkpoint.updated_at,
+        "finished_at": checkpoint.finished_at,
+        "countries": {
+            code: {
+                "done": state["done"],
+                "partitions": play_store.partition_progress(state["cursor"]["partitions"])
+                if state["cursor"] and "partitions" in state["cursor"] else None,
+            }
+            for code, state in progress.items()
+        },
+    }
+
+
+def get_checkpoint(db, app_id: int, platform: str) -> BackfillCheckpoint:
+    checkpoint = db.query(BackfillCheckpoint).filter(
+        BackfillCheckpoint.app_id == app_id, BackfillCheckpoint.platform == platform
+    ).first()
+    if not checkpoint:
+        checkpoint = BackfillCheckpoint(app_id=app_id, platform=platform, status="pending",
+                                        pages=0, fetched=0, new_count=0)
+        db.add(checkpoint)
+        db.flush()
+    return checkpoint
+
+
+def start_backfill(app_id: int, platform: Optional[str] = None, restart: bool = False) -> List[Dict[str, Any]]:
+    """
+    把全量抓取加入队列。已完成的或 restart 时从最新的评论重新开始，否则从上次的位置继续
+    """
+    db = SessionLocal()
+    try:
+        app = db.query(App).filter(App.id == app_id, App.deleted_at.is_(None)).first()
+        platforms = polling.app_platforms(app, platform) if app else []
+        for app_platform in platforms:
+            checkpoint = get_checkpoint(db, app_id, app_platform)
+            if restart or checkpoint.status == "done":
+                checkpoint.cursor = None
+                checkpoint.pages = checkpoint.fetched = checkpoint.new_count = 0
+                checkpoint.started_at = checkpoint.finished_at = None
+            checkpoint.status = "pending"
+            checkpoint.error = None
+            checkpoint.updated_at = datetime.now()
+        db.commit()
+    finally:
+        db.close()
+    return [ingestion.submit("backfill", "backfill", app_id, app_platform) for app_platform in platforms]
+
+
+def backfill_status(db, app_id: int) -> List[Dict[str, Any]]:
+    app = db.query(App).filter(App.id == app_id).first()
+    if not app:
+        return []
+    checkpoints = db.query(BackfillCheckpoint).filter(BackfillCheckpoint.app_id == app_id).order_by(
+        BackfillCheckpoint.platform
+    )
+    return [checkpoint_to_dict(checkpoint, app.countries(checkpoint.platform)) for checkpoint in checkpoints]
+
+
+def delete_app_checkpoints(db, app_id: int) -> None:
+    """删除应用时清理抓取进度（由调用方提交事务）"""
+    db.query(BackfillCheckpoint).filter(BackfillCheckpoint.app_id == app_id).delete(synchronize_session=False)
+
+
+def backfill_app_platform(app_id: int, platform: str, limit: Optional[int] = None) -> int:
+    """
+    从检查点继续抓取最多 BACKFILL_PAGES_PER_TASK 页（或到 INGEST_TASK_DEADLINE_SECONDS 为止），未抓完时重新排队
+    :return: 本次新增评论数
+    """
+    db = SessionLocal()
+    checkpoint = None
+    metrics = None
+    try:
+        app = db.query(App).filter(App.id == app_id, App.deleted_at.is_(None)).first()
+        if not app:
+            return 0
+        checkpoint = get_checkpoint(db, app_id, platform)
+        if checkpoint.status == "done":
+            return 0
+        circuit.check(db, app_id, platform, probe=True)
+        metrics = runs.RunMetrics("backfill", app_id, platform, limit)
+        deadline = Deadline()
+        now = datetime.now()
+        checkpoint.status = "running"
+        checkpoint.error = None
+        checkpoint.started_at = checkpoint.started_at or now
+        checkpoint.updated_at = now
+        db.commit()
+
+        progress = _load_progress(checkpoint, app.countries(platform))
+        backend = backends.select(platform, resume=True)
+        logger.info(f"开始全量抓取: app_id={app_id} ({platform}), backend={backend.name}, 已抓取 {checkpoint.pages} 页, "
+                    f"未完成的国家: {[code for code, state in progress.items() if not state['done']]}")
+        new_total = 0
+        requests = 0
+        for country, state in progress.items():
+            if state["done"]:
+                continue
+            if requests >= BACKFILL_PAGES_PER_TASK or deadline.expired():
+                break
+            cursor = state["cursor"] if backend.capabilities.incremental else None
+            counted = metrics.pages
+            limiter.wait()
+            stream = backend.iter_reviews(app, country, None, metrics, cursor, deadline)
+            try:
+                with polling.store_slot(platform):
+                    for page, position in stream:
+                        # 按本页实际发出的请求数（Play 分区抓取时一轮有多个请求）计入页数和限速
+                        pages, counted = metrics.pages - counted, metrics.pages
+                        requests += pages
+                        new_count = save_reviews(db, app_id, page, metrics)
+                        new_total += new_count
+                        checkpoint.pages += pages
+                        checkpoint.fetched += len(page)
+                        checkpoint.new_count += new_count
+                        state["done"] = position is None
+                        state["cursor"] = position
+                        checkpoint.cursor = json.dumps({"countries": progress})
+                        checkpoint.updated_at = datetime.now()
+                        with metrics.timer("write"):
+                            db.commit()
+                        if state["done"] or requests >= BACKFILL_PAGES_PER_TASK:
+                            break
+                        limiter.wait(pages)
+            finally:
+                stream.close()
+            if state["done"]:
+                logger.info(f"全量抓取完成一个国家: app_id={app_id} ({platform}), country={country}")
+                continue
+            if requests < BACKFILL_PAGES_PER_TASK and not deadline.expired():
+                # 抓取中途失败：已抓到的部分和位置已保存，下次从该位置继续；按中断的原因计入熔断
+                logger.warning(f"全量抓取中断: app_id={app_id} ({platform}), country={country}，下次从保存的位置继续")
+                raise metrics.interrupted or ReviewFetchError(f"全量抓取中断: country={country}，下次从保存的位置继续")
+            logger.info(f"全量抓取达到本次任务的页数或截止时间: app_id={app_id} ({platform})")
+            break
+
+        if all(state["done"] for state in progress.values()):
+            checkpoint.status = "done"
+            checkpoint.cursor = None
+            checkpoint.finished_at = checkpoint.updated_at = datetime.now()
+            with metrics.timer("write"):
+                db.commit()
+            metrics.finish()
+            circuit.record_success(app_id, platform)
+            logger.info(f"全量抓取完成: app_id={app_id} ({platform}), 共 {checkpoint.pages} 页, "
+                        f"{checkpoint.fetched} 条, 新增 {checkpoint.new_count} 条")
+            return new_total
+
+        # 本次的页数或时间用完，重新排队让出工作线程
+        checkpoint.status = "pending"
+        db.commit()
+        metrics.finish()
+        circuit.record_success(app_id, platform)
+        ingestion.submit("backfill", "backfill", app_id, platform)
+        return new_total
+    except Exception as e:
+        db.rollback()
+        if metrics is not None:
+            metrics.finish(e)
+            circuit.record_failure(app_id, platform, e)
+        if checkpoint is not None:
+            checkpoint.status = "failed"
+            checkpoint.error = str(e)
+            checkpoint.updated_at = datetime.now()
+            db.commit()
+        raise
+    finally:
+        db.close()
+        if metrics is not None:
+            runs.record(metrics)
+
+
+ingestion.register_handler("backfill", backfill_app_platform)
@@ -0,0 +1,183 @@
+"""
+SQLite 在线备份
+
+使用 SQLite 的 online backup API 按 BACKUP_STEP_PAGES 分步复制数据库。复制期间在源
+连接上保持一个读事务：WAL 模式下这个事务看到的是开始时刻的一致快照，其他连接的写入
+照常进行，也不会导致备份从头重来。备份文件按时间命名：
+
+    {BACKUP_DIR}/app-20261019T020000.db
+
+命令行:
+    python -m app.backup create
+    python -m app.backup list
+    python -m app.backup restore --at "2026-10-19 08:00"   # 恢复到该时间点之前最近的一份备份
+    python -m app.backup restore --file data/backup/app-20261019T020000.db
+
+恢复会替换数据库文件，需要先停止服务；当前数据库会先另存为 app.db.before-restore-<时间>。
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from .config import BACKUP_DIR, BACKUP_RETENTION, BACKUP_STEP_PAGES, BACKUP_STEP_SLEEP
+from .database import engine
+from .logger import setup_logger
+
+logger = setup_logger("backup")
+
+BACKUP_PREFIX = "app-"
+BACKUP_SUFFIX = ".db"
+TIME_FORMAT = "%Y%m%dT%H%M%S"
+
+
+def database_path() -> str:
+    if engine.dialect.name != "sqlite" or not engine.url.database:
+        raise RuntimeError("只支持备份 SQLite 文件数据库")
+    return engine.url.database
+
+
+def list_backups() -> List[Tuple[datetime, str]]:
+    """返回 (备份时间, 路径) 列表，按时间升序"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    backups = []
+    for name in os.listdir(BACKUP_DIR):
+        if not (name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX)):
+            continue
+        try:
+            taken_at = datetime.strptime(name[len(BACKUP_PREFIX):-len(BACKUP_SUFFIX)], TIME_FORMAT)
+        except ValueError:
+            continue
+        backups.append((taken_at, os.path.join(BACKUP_DIR, name)))
+    return sorted(backups)
+
+
+def create_backup() -> str:
+    """创建一份在线备份，返回备份文件路径"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    taken_at = datetime.now()
+    path = os.path.join(BACKUP_DIR, f"{BACKUP_PREFIX}{taken_at.strftime(TIME_FORMAT)}{BACKUP_SUFFIX}")
+    tmp_path = path + ".tmp"
+    started = time.time()
+    logger.info(f"开始备份数据库: {path}")
+
+    source = sqlite3.connect(database_path(), isolation_level=None, timeout=30)
+    target = sqlite3.connect(tmp_path)
+    try:
+        # 持有读事务，整个备份复制的是同一个快照
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(target, pages=BACKUP_STEP_PAGES, sleep=BACKUP_STEP_SLEEP)
+        source.execute("COMMIT")
+        # 备份文件使用回滚日志模式，单个文件即可完整恢复
+        target.execute("PRAGMA journal_mode=DELETE")
+        result = target.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise RuntimeError(f"备份文件校验失败: {result}")
+    except Exception:
+        target.close()
+        source.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    target.close()
+    source.close()
+    os.replace(tmp_path, path)
+
+    size = os.path.getsize(path) / 1024 / 1024
+    logger.info(f"数据库备份完成: {path}, {size:.1f}MB, 耗时 {time.time() - started:.1f}s")
+    prune_backups()
+    return path
+
+
+def prune_backups(keep: int = BACKUP_RETENTION) -> List[str]:
+    """只保留最近 keep 份备份"""
+    backups = list_backups()
+    removed = []
+    if keep > 0 and len(backups) > keep:
+        for _, path in backups[:-keep]:
+            os.remove(path)
+            removed.append(path)
+            logger.info(f"删除过期备份: {path}")
+    return removed
+
+
+def find_backup(at: datetime) -> Optional[str]:
+    """找到 at 时刻及之前最近的一份备份"""
+    candidates = [path for taken_at, path in list_backups() if taken_at <= at]
+    return candidates[-1] if candidates else None
+
+
+def restore_backup(path: str) -> str:
+    """
+    用备份文件替换当前数据库（需先停止服务），返回原数据库的另存路径
+    """
+    check = sqlite3.connect(path)
+    try:
+        result = check.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        check.close()
+    if result != "ok":
+        raise RuntimeError(f"备份文件校验失败: {result}")
+
+    db_path = database_path()
+    saved = f"{db_path}.before-restore-{datetime.now().strftime(TIME_FORMAT)}"
+    if os.path.exists(db_path):
+        # 先合并 WAL 再另存，保证另存的文件是完整的
+        conn = sqlite3.connect(db_path)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+        shutil.copy2(db_path, saved)
+
+    tmp_path = db_path + ".restore.tmp"
+    shutil.copy2(path, tmp_path)
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.replace(tmp_path, db_path)
+    logger.info(f"已从 {path} 恢复数据库，原数据库另存为 {saved}")
+    return saved
+
+
+def scheduled_backup():
+    """定时任务入口"""
+    try:
+        create_backup()
+    except Exception as e:
+        logger.error(f"数据库备份失败: {str(e)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.backup", description="SQLite 在线备份与恢复")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("create", help="创建一份在线备份")
+    sub.add_parser("list", help="列出已有备份")
+    restore = sub.add_parser("restore", help="从备份恢复（需先停止服务）")
+    group = restore.add_mutually_exclusive_group(required=True)
+    group.add_argument("--at", help="恢复到该时间点之前最近的一份备份，如 \"2026-10-19 08:00\"")
+    group.add_argument("--file", help="指定备份文件")
+    args = parser.parse_args(argv)
+
+    if args.command == "create":
+        print(create_backup())
+    elif args.command == "list":
+        for taken_at, path in list_backups():
+            print(f"{taken_at:%Y-%m-%d %H:%M:%S}  {os.path.getsize(path) / 1024 / 1024:8.1f}MB  {path}")
+    elif args.command == "restore":
+        path = args.file
+        if args.at:
+            path = find_backup(datetime.fromisoformat(args.at))
+            if not path:
+                print(f"没有 {args.at} 之前的备份")
+                sys.exit(1)
+        saved = restore_backup(path)
+        print(f"已从 {path} 恢复，原数据库另存为 {saved}")
+
+
+if __name__ == "__main__":
+    main()
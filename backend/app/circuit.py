@@ -0,0 +1,308 @@
+"""
+失败重试与熔断
+
+重试：超时、连接失败、限流（429）和 5xx 等临时错误按指数退避重试 STORE_RETRY_ATTEMPTS 次，等待时间不超过
+任务的截止时间。是否为临时错误由抛出方明确标记（store error 的 transient），requests 的超时和连接错误也算；
+其他错误（应用不存在、ID 无效、响应解析失败、数据库错误等）都不重试，也不计入商店的失败次数。
+
+熔断（状态保存在 circuit_breakers 表中，所有进程共享）：
+- 商店：连续 CIRCUIT_STORE_FAILURE_THRESHOLD 次临时错误后熔断 CIRCUIT_STORE_OPEN_SECONDS 秒，期间该商店的
+  所有抓取直接失败，不再等待超时；
+- 应用：连续 CIRCUIT_APP_FAILURE_THRESHOLD 次失败后熔断 CIRCUIT_APP_OPEN_MINUTES 分钟，轮询跳过该应用。
+  连续失败 CIRCUIT_APP_DISABLE_AFTER 次（应用不存在、ID 无效时为 CIRCUIT_APP_FAILURE_THRESHOLD 次）后停止
+  抓取，直到修改应用的商店 ID 或手动重置。
+
+熔断到期后进入半开状态：check() 原子地把状态改为 half_open，只有改成功的一个抓取作为试探放行，其他抓取在
+试探结束前继续跳过。试探成功则关闭，失败则重新熔断且时长翻倍（不超过 CIRCUIT_MAX_OPEN_HOURS）；试探超过
+PROBE_LEASE 仍没有结果（如进程退出）时允许再试探一次。手动刷新不受应用熔断限制，可以用来验证应用是否已恢复。
+"""
+import random
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypeVar
+
+import requests
+
+from .config import (
+    CIRCUIT_APP_DISABLE_AFTER, CIRCUIT_APP_FAILURE_THRESHOLD, CIRCUIT_APP_OPEN_MINUTES, CIRCUIT_MAX_OPEN_HOURS,
+    CIRCUIT_STORE_FAILURE_THRESHOLD, CIRCUIT_STORE_OPEN_SECONDS, INGEST_TASK_DEADLINE_SECONDS, STORE_RETRY_ATTEMPTS,
+    STORE_RETRY_BASE_SECONDS,
+)
+from .database import SessionLocal
+from .deadline import Deadline
+from .exceptions import CircuitOpenError
+from .logger import setup_logger
+from .models import CircuitBreaker
+
+logger = setup_logger("circuit")
+
+T = TypeVar("T")
+
+# 试探的最长时间，超过后认为试探方已退出，允许再试探一次
+PROBE_LEASE = timedelta(seconds=INGEST_TASK_DEADLINE_SECONDS or 3600)
+
+_TRANSIENT_ERRORS = (requests.Timeout, requests.ConnectionError, socket.timeout, ConnectionError, TimeoutError)
+
+
+def is_transient(error: BaseException) -> bool:
+    """重试可能成功的错误：抛出方标记为 transient 的错误，以及超时和连接错误；其他错误默认不是"""
+    transient = getattr(error, "transient", None)
+    if transient is not None:
+        return transient
+    return isinstance(error, _TRANSIENT_ERRORS)
+
+
+def transient_status(status_code: int) -> bool:
+    """限流（429）和服务端错误（5xx）的响应可以重试"""
+    return status_code == 429 or status_code >= 500
+
+
+def call_with_retry(func: Callable[[], T], deadline: Optional[Deadline] = None, what: str = "请求") -> T:
+    """执行 func，临时错误按指数退避（带随机抖动）重试"""
+    for attempt in range(STORE_RETRY_ATTEMPTS + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= STORE_RETRY_ATTEMPTS or not is_transient(e):
+                raise
+            delay = STORE_RETRY_BASE_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+            remaining = deadline.remaining() if deadline else None
+            if remaining is not None and delay >= remaining:
+                raise
+            logger.warning(f"{what}失败，{delay:.1f} 秒后第 {attempt + 1} 次重试: {str(e)}")
+            time.sleep(delay)
+
+
+def _store_key(platform: str) -> str:
+    return f"store:{platform}"
+
+
+def _app_key(app_id: int, platform: str) -> str:
+    return f"app:{app_id}:{platform}"
+
+
+def _get(db, scope: str, platform: str, app_id: Optional[int] = None) -> CircuitBreaker:
+    key = _store_key(platform) if scope == "store" else _app_key(app_id, platform)
+    breaker = db.query(CircuitBreaker).filter(CircuitBreaker.key == key).first()
+    if not breaker:
+        breaker = CircuitBreaker(key=key, scope=scope, app_id=app_id, platform=platform, state="closed",
+                                 consecutive_failures=0, total_failures=0)
+        db.add(breaker)
+        db.flush()
+    return breaker
+
+
+def _is_open(breaker: Optional[CircuitBreaker], now: datetime) -> bool:
+    """熔断中，或半开且试探还没有结束"""
+    if breaker is None:
+        return False
+    if breaker.state == "disabled":
+        return True
+    return breaker.state in ("open", "half_open") and breaker.open_until is not None and breaker.open_until > now
+
+
+def _probe_due(breaker: Optional[CircuitBreaker], now: datetime) -> bool:
+    """熔断到期（或上次试探超时），下一个抓取作为试探"""
+    return (breaker is not None and breaker.state in ("open", "half_open")
+            and breaker.open_until is not None and breaker.open_until <= now)
+
+
+def _claim_probe(db, breaker: CircuitBreaker, now: datetime) -> None:
+    """
+    把到期的熔断器原子地改为半开并立即提交（其他进程可见），改成功的调用方作为试探放行；
+    已被其他抓取领取时抛出 CircuitOpenError
+    """
+    claimed = db.query(CircuitBreaker).filter(
+        CircuitBreaker.id == breaker.id,
+        CircuitBreaker.state == breaker.state,
+        CircuitBreaker.open_until == breaker.open_until,
+    ).update({"state": "half_open", "open_until": now + PROBE_LEASE}, synchronize_session=False)
+    db.commit()
+    if not claimed:
+        raise CircuitOpenError(f"熔断器 {breaker.key} 正在试探恢复，跳过抓取")
+    logger.info(f"熔断器 {breaker.key} 到期，试探一次")
+
+
+def check(db, app_id: int, platform: str, probe: bool = False, claim: bool = True) -> None:
+    """
+    抓取前检查熔断状态，打开时抛出 CircuitOpenError。熔断到期时本次抓取作为试探（半开），此时会提交 db 的事务
+    :param probe: 手动刷新，忽略应用熔断（只检查商店）
+    :param claim: 为 False 时只检查，不领取试探（之后还会再调用 check 的预检查）
+    """
+    now = datetime.now()
+    breakers = {
+        breaker.key: breaker for breaker in db.query(CircuitBreaker).filter(
+            CircuitBreaker.key.in_([_store_key(platform), _app_key(app_id, platform)])
+        )
+    }
+    store = breakers.get(_store_key(platform))
+    if _is_open(store, now):
+        if store.state == "half_open":
+            raise CircuitOpenError(f"{platform} 商店正在试探恢复，{store.open_until:%H:%M:%S} 前跳过抓取")
+        raise CircuitOpenError(f"{platform} 商店暂时不可用，{store.open_until:%H:%M:%S} 前跳过抓取: {store.last_error}")
+    app = breakers.get(_app_key(app_id, platform))
+    if not probe and _is_open(app, now):
+        if app.state == "disabled":
+            raise CircuitOpenError(f"应用 {app_id} ({platform}) 连续失败 {app.consecutive_failures} 次，已停止抓取: "
+                                   f"{app.last_error}")
+        raise CircuitOpenError(f"应用 {app_id} ({platform}) 连续失败，{app.open_until:%Y-%m-%d %H:%M} 前跳过抓取")
+    if claim:
+        # 先领取应用的试探：领取商店的试探后失败会让该商店的其他抓取一直等到试探超时
+        for breaker in ((app,) if not probe else ()) + (store,):
+            if _probe_due(breaker, now):
+                _claim_probe(db, breaker, now)
+
+
+def blocked(db, now: Optional[datetime] = None) -> Tuple[Set[str], Set[Tuple[int, str]]]:
+    """当前熔断中的商店和应用平台"""
+    now = now or datetime.now()
+    stores, apps = set(), set()
+    for breaker in db.query(CircuitBreaker).filter(CircuitBreaker.state != "closed"):
+        if not _is_open(breaker, now):
+            continue
+        if breaker.scope == "store":
+            stores.add(breaker.platform)
+        else:
+            apps.add((breaker.app_id, breaker.platform))
+    return stores, apps
+
+
+def open_until(db, app_id: int, platform: str) -> Optional[datetime]:
+    """应用平台恢复抓取的时间（熔断中或正在试探时），商店和应用熔断取较晚者；停止抓取时返回 None"""
+    now = datetime.now()
+    result = None
+    for breaker in db.query(CircuitBreaker).filter(
+        CircuitBreaker.key.in_([_store_key(platform), _app_key(app_id, platform)])
+    ):
+        if breaker.state in ("open", "half_open") and breaker.open_until and breaker.open_until > now:
+            result = max(result, breaker.open_until) if result else breaker.open_until
+    return result
+
+
+def _open_duration(base: timedelta, failures: int, threshold: int) -> timedelta:
+    return min(base * 2 ** max(failures - threshold, 0), timedelta(hours=CIRCUIT_MAX_OPEN_HOURS))
+
+
+def record_success(app_id: int, platform: str) -> None:
+    """抓取成功，关闭商店和应用的熔断器"""
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        for breaker in (_get(db, "store", platform), _get(db, "app", platform, app_id)):
+            if breaker.state != "closed":
+                logger.info(f"熔断器 {breaker.key} 已恢复")
+            breaker.state = "closed"
+            breaker.consecutive_failures = 0
+            breaker.open_until = None
+            breaker.last_success_at = now
+        db.commit()
+    except Exception as e:
+        logger.error(f"更新熔断状态失败: {str(e)}\n{traceback.format_exc()}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def record_failure(app_id: int, platform: str, error: BaseException) -> None:
+    """
+    抓取失败，累计失败次数，达到阈值时熔断（半开时重新熔断）；熔断导致的失败不计入。
+    只有临时错误计入商店的失败次数；商店正在试探时，非临时错误说明不了商店是否恢复，让下一个抓取再试探
+    """
+    if isinstance(error, CircuitOpenError):
+        return
+    transient = is_transient(error)
+    not_found = getattr(error, "not_found", False)
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        message = str(getattr(error, "detail", None) or error)[:500]
+        breakers = [_get(db, "app", platform, app_id)]
+        if transient:
+            breakers.append(_get(db, "store", platform))
+        else:
+            store = db.query(CircuitBreaker).filter(CircuitBreaker.key == _store_key(platform)).first()
+            if store is not None and store.state == "half_open":
+                store.state = "open"
+                store.open_until = now
+        for breaker in breakers:
+            breaker.consecutive_failures = (breaker.consecutive_failures or 0) + 1
+            breaker.total_failures = (breaker.total_failures or 0) + 1
+            breaker.last_error = message
+            breaker.last_failure_at = now
+            failures = breaker.consecutive_failures
+            if breaker.scope == "store":
+                if failures < CIRCUIT_STORE_FAILURE_THRESHOLD:
+                    continue
+                breaker.state = "open"
+                breaker.open_until = now + _open_duration(
+                    timedelta(seconds=CIRCUIT_STORE_OPEN_SECONDS), failures, CIRCUIT_STORE_FAILURE_THRESHOLD
+                )
+            elif failures >= CIRCUIT_APP_DISABLE_AFTER or (not_found and failures >= CIRCUIT_APP_FAILURE_THRESHOLD):
+                breaker.state = "disabled"
+                breaker.open_until = None
+            elif failures >= CIRCUIT_APP_FAILURE_THRESHOLD:
+                breaker.state = "open"
+                breaker.open_until = now + _open_duration(
+                    timedelta(minutes=CIRCUIT_APP_OPEN_MINUTES), failures, CIRCUIT_APP_FAILURE_THRESHOLD
+                )
+            else:
+                # 未达到阈值（如试探时的非临时错误）：半开的熔断器按到期处理，下一个抓取再试探
+                if breaker.state == "half_open":
+                    breaker.state = "open"
+                    breaker.open_until = now
+                continue
+            logger.warning(
+                f"熔断器 {breaker.key} 连续失败 {failures} 次，"
+                + ("停止抓取，直到修改应用或手动重置" if breaker.state == "disabled"
+                   else f"{breaker.open_until:%Y-%m-%d %H:%M:%S} 前跳过")
+                + f": {message}"
+            )
+        db.commit()
+    except Exception as e:
+        logger.error(f"更新熔断状态失败: {str(e)}\n{traceback.format_exc()}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def reset(db, app_id: int, platform: Optional[str] = None) -> int:
+    """重置应用的熔断状态和失败计数（由调用方提交事务）"""
+    query = db.query(CircuitBreaker).filter(CircuitBreaker.scope == "app", CircuitBreaker.app_id == app_id)
+    if platform:
+        query = query.filter(CircuitBreaker.platform == platform)
+    return query.update({"state": "closed", "consecutive_failures": 0, "open_until": None},
+                        synchronize_session=False)
+
+
+def delete_app_breakers(db, app_id: int) -> None:
+    """删除应用时清理熔断状态（由调用方提交事务）"""
+    db.query(CircuitBreaker).filter(CircuitBreaker.scope == "app", CircuitBreaker.app_id == app_id).delete(
+        synchronize_session=False
+    )
+
+
+def breaker_to_dict(breaker: CircuitBreaker, now: Optional[datetime] = None) -> Dict[str, Any]:
+    now = now or datetime.now()
+    return {
+        "scope": breaker.scope,
+        "app_id": breaker.app_id,
+        "platform": breaker.platform,
+        "state": breaker.state,
+        "open": _is_open(breaker, now),
+        "open_until": breaker.open_until,
+        "consecutive_failures": breaker.consecutive_failures,
+        "total_failures": breaker.total_failures,
+        "last_error": breaker.last_error,
+        "last_failure_at": breaker.last_failure_at,
+        "last_success_at": breaker.last_success_at,
+    }
+
+
+def list_breakers(db, include_closed: bool = False) -> List[Dict[str, Any]]:
+    query = db.query(CircuitBreaker)
+    if not include_closed:
+        query = query.filter(CircuitBreaker.state != "closed")
+    now = datetime.now()
+    return [breaker_to_dict(breaker, now) for breaker in query.order_by(CircuitBreaker.scope.desc(), CircuitBreaker.key)]
@@ -0,0 +1,245 @@
+"""
+评论正文压缩存储
+
+评论正文存放在 review_contents 表中（reviews 表只保留评分、日期等小字段，统计和趋势
+查询扫描的数据量更小）。正文按 REVIEW_CONTENT_CODEC 压缩：
+
+    zstd  - 需要安装 zstandard，支持训练的字典
+    zlib  - 标准库，使用 zdict 预置字典
+    none  - 不压缩
+
+评论很短，单条压缩效果有限，因此按语言（按文字系统粗略判断）训练字典，保存在
+compression_dicts 表，每条正文记录压缩时使用的 dict_id，旧字典始终可以解压。
+
+命令行:
+    python -m app.compression train   # 从已有评论采样训练字典
+    python -m app.compression stats   # 查看压缩前后的大小
+"""
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from .config import REVIEW_CONTENT_CODEC
+from .database import engine
+from .logger import setup_logger
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - 未安装时使用 zlib
+    zstandard = None
+
+logger = setup_logger("compression")
+
+DICT_SIZE = 32 * 1024  # zlib 的 zdict 最多使用 32KB
+MIN_TRAIN_SAMPLES = 200
+TRAIN_SAMPLES_PER_LANGUAGE = 5000
+DICT_REFRESH_SECONDS = 600  # 其他进程训练的新字典最多延迟这么久生效
+
+if REVIEW_CONTENT_CODEC == "auto":
+    CODEC = "zstd" if zstandard is not None else "zlib"
+elif REVIEW_CONTENT_CODEC == "none":
+    CODEC = "plain"
+else:
+    CODEC = REVIEW_CONTENT_CODEC
+
+_KANA_RE = re.compile("[\u3040-\u30ff]")
+_HANGUL_RE = re.compile("[\uac00-\ud7af]")
+_HAN_RE = re.compile("[\u3400-\u9fff]")
+
+_lock = threading.Lock()
+_dicts: Dict[int, Tuple[str, bytes]] = {}  # dict_id -> (codec, data)
+_active: Dict[Tuple[str, str], int] = {}  # (codec, language) -> 最新的 dict_id
+_zstd_dicts: Dict[int, "zstandard.ZstdCompressionDict"] = {}
+_loaded_at = 0.0
+
+
+def detect_language(content: str) -> str:
+    """按文字系统粗略区分语言，用于选择压缩字典"""
+    if _KANA_RE.search(content):
+        return "ja"
+    if _HANGUL_RE.search(content):
+        return "ko"
+    if _HAN_RE.search(content):
+        return "zh"
+    return "latin"
+
+
+def _load_dicts(force: bool = False) -> None:
+    global _loaded_at
+    if not force and time.time() - _loaded_at < DICT_REFRESH_SECONDS:
+        return
+    with _lock:
+        if not force and time.time() - _loaded_at < DICT_REFRESH_SECONDS:
+            return
+        try:
+            with engine.connect() as conn:
+                rows = conn.execute(text(
+                    "SELECT id, language, codec, data FROM compression_dicts ORDER BY id"
+                )).all()
+        except Exception:
+            rows = []  # 表还未创建
+        for row in rows:
+            _dicts[row.id] = (row.codec, row.data)
+            _active[(row.codec, row.language)] = row.id
+        _loaded_at = time.time()
+
+
+def _dict_data(dict_id: Optional[int]) -> Optional[bytes]:
+    if dict_id is None:
+        return None
+    if dict_id not in _dicts:
+        _load_dicts(force=True)
+    if dict_id not in _dicts:
+        raise ValueError(f"压缩字典不存在: {dict_id}")
+    return _dicts[dict_id][1]
+
+
+def _zstd_dict(dict_id: Optional[int]):
+    if dict_id is None:
+        return None
+    if dict_id not in _zstd_dicts:
+        _zstd_dicts[dict_id] = zstandard.ZstdCompressionDict(_dict_data(dict_id))
+    return _zstd_dicts[dict_id]
+
+
+def encode(content: str) -> Tuple[str, Optional[int], bytes]:
+    """压缩评论正文，返回 (codec, dict_id, data)；压缩后不变小时按原文存储"""
+    raw = content.encode("utf-8")
+    if CODEC == "plain" or not raw:
+        return "plain", None, raw
+
+    _load_dicts()
+    dict_id = _active.get((CODEC, detect_language(content)))
+    if CODEC == "zstd":
+        compressor = zstandard.ZstdCompressor(
+            level=6, dict_data=_zstd_dict(dict_id), write_checksum=False, write_dict_id=False
+        )
+        data = compressor.compress(raw)
+    else:
+        zdict = _dict_data(dict_id)
+        # 使用原始 deflate 流（wbits=-15），省去 zlib 头和校验和
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15, **({"zdict": zdict} if zdict else {}))
+        data = compressor.compress(raw) + compressor.flush()
+
+    if len(data) >= len(raw):
+        return "plain", None, raw
+    return CODEC, dict_id, data
+
+
+def decode(codec: Optional[str], dict_id: Optional[int], data: Optional[bytes]) -> Optional[str]:
+    """解压评论正文"""
+    if data is None:
+        return None
+    if codec == "plain":
+        return bytes(data).decode("utf-8")
+    if codec == "zlib":
+        zdict = _dict_data(dict_id)
+        decompressor = zlib.decompressobj(-15, **({"zdict": zdict} if zdict else {}))
+        return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("解压评论需要安装 zstandard")
+        return zstandard.ZstdDecompressor(dict_data=_zstd_dict(dict_id)).decompress(data).decode("utf-8")
+    raise ValueError(f"未知的压缩格式: {codec}")
+
+
+def _zlib_dictionary(samples: List[str]) -> bytes:
+    """
+    为 zlib 构造预置字典：统计样本中高频的片段，收益（出现次数 x 长度）越高越靠后，
+    deflate 对距离越近的引用编码越短
+    """
+    counter: Counter = Counter()
+    for sample in samples:
+        for n in (2, 3, 4, 6, 8):
+            for i in range(0, max(len(sample) - n + 1, 0)):
+                counter[sample[i:i + n]] += 1
+
+    scored = sorted(
+        ((count - 1) * len(piece.encode("utf-8")), piece)
+        for piece, count in counter.items() if count >= 3
+    )
+    chosen = []
+    size = 0
+    for _, piece in reversed(scored):
+        piece_size = len(piece.encode("utf-8"))
+        if size + piece_size > DICT_SIZE:
+            break
+        chosen.append(piece)
+        size += piece_size
+    return "".join(reversed(chosen)).encode("utf-8")
+
+
+def train_dictionaries(samples: Dict[str, List[str]]) -> List[int]:
+    """按语言训练压缩字典并保存，返回新字典的 ID"""
+    if CODEC == "plain":
+        return []
+    created = []
+    for language, texts in samples.items():
+        texts = [t for t in texts if t]
+        if len(texts) < MIN_TRAIN_SAMPLES:
+            logger.info(f"语言 {language} 的样本不足 {MIN_TRAIN_SAMPLES} 条，跳过字典训练")
+            continue
+        try:
+            if CODEC == "zstd":
+                data = zstandard.train_dictionary(DICT_SIZE * 4, [t.encode("utf-8") for t in texts]).as_bytes()
+            else:
+                data = _zlib_dictionary(texts)
+        except Exception as e:
+            logger.warning(f"训练语言 {language} 的压缩字典失败: {str(e)}")
+            continue
+        with engine.begin() as conn:
+            result = conn.execute(
+                text("INSERT INTO compression_dicts(language, codec, data, sample_count, created_at) "
+                     "VALUES (:language, :codec, :data, :sample_count, CURRENT_TIMESTAMP)"),
+                {"language": language, "codec": CODEC, "data": data, "sample_count": len(texts)},
+            )
+            created.append(result.lastrowid)
+        logger.info(f"已训练压缩字典: language={language}, codec={CODEC}, size={len(data)}, samples={len(texts)}")
+    _load_dicts(force=True)
+    return created
+
+
+def group_samples(texts) -> Dict[str, List[str]]:
+    samples: Dict[str, List[str]] = defaultdict(list)
+    for content in texts:
+        if content:
+            language = detect_language(content)
+            if len(samples[language]) < TRAIN_SAMPLES_PER_LANGUAGE:
+                samples[language].append(content)
+    return samples
+
+
+def train_from_database() -> List[int]:
+    """从最近的评论中采样训练字典"""
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT codec, dict_id, data FROM review_contents ORDER BY review_id DESC LIMIT :limit"
+        ), {"limit": TRAIN_SAMPLES_PER_LANGUAGE * 4}).all()
+    return train_dictionaries(group_samples(decode(row.codec, row.dict_id, row.data) for row in rows))
+
+
+def storage_stats() -> List[Dict]:
+    """按压缩格式统计正文条数与存储字节数"""
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT codec, COUNT(*) AS count, SUM(LENGTH(data)) AS stored FROM review_contents GROUP BY codec"
+        )).mappings().all()
+    return [dict(row) for row in rows]
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "train":
+        print(f"已创建字典: {train_from_database()}")
+    elif command == "stats":
+        for row in storage_stats():
+            print(f"{row['codec']}: {row['count']} 条, {row['stored'] or 0} 字节")
+    else:
+        print("用法: python -m app.compression [train|stats]")
+        sys.exit(1)
@@ -1,4 +1,144 @@
 from os import getenv
 
 DATABASE_URL = getenv("DATABASE_URL", "sqlite:///./data/app.db")
-AUTH_CODE = getenv("AUTH_CODE", "admin123")  # 默认授权码 
\ No newline at end of file
+AUTH_CODE = getenv("AUTH_CODE", "admin123")  # 默认授权码
+
+# 支持的国家/地区列表（与前端共用），每个应用的多个国家同时抓取的并发数
+COUNTRIES_FILE = getenv("COUNTRIES_FILE", "./config/countries.json")
+COUNTRY_FANOUT_CONCURRENCY = int(getenv("COUNTRY_FANOUT_CONCURRENCY", "4"))
+
+# 删除应用时分批清理评论
+PURGE_BATCH_SIZE = int(getenv("PURGE_BATCH_SIZE", "500"))
+PURGE_BATCH_PAUSE = float(getenv("PURGE_BATCH_PAUSE", "0.05"))  # 每批之间让出写锁的秒数
+PURGE_WAIT_SECONDS = float(getenv("PURGE_WAIT_SECONDS", "2"))  # 等待应用正在执行的抓取任务结束时的检查间隔
+
+# 评论保留与归档
+RETENTION_MONTHS = int(getenv("RETENTION_MONTHS", "0"))  # 默认保留月数，0 表示不归档
+ARCHIVE_DIR = getenv("ARCHIVE_DIR", "./data/archive")
+ARCHIVE_BATCH_SIZE = int(getenv("ARCHIVE_BATCH_SIZE", "1000"))
+VACUUM_STEP_PAGES = int(getenv("VACUUM_STEP_PAGES", "1000"))  # 每次增量回收的页数
+
+# 商店原始响应存档：按内容哈希去重、压缩保存每次抓取的原始响应，修复解析问题后可离线重新解析
+RAW_ARCHIVE_ENABLED = getenv("RAW_ARCHIVE_ENABLED", "false").lower() == "true"
+RAW_ARCHIVE_DIR = getenv("RAW_ARCHIVE_DIR", "./data/raw")
+
+# 评论正文压缩格式：auto（有 zstandard 时用 zstd，否则 zlib）、zstd、zlib、none
+REVIEW_CONTENT_CODEC = getenv("REVIEW_CONTENT_CODEC", "auto")
+
+# 在线备份
+BACKUP_DIR = getenv("BACKUP_DIR", "./data/backup")
+BACKUP_INTERVAL_HOURS = float(getenv("BACKUP_INTERVAL_HOURS", "24"))  # 0 表示不自动备份
+BACKUP_RETENTION = int(getenv("BACKUP_RETENTION", "14"))  # 保留最近的备份份数
+BACKUP_STEP_PAGES = int(getenv("BACKUP_STEP_PAGES", "1000"))  # 每步复制的页数
+BACKUP_STEP_SLEEP = float(getenv("BACKUP_STEP_SLEEP", "0.01"))  # 每步之间的间隔秒数
+
+# 自适应轮询
+POLL_TICK_MINUTES = int(getenv("POLL_TICK_MINUTES", "5"))  # 检查到期应用的间隔
+POLL_MIN_INTERVAL_MINUTES = int(getenv("POLL_MIN_INTERVAL_MINUTES", "60"))  # 最活跃的应用每小时一次
+POLL_MAX_INTERVAL_MINUTES = int(getenv("POLL_MAX_INTERVAL_MINUTES", str(7 * 24 * 60)))  # 不活跃的应用每周一次
+POLL_DEFAULT_INTERVAL_MINUTES = int(getenv("POLL_DEFAULT_INTERVAL_MINUTES", str(24 * 60)))
+POLL_TARGET_NEW_PER_RUN = int(getenv("POLL_TARGET_NEW_PER_RUN", "30"))  # 期望每次抓到的新增评论数
+POLL_EWMA_ALPHA = float(getenv("POLL_EWMA_ALPHA", "0.3"))
+POLL_MIN_LIMIT = int(getenv("POLL_MIN_LIMIT", "20"))
+POLL_MAX_LIMIT = int(getenv("POLL_MAX_LIMIT", "1000"))
+POLL_DEFAULT_LIMIT = int(getenv("POLL_DEFAULT_LIMIT", "100"))
+POLL_REQUEST_BUDGET_PER_HOUR = int(getenv("POLL_REQUEST_BUDGET_PER_HOUR", "600"))  # 所有应用、所有进程每小时的请求预算
+
+# 错峰调度
+SCHEDULE_WINDOW_MINUTES = int(getenv("SCHEDULE_WINDOW_MINUTES", str(24 * 60)))  # 各应用的抓取时间均匀分布在该窗口内
+SCHEDULE_JITTER_SECONDS = int(getenv("SCHEDULE_JITTER_SECONDS", "300"))  # 在分配的时间点上随机偏移
+STORE_MAX_IN_FLIGHT = {  # 每个商店同时进行的抓取数上限（所有进程合计）
+    "ios": int(getenv("STORE_MAX_IN_FLIGHT_IOS", "2")),
+    "android": int(getenv("STORE_MAX_IN_FLIGHT_ANDROID", "2")),
+}
+
+# 商店请求限速（令牌桶，按 AIMD 自适应）
+STORE_RATE_INITIAL = {  # 每个商店初始的每秒请求数
+    "ios": float(getenv("STORE_RATE_IOS", "1")),
+    "android": float(getenv("STORE_RATE_ANDROID", "1")),
+}
+STORE_RATE_MIN = float(getenv("STORE_RATE_MIN", "0.05"))  # 被限流后降到的最低速率
+STORE_RATE_MAX = float(getenv("STORE_RATE_MAX", "5"))
+STORE_RATE_BURST = float(getenv("STORE_RATE_BURST", "3"))  # 令牌桶容量，允许的瞬时突发请求数
+STORE_RATE_INCREASE = float(getenv("STORE_RATE_INCREASE", "0.02"))  # 每个成功请求增加的速率
+STORE_RATE_DECREASE = float(getenv("STORE_RATE_DECREASE", "0.5"))  # 收到 429/5xx 时速率乘以该系数
+# 向商店发出请求的进程数（内嵌工作线程的 API 进程与独立工作进程之和）。限速器在进程内，各进程按 1/N 分配速率
+STORE_REQUEST_PROCESSES = max(int(getenv("STORE_REQUEST_PROCESSES", getenv("WEB_CONCURRENCY", "1"))), 1)
+STORE_RETRY_AFTER_MAX_SECONDS = float(getenv("STORE_RETRY_AFTER_MAX_SECONDS", "900"))  # Retry-After 最多暂停的时间
+STORE_THROTTLE_RETRIES = int(getenv("STORE_THROTTLE_RETRIES", "2"))  # 被限流的请求等待后重试的次数
+
+# 调度器任务持久化在数据库中，重启后不会多跑也不会丢失错过的执行
+SCHEDULER_MISFIRE_GRACE_SECONDS = int(getenv("SCHEDULER_MISFIRE_GRACE_SECONDS", str(6 * 3600)))  # 错过的执行在该时间内仍会补跑一次
+
+# 抓取任务队列
+INGEST_EMBEDDED_WORKER = getenv("INGEST_EMBEDDED_WORKER", "true").lower() == "true"  # 是否在 API 进程内执行抓取任务
+INGEST_WORKERS = int(getenv("INGEST_WORKERS", "4"))  # 每个工作进程执行抓取任务的线程数
+INGEST_LANE_WEIGHTS = {  # 各通道分得工作线程的权重，格式如 "interactive:6,scheduled:3,backfill:1"
+    lane: float(weight)
+    for lane, weight in (
+        item.split(":") for item in getenv("INGEST_LANE_WEIGHTS", "interactive:6,scheduled:3,backfill:1").split(",")
+    )
+}
+INGEST_RESERVED_INTERACTIVE = int(getenv("INGEST_RESERVED_INTERACTIVE", "1"))  # 为手动刷新保留的工作线程数
+INGEST_MAX_WAIT_SECONDS = int(getenv("INGEST_MAX_WAIT_SECONDS", "600"))  # 排队超过该时间的任务优先执行，防止饿死
+INGEST_LEASE_SECONDS = int(getenv("INGEST_LEASE_SECONDS", "120"))  # 租约有效期，超过未续约的任务会被重新领取
+INGEST_HEARTBEAT_SECONDS = int(getenv("INGEST_HEARTBEAT_SECONDS", "30"))  # 执行中的任务续约间隔
+INGEST_MAX_ATTEMPTS = int(getenv("INGEST_MAX_ATTEMPTS", "3"))  # 租约过期后最多重新领取的次数
+INGEST_POLL_SECONDS = float(getenv("INGEST_POLL_SECONDS", "2"))  # 空闲时检查新任务的间隔
+INGEST_TASK_RETENTION_DAYS = int(getenv("INGEST_TASK_RETENTION_DAYS", "7"))  # 已完成任务的保留天数
+
+# 多进程部署时只有持有租约的进程运行定时调度器
+LEADER_LEASE_SECONDS = int(getenv("LEADER_LEASE_SECONDS", "30"))  # 领导权租约有效期
+LEADER_RENEW_SECONDS = int(getenv("LEADER_RENEW_SECONDS", "10"))  # 续约及竞选的间隔
+
+# 历史评论全量抓取
+BACKFILL_REQUESTS_PER_MINUTE = float(getenv("BACKFILL_REQUESTS_PER_MINUTE", "6"))  # 全量抓取的请求速率（所有进程合计，按 STORE_REQUEST_PROCESSES 分配），独立于轮询预算
+BACKFILL_PAGES_PER_TASK = int(getenv("BACKFILL_PAGES_PER_TASK", "50"))  # 每个任务抓取的页数，之后重新排队让出工作线程
+
+# 抓取记录与慢任务检测
+SLOW_RUN_FACTOR = float(getenv("SLOW_RUN_FACTOR", "3"))  # 耗时超过近期中位数的倍数视为慢
+SLOW_RUN_MIN_SECONDS = float(getenv("SLOW_RUN_MIN_SECONDS", "30"))  # 低于该耗时不算慢
+SLOW_RUN_BASELINE = int(getenv("SLOW_RUN_BASELINE", "20"))  # 计算中位数使用的近期成功次数
+INGESTION_RUN_RETENTION_DAYS = int(getenv("INGESTION_RUN_RETENTION_DAYS", "30"))  # 抓取记录保留天数
+
+# 商店请求的连接池
+HTTP_POOL_SIZE = int(getenv("HTTP_POOL_SIZE", "10"))  # 每个主机保持的连接数
+# 把商店请求改发到本地的商店替身服务（压测用，见 benchmarks/fake_stores.py），如 http://127.0.0.1:8765
+STORE_STAND_IN_URL = getenv("STORE_STAND_IN_URL", "")
+APP_STORE_TOKEN_TTL_SECONDS = int(getenv("APP_STORE_TOKEN_TTL_SECONDS", "3600"))  # App Store 网页 token 的缓存时间
+
+# 各商店使用的抓取方式，如 ios=scraper,android=library；未指定的商店自动选择最快的（见 scrapers/backends.py）
+SCRAPER_BACKENDS = {
+    store.strip(): name.strip()
+    for store, _, name in (item.partition("=") for item in getenv("SCRAPER_BACKENDS", "").split(","))
+    if store.strip() and name.strip()
+}
+# 兼容旧配置：App Store 抓取方式，concurrent（旧名称 async）为内置的并发客户端，scraper 为 app_store_scraper 逐页抓取
+APP_STORE_BACKEND = getenv("APP_STORE_BACKEND", "")
+if APP_STORE_BACKEND:
+    SCRAPER_BACKENDS.setdefault("ios", APP_STORE_BACKEND)
+APP_STORE_CONCURRENCY = int(getenv("APP_STORE_CONCURRENCY", "4"))  # concurrent 方式同时进行的请求数
+
+# Google Play 全量抓取（不限条数）按星级拆成独立的分区并发抓取
+PLAY_PARTITIONED_CRAWL = getenv("PLAY_PARTITIONED_CRAWL", "true").lower() == "true"
+PLAY_PARTITION_SORTS = [  # 每个星级再按这些排序方式各抓一遍（newest、most_relevant），结果按评论 ID 去重
+    sort.strip() for sort in getenv("PLAY_PARTITION_SORTS", "newest").split(",") if sort.strip()
+]
+PLAY_PARTITION_CONCURRENCY = int(getenv("PLAY_PARTITION_CONCURRENCY", "5"))  # 同时抓取的分区数
+
+# 抓取与写入流水线：每个抓取来源（国家）最多预取的页数，写入跟不上时抓取等待
+STREAM_QUEUE_PAGES = int(getenv("STREAM_QUEUE_PAGES", "2"))
+
+# 抓取超时
+STORE_REQUEST_TIMEOUT_SECONDS = float(getenv("STORE_REQUEST_TIMEOUT_SECONDS", "30"))  # 单个商店请求的超时
+INGEST_TASK_DEADLINE_SECONDS = float(getenv("INGEST_TASK_DEADLINE_SECONDS", "600"))  # 单个抓取任务的截止时间，0 表示不限
+
+# 失败重试与熔断
+STORE_RETRY_ATTEMPTS = int(getenv("STORE_RETRY_ATTEMPTS", "2"))  # 超时、连接失败等临时错误的重试次数
+STORE_RETRY_BASE_SECONDS = float(getenv("STORE_RETRY_BASE_SECONDS", "2"))  # 第 n 次重试前等待 base * 2^(n-1) 秒
+CIRCUIT_STORE_FAILURE_THRESHOLD = int(getenv("CIRCUIT_STORE_FAILURE_THRESHOLD", "5"))  # 商店连续失败多少次后熔断
+CIRCUIT_STORE_OPEN_SECONDS = int(getenv("CIRCUIT_STORE_OPEN_SECONDS", "300"))  # 商店熔断的初始时长，再次失败时翻倍
+CIRCUIT_APP_FAILURE_THRESHOLD = int(getenv("CIRCUIT_APP_FAILURE_THRESHOLD", "3"))  # 应用连续失败多少次后熔断
+CIRCUIT_APP_OPEN_MINUTES = int(getenv("CIRCUIT_APP_OPEN_MINUTES", "60"))  # 应用熔断的初始时长，再次失败时翻倍
+CIRCUIT_MAX_OPEN_HOURS = int(getenv("CIRCUIT_MAX_OPEN_HOURS", "24"))  # 熔断时长上限
+CIRCUIT_APP_DISABLE_AFTER = int(getenv("CIRCUIT_APP_DISABLE_AFTER", "10"))  # 应用连续失败多少次后停止抓取，直到修改应用或手动重置
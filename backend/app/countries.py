@@ -0,0 +1,69 @@
+"""
+支持的国家/地区
+
+列表来自 COUNTRIES_FILE（默认 config/countries.json，与前端共用，格式为 {"cn": "中国", ...}），文件不存在时
+使用内置的列表。应用的每个平台可以设置多个国家（apps.app_store_countries / play_store_countries，逗号分隔），
+抓取时各国家并发进行，评论记录来源国家（reviews.country）。
+"""
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Union
+
+from .config import COUNTRIES_FILE
+from .exceptions import InvalidCountryError
+from .logger import setup_logger
+
+logger = setup_logger("countries")
+
+DEFAULT_COUNTRIES = {
+    "cn": "中国",
+    "us": "美国",
+    "jp": "日本",
+    "kr": "韩国",
+    "hk": "香港",
+    "tw": "台湾",
+    "sg": "新加坡",
+    "my": "马来西亚",
+    "id": "印度尼西亚",
+    "ph": "菲律宾",
+    "mm": "缅甸",
+    "th": "泰国",
+    "vn": "越南",
+}
+
+_countries: Optional[Dict[str, str]] = None
+
+
+def supported() -> Dict[str, str]:
+    """国家代码 -> 名称"""
+    global _countries
+    if _countries is None:
+        countries = DEFAULT_COUNTRIES
+        if os.path.exists(COUNTRIES_FILE):
+            try:
+                with open(COUNTRIES_FILE, encoding="utf-8") as f:
+                    data = json.load(f)
+                if isinstance(data, dict) and isinstance(data.get("countries"), list):
+                    data = {item["code"]: item["name"] for item in data["countries"]}
+                countries = {code.lower(): name for code, name in data.items()}
+            except Exception as e:
+                logger.warning(f"读取 {COUNTRIES_FILE} 失败，使用内置的国家列表: {str(e)}")
+        _countries = countries
+    return _countries
+
+
+def normalize(codes: Union[str, Iterable[str]]) -> List[str]:
+    """校验国家代码（列表或逗号分隔的字符串），转为小写并去重，保持原来的顺序"""
+    if isinstance(codes, str):
+        codes = codes.split(",")
+    result = []
+    for code in codes:
+        code = str(code).strip().lower()
+        if not code or code in result:
+            continue
+        if code not in supported():
+            raise InvalidCountryError(f"不支持的国家/地区: {code}")
+        result.append(code)
+    if not result:
+        raise InvalidCountryError("至少需要一个国家/地区")
+    return result
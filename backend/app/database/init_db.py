@@ -1,7 +1,120 @@
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
 from app.models import Base, App, Review
-from app.config import DATABASE_URL
+from app.config import ARCHIVE_DIR, DATABASE_URL
+from app.search import ensure_search_index
+from app import archive, compression
+import os
+
+MIGRATE_BATCH_SIZE = 1000
+
+def upgrade_schema(engine):
+    """为已有数据库补齐新增的表、字段和索引"""
+    Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                print(f"为表 {table.name} 添加字段 {column.name}")
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+def migrate_review_contents(engine):
+    """把旧版 reviews.content 中的正文迁移到 review_contents（按配置压缩）"""
+    columns = {column["name"] for column in inspect(engine).get_columns("reviews")}
+    if "content" not in columns:
+        return
+
+    with engine.connect() as conn:
+        has_dicts = conn.execute(text("SELECT 1 FROM compression_dicts LIMIT 1")).first()
+        samples = conn.execute(text(
+            "SELECT content FROM reviews WHERE content IS NOT NULL ORDER BY id DESC LIMIT :limit"
+        ), {"limit": compression.TRAIN_SAMPLES_PER_LANGUAGE * 4}).scalars().all()
+    if not samples:
+        total = 0
+    else:
+        print("正在迁移评论正文到 review_contents...")
+        if not has_dicts:
+            compression.train_dictionaries(compression.group_samples(samples))
+        last_id = 0
+        total = 0
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(text(
+                    "SELECT id, content FROM reviews WHERE id > :last_id AND content IS NOT NULL "
+                    "ORDER BY id LIMIT :limit"
+                ), {"last_id": last_id, "limit": MIGRATE_BATCH_SIZE}).all()
+                if not rows:
+                    break
+                values = []
+                for row in rows:
+                    codec, dict_id, data = compression.encode(row.content)
+                    values.append({"review_id": row.id, "codec": codec, "dict_id": dict_id, "data": data})
+                conn.execute(text(
+                    "INSERT OR REPLACE INTO review_contents(review_id, codec, dict_id, data) "
+                    "VALUES (:review_id, :codec, :dict_id, :data)"
+                ), values)
+            last_id = rows[-1].id
+            total += len(rows)
+
+    with engine.begin() as conn:
+        try:
+            conn.exec_driver_sql("ALTER TABLE reviews DROP COLUMN content")
+        except Exception:
+            # SQLite 3.35 以下不支持删除字段，清空即可（迁移可重复执行）
+            conn.exec_driver_sql("UPDATE reviews SET content = NULL")
+    print(f"评论正文迁移完成，共 {total} 条；如需回收空间，请在停机时执行 VACUUM")
+
+def migrate_review_countries(engine):
+    """旧评论没有记录国家，按应用当前的主要国家补齐（分批更新，避免长时间占用写锁）"""
+    with engine.connect() as conn:
+        if not conn.execute(text("SELECT 1 FROM reviews WHERE country IS NULL LIMIT 1")).first():
+            return
+    print("正在为已有评论补齐国家/地区...")
+    last_id = 0
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            ids = conn.execute(text(
+                "SELECT id FROM reviews WHERE id > :last_id AND country IS NULL ORDER BY id LIMIT :limit"
+            ), {"last_id": last_id, "limit": MIGRATE_BATCH_SIZE}).scalars().all()
+            if not ids:
+                break
+            conn.execute(text(
+                "UPDATE reviews SET country = ("
+                "SELECT CASE WHEN reviews.platform = 'ios' THEN apps.app_store_country ELSE apps.play_store_country END "
+                "FROM apps WHERE apps.id = reviews.app_id"
+                ") WHERE id >= :first_id AND id <= :last_id AND country IS NULL"
+            ), {"first_id": ids[0], "last_id": ids[-1]})
+        last_id = ids[-1]
+        total += len(ids)
+    print(f"国家/地区补齐完成，共 {total} 条")
+
+def migrate_archived_keys(engine):
+    """升级前归档的评论没有去重字段：按归档文件补齐，并重建这些应用的月度汇总"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    with engine.connect() as conn:
+        indexed = set(conn.execute(text("SELECT DISTINCT app_id FROM archived_review_keys")).scalars().all())
+    app_ids = [
+        int(name[len("app_"):]) for name in os.listdir(ARCHIVE_DIR)
+        if name.startswith("app_") and name[len("app_"):].isdigit()
+    ]
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    for app_id in sorted(set(app_ids) - indexed):
+        db = SessionLocal()
+        try:
+            total = archive.rebuild_index(db, app_id)
+        finally:
+            db.close()
+        if total:
+            print(f"已按归档文件补齐应用 {app_id} 的去重字段和月度汇总，共 {total} 条")
 
 def init_db():
     engine = create_engine(DATABASE_URL)
@@ -10,6 +123,10 @@ def init_db():
     # 检查表是否已存在
     if not inspector.has_table("apps"):
         print("检测到数据库表不存在，正在创建新表...")
+        if engine.dialect.name == "sqlite":
+            # 新库开启增量回收，归档和删除后可以分步释放空间
+            with engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
         # 创建新表
         Base.metadata.create_all(bind=engine)
         
@@ -55,5 +172,11 @@ def init_db():
     else:
         print("数据库表已存在，无需初始化。")
 
+    upgrade_schema(engine)
+    migrate_review_contents(engine)
+    migrate_review_countries(engine)
+    migrate_archived_keys(engine)
+    ensure_search_index(engine)
+
 if __name__ == "__main__":
     init_db()
\ No newline at end of file
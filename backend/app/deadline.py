@@ -0,0 +1,26 @@
+import time
+from typing import Optional
+
+from .config import INGEST_TASK_DEADLINE_SECONDS, STORE_REQUEST_TIMEOUT_SECONDS
+
+
+class Deadline:
+    """抓取任务的截止时间，seconds 为 0 或 None 时不限"""
+
+    def __init__(self, seconds: Optional[float] = INGEST_TASK_DEADLINE_SECONDS):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def timeout(self, limit: float = STORE_REQUEST_TIMEOUT_SECONDS) -> float:
+        """单个请求的超时：不超过 limit，也不超过剩余时间"""
+        remaining = self.remaining()
+        if remaining is None:
+            return limit
+        return max(min(limit, remaining), 0.1)
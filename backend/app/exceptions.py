@@ -1,12 +1,16 @@
 from fastapi import HTTPException
 
 class AppStoreError(HTTPException):
-    def __init__(self, detail: str):
+    def __init__(self, detail: str, transient: bool = False, not_found: bool = False):
         super().__init__(status_code=400, detail=detail)
+        self.transient = transient  # 超时、连接失败、限流、5xx 等重试可能成功的错误，由抛出方明确标记
+        self.not_found = not_found  # 应用不存在、ID 无效
 
 class PlayStoreError(HTTPException):
-    def __init__(self, detail: str):
+    def __init__(self, detail: str, transient: bool = False, not_found: bool = False):
         super().__init__(status_code=400, detail=detail)
+        self.transient = transient
+        self.not_found = not_found
 
 class DatabaseError(HTTPException):
     def __init__(self, detail: str):
@@ -14,4 +18,18 @@ class DatabaseError(HTTPException):
 
 class ReviewFetchError(HTTPException):
     def __init__(self, detail: str):
-        super().__init__(status_code=400, detail=detail) 
\ No newline at end of file
+        super().__init__(status_code=400, detail=detail)
+
+class CircuitOpenError(HTTPException):
+    """商店或应用的熔断器打开，跳过抓取"""
+    def __init__(self, detail: str):
+        super().__init__(status_code=503, detail=detail)
+
+class AppDeletedError(HTTPException):
+    """应用已删除（或正在清理），停止抓取和写入"""
+    def __init__(self, detail: str):
+        super().__init__(status_code=404, detail=detail)
+
+class InvalidCountryError(HTTPException):
+    def __init__(self, detail: str):
+        super().__init__(status_code=400, detail=detail)
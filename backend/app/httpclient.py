@@ -0,0 +1,65 @@
+"""
+商店请求共用的 HTTP 连接池
+
+App Store 和 Google Play 的抓取共用一个进程级的 requests.Session：长连接复用 TCP/TLS 连接，每个主机最多保持
+HTTP_POOL_SIZE 个连接（与工作线程数相当即可）。requests 只支持 HTTP/1.1，需要 HTTP/2 时要换用 httpx。
+
+连接失败自动重试；读超时不重试，超时与其他错误的重试由调用方决定。request() 还会经过商店的限速器。
+
+设置 STORE_STAND_IN_URL 时，request() 把商店请求改发到本地的替身服务：https://<主机><路径> 变为
+<STORE_STAND_IN_URL>/<主机><路径>，用于压测抓取流程（见 benchmarks/fake_stores.py）。
+"""
+import threading
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import HTTP_POOL_SIZE, STORE_STAND_IN_URL, STORE_THROTTLE_RETRIES
+from . import ratelimit
+
+_session: Optional[requests.Session] = None
+_lock = threading.Lock()
+
+
+def session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=4,
+                    pool_maxsize=HTTP_POOL_SIZE,
+                    max_retries=Retry(total=2, connect=2, read=False, status=0, respect_retry_after_header=False),
+                )
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _session = s
+    return _session
+
+
+def _stand_in(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{STORE_STAND_IN_URL.rstrip('/')}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+
+
+def request(store: str, method: str, url: str, timeout: float, **kwargs) -> requests.Response:
+    """
+    经过商店的限速器发出请求：429/5xx 时降速，按 Retry-After 暂停后重试 STORE_THROTTLE_RETRIES 次，
+    仍被限流时返回最后的响应；timeout 内取不到令牌时抛出 requests.Timeout
+    """
+    limiter = ratelimit.limiters[store]
+    if STORE_STAND_IN_URL:
+        url = _stand_in(url)
+    for attempt in range(STORE_THROTTLE_RETRIES + 1):
+        if not limiter.acquire(timeout):
+            raise requests.Timeout(f"等待 {store} 商店限速超时")
+        response = session().request(method, url, timeout=timeout, **kwargs)
+        if not ratelimit.is_throttled(response.status_code):
+            limiter.success()
+            return response
+        limiter.throttled(ratelimit.retry_after(response.headers.get("Retry-After")))
+    return response
@@ -0,0 +1,375 @@
+"""
+带优先级的评论抓取队列
+
+所有抓取任务（手动刷新、自适应轮询、历史全量抓取）都写入 ingest_tasks 表，由工作线程通过租约
+领取执行。工作线程可以运行在 API 进程内（INGEST_EMBEDDED_WORKER=true，单容器部署的默认方式），
+也可以运行在独立的工作进程中（python -m app.worker），多个节点的工作进程共享同一个队列。
+
+任务分为三条通道：
+
+    interactive - 用户手动刷新
+    scheduled   - 自适应轮询的增量抓取
+    backfill    - 不限条数的历史全量抓取
+
+调度规则（每个工作进程各自执行）：
+- 按 INGEST_LANE_WEIGHTS 的权重分配工作线程（stride 调度），默认 interactive:scheduled:backfill = 6:3:1；
+- 始终为 interactive 保留 INGEST_RESERVED_INTERACTIVE 个工作线程，手动刷新不必等后台任务执行完；
+- 任务排队超过 INGEST_MAX_WAIT_SECONDS 后不再按权重，直接按排队先后执行，低优先级通道不会饿死；
+- 同一应用、同一平台同时只有一个任务排队，更高优先级的任务会替换排队中的任务；
+  正在执行的应用平台不会被另一个工作线程同时抓取。
+
+租约：领取任务时写入 lease_owner 和 lease_expires_at（INGEST_LEASE_SECONDS 后过期），执行期间每
+INGEST_HEARTBEAT_SECONDS 续约一次。工作进程崩溃后租约过期，任务重新排队，累计领取
+INGEST_MAX_ATTEMPTS 次仍未完成的任务标记为失败。
+"""
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+
+from .config import (
+    INGEST_HEARTBEAT_SECONDS, INGEST_LANE_WEIGHTS, INGEST_LEASE_SECONDS, INGEST_MAX_ATTEMPTS,
+    INGEST_MAX_WAIT_SECONDS, INGEST_POLL_SECONDS, INGEST_RESERVED_INTERACTIVE, INGEST_TASK_RETENTION_DAYS,
+    INGEST_WORKERS, INGESTION_RUN_RETENTION_DAYS,
+)
+from .database import SessionLocal
+from .logger import setup_logger
+from .models import IngestionRun, IngestTask
+
+logger = setup_logger("ingestion")
+
+LANES = ("interactive", "scheduled", "backfill")  # 按优先级从高到低
+
+# 任务类型 -> 处理函数 handler(app_id, platform, limit) -> 新增评论数
+_handlers: Dict[str, Callable[[int, str, Optional[int]], Optional[int]]] = {}
+# 本进程提交任务时唤醒本进程内的工作线程，其他进程的任务靠轮询发现
+_wakeup = threading.Event()
+# 工作线程正在执行的任务，供处理函数记录抓取指标时关联任务
+_current = threading.local()
+
+
+def register_handler(kind: str, handler: Callable[[int, str, Optional[int]], Optional[int]]) -> None:
+    _handlers[kind] = handler
+
+
+def current_task() -> Optional[Dict[str, Any]]:
+    """当前线程正在执行的任务（id、kind、lane），不在工作线程中时返回 None"""
+    return getattr(_current, "task", None)
+
+
+def task_to_dict(task: IngestTask) -> Dict[str, Any]:
+    return {
+        "id": task.id,
+        "lane": task.lane,
+        "kind": task.kind,
+        "app_id": task.app_id,
+        "platform": task.platform,
+        "limit": task.fetch_limit,
+        "status": task.status,
+        "attempts": task.attempts,
+        "result": task.result,
+        "error": task.error,
+        "worker": task.lease_owner,
+        "created_at": task.created_at,
+        "started_at": task.started_at,
+        "finished_at": task.finished_at,
+    }
+
+
+def submit(lane: str, kind: str, app_id: int, platform: str, limit: Optional[int] = None) -> Dict[str, Any]:
+    """
+    提交任务。同一应用平台已在排队时不重复排队：新任务优先级更高则替换排队中的任务，否则返回排队中的任务
+    """
+    if lane not in LANES:
+        raise ValueError(f"未知的任务通道: {lane}")
+    db = SessionLocal()
+    try:
+        task = db.query(IngestTask).filter(
+            IngestTask.app_id == app_id, IngestTask.platform == platform, IngestTask.status == "queued"
+        ).order_by(IngestTask.id).first()
+        if task is not None:
+            if LANES.index(lane) < LANES.index(task.lane):
+                task.lane, task.kind, task.fetch_limit = lane, kind, limit
+        else:
+            task = IngestTask(lane=lane, kind=kind, app_id=app_id, platform=platform, fetch_limit=limit,
+                              status="queued", attempts=0, created_at=datetime.now())
+            db.add(task)
+        db.commit()
+        result = task_to_dict(task)
+    finally:
+        db.close()
+    _wakeup.set()
+    return result
+
+
+def pending(db, app_id: int, platform: str) -> bool:
+    """该应用平台是否已有任务在排队或执行"""
+    return db.query(IngestTask.id).filter(
+        IngestTask.app_id == app_id,
+        IngestTask.platform == platform,
+        IngestTask.status.in_(["queued", "running"]),
+    ).first() is not None
+
+
+def get(db, task_id: int) -> Optional[Dict[str, Any]]:
+    task = db.query(IngestTask).filter(IngestTask.id == task_id).first()
+    return task_to_dict(task) if task else None
+
+
+def stats(db) -> Dict[str, Any]:
+    """各通道排队、执行中的任务数和最长等待时间"""
+    now = datetime.now()
+    lanes = {lane: {"queued": 0, "running": 0, "weight": INGEST_LANE_WEIGHTS.get(lane, 1), "oldest_wait_seconds": 0}
+             for lane in LANES}
+    rows = db.query(IngestTask.lane, IngestTask.status, func.count(IngestTask.id), func.min(IngestTask.created_at)).filter(
+        IngestTask.status.in_(["queued", "running"])
+    ).group_by(IngestTask.lane, IngestTask.status)
+    for lane, status, count, oldest in rows:
+        if lane not in lanes:
+            continue
+        lanes[lane][status] = count
+        if status == "queued" and oldest:
+            lanes[lane]["oldest_wait_seconds"] = round((now - oldest).total_seconds(), 1)
+    workers = db.query(IngestTask.lease_owner).filter(IngestTask.status == "running").distinct().count()
+    return {"lanes": lanes, "busy_workers": workers}
+
+
+def recent(db, limit: int = 50) -> List[Dict[str, Any]]:
+    return [task_to_dict(task) for task in db.query(IngestTask).order_by(IngestTask.id.desc()).limit(limit)]
+
+
+def running_app_tasks(db, app_id: int) -> int:
+    """应用正在执行（租约未过期）的任务数"""
+    return db.query(IngestTask).filter(
+        IngestTask.app_id == app_id, IngestTask.status == "running", IngestTask.lease_expires_at >= datetime.now()
+    ).count()
+
+
+def delete_app_tasks(db, app_id: int) -> None:
+    """删除应用时清理其排队中的任务（由调用方提交事务）"""
+    db.query(IngestTask).filter(IngestTask.app_id == app_id, IngestTask.status == "queued").delete(
+        synchronize_session=False
+    )
+
+
+class IngestionWorker:
+    """从 ingest_tasks 领取并执行任务的一组工作线程"""
+
+    def __init__(self, threads: int = INGEST_WORKERS, lanes: Sequence[str] = LANES,
+                 reserved_interactive: int = INGEST_RESERVED_INTERACTIVE):
+        self.threads = max(threads, 1)
+        self.lanes = [lane for lane in LANES if lane in lanes]
+        self.weights = {lane: max(INGEST_LANE_WEIGHTS.get(lane, 1), 0.01) for lane in LANES}
+        # 只处理 interactive 时无需保留；否则至少留一个线程给后台任务
+        self.reserved_interactive = min(max(reserved_interactive, 0), self.threads - 1) \
+            if "interactive" in self.lanes else 0
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._pass: Dict[str, float] = {lane: 0.0 for lane in LANES}
+        self._running: Dict[str, str] = {}  # lease_owner -> lane
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._last_sweep = 0.0
+        self._last_cleanup = 0.0
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        logger.info(f"启动抓取工作线程: worker={self.name}, threads={self.threads}, lanes={','.join(self.lanes)}")
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._work, args=(f"{self.name}:{i + 1}",),
+                                      name=f"ingest-{i + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat, name="ingest-heartbeat", daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """停止领取新任务，等待执行中的任务完成"""
+        self._stop.set()
+        _wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(INGEST_HEARTBEAT_SECONDS):
+            with self._lock:
+                owners = list(self._running)
+            if not owners:
+                continue
+            db = SessionLocal()
+            try:
+                db.query(IngestTask).filter(
+                    IngestTask.status == "running", IngestTask.lease_owner.in_(owners)
+                ).update({"lease_expires_at": datetime.now() + timedelta(seconds=INGEST_LEASE_SECONDS)},
+                         synchronize_session=False)
+                db.commit()
+            except Exception as e:
+                logger.error(f"续约抓取任务失败: {str(e)}")
+                db.rollback()
+            finally:
+                db.close()
+
+    def _sweep(self, db) -> None:
+        """让租约过期的任务重新排队，清理过旧的已完成任务和抓取记录"""
+        if time.time() - self._last_sweep < INGEST_HEARTBEAT_SECONDS:
+            return
+        self._last_sweep = time.time()
+        now = datetime.now()
+        expired = db.query(IngestTask).filter(IngestTask.status == "running", IngestTask.lease_expires_at < now)
+        failed = expired.filter(IngestTask.attempts >= INGEST_MAX_ATTEMPTS).update(
+            {"status": "failed", "error": "工作进程多次中断，放弃执行", "finished_at": now, "lease_owner": None},
+            synchronize_session=False,
+        )
+        requeued = expired.filter(IngestTask.attempts < INGEST_MAX_ATTEMPTS).update(
+            {"status": "queued", "lease_owner": None, "lease_expires_at": None}, synchronize_session=False
+        )
+        if time.time() - self._last_cleanup >= 3600:
+            self._last_cleanup = time.time()
+            db.query(IngestTask).filter(
+                IngestTask.status.in_(["done", "failed"]),
+                IngestTask.created_at < now - timedelta(days=INGEST_TASK_RETENTION_DAYS),
+            ).delete(synchronize_session=False)
+            db.query(IngestionRun).filter(
+                IngestionRun.started_at < now - timedelta(days=INGESTION_RUN_RETENTION_DAYS)
+            ).delete(synchronize_session=False)
+        db.commit()
+        if failed or requeued:
+            logger.warning(f"租约过期的抓取任务: 重新排队 {requeued} 个，放弃 {failed} 个")
+
+    def _lane_order(self, db) -> List[str]:
+        """按调度规则排出本次尝试领取的通道顺序"""
+        with self._lock:
+            background_running = sum(1 for lane in self._running.values() if lane != "interactive")
+        allowed = [
+            lane for lane in self.lanes
+            if lane == "interactive" or background_running < self.threads - self.reserved_interactive
+        ]
+        if not allowed:
+            return []
+        heads = dict(db.query(IngestTask.lane, func.min(IngestTask.created_at)).filter(
+            IngestTask.status == "queued", IngestTask.lane.in_(allowed)
+        ).group_by(IngestTask.lane).all())
+        if not heads:
+            return []
+
+        now = datetime.now()
+        overdue = [
+            lane for oldest, lane in sorted((oldest, lane) for lane, oldest in heads.items())
+            if (now - oldest).total_seconds() >= INGEST_MAX_WAIT_SECONDS
+        ]
+        with self._lock:
+            # 空闲的通道重新有任务时，从当前最小的进度开始计，避免空闲期间积累的份额一次性用掉
+            floor = min(self._pass[lane] for lane in heads)
+            for lane in heads:
+                self._pass[lane] = max(self._pass[lane], floor)
+            by_share = sorted(heads, key=lambda lane: (self._pass[lane], LANES.index(lane)))
+        # 防饿死：等待过久的任务按排队先后优先
+        return overdue + [lane for lane in by_share if lane not in overdue]
+
+    def _claim(self, db, owner: str) -> Optional[IngestTask]:
+        self._sweep(db)
+        for lane in self._lane_order(db):
+            running = aliased(IngestTask)
+            busy = db.query(running.id).filter(
+                running.status == "running",
+                running.app_id == IngestTask.app_id,
+                running.platform == IngestTask.platform,
+            ).exists()
+            candidate = db.query(IngestTask.id).filter(
+                IngestTask.status == "queued", IngestTask.lane == lane, ~busy
+            ).order_by(IngestTask.id).first()
+            if candidate is None:
+                continue
+            now = datetime.now()
+            claimed = db.query(IngestTask).filter(
+                IngestTask.id == candidate.id, IngestTask.status == "queued"
+            ).update({
+                "status": "running",
+                "lease_owner": owner,
+                "lease_expires_at": now + timedelta(seconds=INGEST_LEASE_SECONDS),
+                "attempts": IngestTask.attempts + 1,
+                "started_at": now,
+            }, synchronize_session=False)
+            db.commit()
+            if claimed:
+                with self._lock:
+                    self._pass[lane] += 1 / self.weights[lane]
+                    self._running[owner] = lane
+                return db.query(IngestTask).filter(IngestTask.id == candidate.id).first()
+        db.commit()
+        return None
+
+    def _finish(self, task_id: int, owner: str, status: str, result: Optional[int], error: Optional[str]) -> None:
+        db = SessionLocal()
+        try:
+            updated = db.query(IngestTask).filter(
+                IngestTask.id == task_id, IngestTask.lease_owner == owner, IngestTask.status == "running"
+            ).update({
+                "status": status,
+                "result": result,
+                "error": error,
+                "finished_at": datetime.now(),
+                "lease_expires_at": None,
+            }, synchronize_session=False)
+            db.commit()
+            if not updated:
+                logger.warning(f"抓取任务 {task_id} 的租约已被其他工作线程接管，忽略本次结果")
+        finally:
+            db.close()
+
+    def _work(self, owner: str) -> None:
+        while not self._stop.is_set():
+            db = SessionLocal()
+            try:
+                task = self._claim(db, owner)
+                if task is not None:
+                    task_id, kind = task.id, task.kind
+                    args = (task.app_id, task.platform, task.fetch_limit)
+                    lane = task.lane
+            except Exception as e:
+                logger.error(f"领取抓取任务失败: {str(e)}\n{traceback.format_exc()}")
+                db.rollback()
+                task = None
+            finally:
+                db.close()
+
+            if task is None:
+                _wakeup.wait(INGEST_POLL_SECONDS)
+                _wakeup.clear()
+                continue
+
+            logger.info(f"开始执行抓取任务 {task_id} [{lane}]: {kind} app_id={args[0]} ({args[1]}), limit={args[2]}")
+            try:
+                handler = _handlers.get(kind)
+                if handler is None:
+                    raise ValueError(f"未知的任务类型: {kind}")
+                _current.task = {"id": task_id, "kind": kind, "lane": lane}
+                result = handler(*args)
+                self._finish(task_id, owner, "done", result, None)
+            except Exception as e:
+                logger.error(f"抓取任务 {task_id} 失败: {str(e)}\n{traceback.format_exc()}")
+                self._finish(task_id, owner, "failed", None, str(e))
+            finally:
+                _current.task = None
+                with self._lock:
+                    self._running.pop(owner, None)
+
+
+_embedded: Optional[IngestionWorker] = None
+
+
+def start_embedded_worker() -> IngestionWorker:
+    """在当前进程内启动工作线程（API 进程未配置独立工作进程时使用）"""
+    global _embedded
+    if _embedded is None:
+        _embedded = IngestionWorker()
+        _embedded.start()
+    return _embedded
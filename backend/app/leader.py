@@ -0,0 +1,126 @@
+"""
+调度器领导权选举
+
+多进程部署（gunicorn 多个 worker、多台机器）时每个进程都会加载应用，但定时调度器只能在一个进程中运行，
+否则每次轮询、归档、备份都会重复执行。各进程每 LEADER_RENEW_SECONDS 秒尝试在 scheduler_leases
+表中获取或续约租约，持有未过期租约的进程就是领导者，负责运行调度器。领导者进程退出时主动释放租约；
+崩溃时租约在 LEADER_LEASE_SECONDS 秒后过期，由其他进程接管。
+
+租约时间由各进程按本机时钟写入，机器之间的时钟偏差应明显小于 LEADER_LEASE_SECONDS。
+"""
+import os
+import socket
+import threading
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from .config import LEADER_LEASE_SECONDS, LEADER_RENEW_SECONDS
+from .database import SessionLocal
+from .logger import setup_logger
+from .models import SchedulerLease
+
+logger = setup_logger("leader")
+
+
+class LeaderElection:
+    """基于数据库租约的领导者选举，领导权变化时调用回调"""
+
+    def __init__(self, name: str, on_elected: Callable[[], None], on_demoted: Callable[[], None]):
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.is_leader = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _try_acquire(self) -> bool:
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=LEADER_LEASE_SECONDS)
+        db = SessionLocal()
+        try:
+            values = {"owner": self.owner, "expires_at": expires_at}
+            if not self.is_leader:
+                values["acquired_at"] = now
+            updated = db.query(SchedulerLease).filter(
+                SchedulerLease.name == self.name,
+                or_(SchedulerLease.owner == self.owner, SchedulerLease.expires_at < now),
+            ).update(values, synchronize_session=False)
+            if not updated:
+                if db.query(SchedulerLease.name).filter(SchedulerLease.name == self.name).first():
+                    db.rollback()
+                    return False
+                db.add(SchedulerLease(name=self.name, owner=self.owner, acquired_at=now, expires_at=expires_at))
+            db.commit()
+            return True
+        except IntegrityError:
+            # 其他进程同时插入了租约
+            db.rollback()
+            return False
+        finally:
+            db.close()
+
+    def _step(self) -> None:
+        try:
+            leader = self._try_acquire()
+        except Exception as e:
+            logger.error(f"竞选调度器领导权失败: {str(e)}")
+            leader = False
+        if leader and not self.is_leader:
+            logger.info(f"成为调度器领导者: {self.owner}")
+            self.is_leader = True
+            self._call(self.on_elected)
+        elif not leader and self.is_leader:
+            logger.warning(f"失去调度器领导权: {self.owner}")
+            self.is_leader = False
+            self._call(self.on_demoted)
+
+    def _call(self, callback: Callable[[], None]) -> None:
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"执行领导权回调失败: {str(e)}\n{traceback.format_exc()}")
+
+    def _run(self) -> None:
+        self._step()
+        while not self._stop.wait(LEADER_RENEW_SECONDS):
+            self._step()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"leader-{self.name}", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """停止竞选；是领导者时先执行 on_demoted 再释放租约，其他进程可以立即接管"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(LEADER_RENEW_SECONDS)
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        self._call(self.on_demoted)
+        db = SessionLocal()
+        try:
+            db.query(SchedulerLease).filter(
+                SchedulerLease.name == self.name, SchedulerLease.owner == self.owner
+            ).update({"expires_at": datetime.now()}, synchronize_session=False)
+            db.commit()
+            logger.info(f"已释放调度器领导权: {self.owner}")
+        except Exception as e:
+            logger.error(f"释放调度器领导权失败: {str(e)}")
+            db.rollback()
+        finally:
+            db.close()
+
+
+def current_leader(db, name: str = "scheduler") -> Optional[SchedulerLease]:
+    """当前持有未过期租约的领导者"""
+    return db.query(SchedulerLease).filter(
+        SchedulerLease.name == name, SchedulerLease.expires_at >= datetime.now()
+    ).first()
@@ -1,19 +1,21 @@
 from fastapi import FastAPI, Depends, HTTPException, Header, Response
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 from . import models, database
 from .scrapers import app_store, play_store
 from fastapi.middleware.cors import CORSMiddleware
-from .exceptions import AppStoreError, DatabaseError, ReviewFetchError
+from .exceptions import AppStoreError, DatabaseError, InvalidCountryError, ReviewFetchError
 from .logger import setup_logger
 from typing import Dict, Any, List, Optional
 import traceback
-from .config import AUTH_CODE
+from .config import AUTH_CODE, INGEST_EMBEDDED_WORKER
 import csv
 import io
 from datetime import datetime
 import urllib.parse
 from pydantic import BaseModel
-from .scheduler import update_reviews, update_latest_reviews
+from .scheduler import election, enqueue_refresh, list_jobs, shutdown_scheduler
+from .pagination import clamp_limit, encode_cursor, decode_cursor, page_response
+from . import search, purge, archive, polling, ingestion, leader, backfill, runs, ratelimit, circuit, countries
 import os
 
 # 设置日志
@@ -35,6 +37,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def start_background_jobs():
+    """
+    参与调度器领导权竞选（成为领导者后启动定时任务并恢复未完成的清理），
+    未使用独立工作进程时在本进程内执行抓取任务
+    """
+    election.start()
+    if INGEST_EMBEDDED_WORKER:
+        ingestion.start_embedded_worker()
+
+@app.on_event("shutdown")
+def stop_background_jobs():
+    """释放调度器领导权，其他进程可以立即接管"""
+    election.stop()
+    shutdown_scheduler()
+
 # 错误处理中间件
 @app.middleware("http")
 async def error_handling(request, call_next):
@@ -50,6 +68,29 @@ async def verify_auth_code(auth_code: str = Header(..., alias="X-Auth-Code")):
         raise HTTPException(status_code=401, detail="授权码无效")
     return auth_code
 
+COUNTRY_FIELDS = (
+    ("app_store_country", "app_store_countries"),
+    ("play_store_country", "play_store_countries"),
+)
+
+def _normalize_countries(app_data: Dict[str, Any]) -> None:
+    """
+    校验应用的国家/地区：*_countries 可以是列表或逗号分隔的字符串，保存为逗号分隔；
+    未单独指定主要国家时以列表中的第一个为主要国家
+    """
+    for field, list_field in COUNTRY_FIELDS:
+        if app_data.get(list_field) is not None:
+            codes = countries.normalize(app_data[list_field])
+            app_data[list_field] = ",".join(codes)
+            app_data.setdefault(field, codes[0])
+        if app_data.get(field) is not None:
+            app_data[field] = countries.normalize([app_data[field]])[0]
+
+@app.get("/countries")
+def get_countries():
+    """支持的国家/地区"""
+    return countries.supported()
+
 @app.post("/apps")
 def create_app(
     app_data: Dict[str, Any],
@@ -58,12 +99,15 @@ def create_app(
 ):
     try:
         logger.info(f"创建新应用: {app_data}")
+        _normalize_countries(app_data)
         new_app = models.App(**app_data)
         db.add(new_app)
         db.commit()
         db.refresh(new_app)
         logger.info(f"应用创建成功: {new_app.id}")
         return new_app
+    except InvalidCountryError as e:
+        raise e
     except Exception as e:
         logger.error(f"创建应用失败: {str(e)}\n{traceback.format_exc()}")
         db.rollback()
@@ -73,28 +117,266 @@ def create_app(
 def get_apps(db: Session = Depends(database.get_db)):
     try:
         logger.info("获取应用列表")
-        apps = db.query(models.App).all()
+        apps = db.query(models.App).filter(models.App.deleted_at.is_(None)).all()
         return apps
     except Exception as e:
         logger.error(f"获取应用列表失败: {str(e)}\n{traceback.format_exc()}")
         raise DatabaseError(f"获取应用列表失败: {str(e)}")
 
 @app.get("/apps/{app_id}/reviews")
-def get_app_reviews(app_id: int, db: Session = Depends(database.get_db)):
+def get_app_reviews(
+    app_id: int,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    country: Optional[str] = None,
+    db: Session = Depends(database.get_db)
+):
+    """
+    获取应用评论，按发布时间倒序
+    :param limit: 每页条数，不指定时返回全部评论
+    :param cursor: 上一页返回的 next_cursor
+    :param country: 只返回该国家/地区的评论
+    """
     try:
-        logger.info(f"获取应用评论: app_id={app_id}")
-        app = db.query(models.App).filter(models.App.id == app_id).first()
+        logger.info(f"获取应用评论: app_id={app_id}, limit={limit}, cursor={cursor}")
+        app = db.query(models.App).filter(models.App.id == app_id, models.App.deleted_at.is_(None)).first()
         if not app:
             raise HTTPException(status_code=404, detail="应用不存在")
-            
-        reviews = db.query(models.Review).filter(models.Review.app_id == app_id).order_by(models.Review.created_at.desc()).all()
-        return reviews
+
+        query = db.query(models.Review).options(selectinload(models.Review.body)).filter(models.Review.app_id == app_id)
+        if country:
+            query = query.filter(models.Review.country == country.lower())
+        order = (models.Review.created_at.desc(), models.Review.id.desc())
+        if limit is None and cursor is None:
+            return [review.to_dict() for review in query.order_by(*order)]
+
+        limit = clamp_limit(limit)
+        if cursor:
+            created_at, last_id = decode_cursor(cursor, 2)
+            created_at = datetime.fromisoformat(created_at)
+            query = query.filter(
+                (models.Review.created_at < created_at) |
+                ((models.Review.created_at == created_at) & (models.Review.id < last_id))
+            )
+        reviews = [review.to_dict() for review in query.order_by(*order).limit(limit + 1)]
+        return page_response(
+            reviews, limit,
+            lambda review: encode_cursor(review["created_at"].isoformat(), review["id"])
+        )
     except HTTPException as e:
         raise e
     except Exception as e:
         logger.error(f"获取应用评论失败: {str(e)}\n{traceback.format_exc()}")
         raise DatabaseError(f"获取应用评论失败: {str(e)}")
 
+@app.get("/apps/{app_id}/reviews/search")
+def search_app_reviews(
+    app_id: int,
+    q: str,
+    platform: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    db: Session = Depends(database.get_db)
+):
+    """
+    全文检索应用评论，按相关度排序，命中的关键词以 <mark> 标签高亮
+    :param q: 关键词，多个关键词以空格分隔（AND 关系）
+    :param platform: 平台（ios/android），不指定则检索所有平台
+    :param cursor: 上一页返回的 next_cursor
+    """
+    try:
+        logger.info(f"检索应用评论: app_id={app_id}, q={q}, platform={platform}, cursor={cursor}")
+        app = db.query(models.App).filter(models.App.id == app_id, models.App.deleted_at.is_(None)).first()
+        if not app:
+            raise HTTPException(status_code=404, detail="应用不存在")
+
+        limit = clamp_limit(limit)
+        after_score = after_id = None
+        if cursor:
+            after_score, after_id = decode_cursor(cursor, 2)
+
+        hits = search.search_reviews(
+            db.connection(), app_id, q, limit + 1,
+            after_score=after_score, after_id=after_id, platform=platform
+        )
+        reviews = {
+            review.id: review
+            for review in db.query(models.Review).options(selectinload(models.Review.body)).filter(
+                models.Review.id.in_([hit["id"] for hit in hits])
+            )
+        }
+        items = []
+        for hit in hits:
+            review = reviews.get(hit["id"])
+            if review is None:
+                continue
+            item = review.to_dict()
+            item["score"] = hit["score"]
+            item["highlight"] = search.highlight(review.content, q)
+            items.append(item)
+        return page_response(items, limit, lambda item: encode_cursor(item["score"], item["id"]))
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"检索应用评论失败: {str(e)}\n{traceback.format_exc()}")
+        raise DatabaseError(f"检索应用评论失败: {str(e)}")
+
+@app.get("/apps/{app_id}/stats/monthly")
+def get_monthly_stats(app_id: int, country: Optional[str] = None, db: Session = Depends(database.get_db)):
+    """
+    按月、平台统计评论数和平均评分（包含已归档的月份）
+    :param country: 只统计该国家/地区（不包含已归档的月份）
+    """
+    try:
+        app = db.query(models.App).filter(models.App.id == app_id, models.App.deleted_at.is_(None)).first()
+        if not app:
+            raise HTTPException(status_code=404, detail="应用不存在")
+        return archive.monthly_stats(db, app_id, country.lower() if country else None)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"获取月度统计失败: {str(e)}\n{traceback.format_exc()}")
+        raise DatabaseError(f"获取月度统计失败: {str(e)}")
+
+@app.get("/scheduler/plan")
+def get_schedule_plan(hours: int = 24, db: Session = Depends(database.get_db)):
+    """查看未来 hours 小时内的抓取计划、各商店正在进行的抓取数和剩余请求预算"""
+    try:
+        hours = min(max(hours, 1), 24 * 7)
+        runs = polling.upcoming_plan(db, hours)
+        return {
+            "hours": hours,
+            "runs": runs,
+            "estimated_requests": sum(run["estimated_requests"] for run in runs),
+            "in_flight": polling.in_flight(db),
+            "budget_remaining": polling.budget.remaining(),
+        }
+    except Exception as e:
+        logger.error(f"获取抓取计划失败: {str(e)}\n{traceback.format_exc()}")
+        raise DatabaseError(f"获取抓取计划失败: {str(e)}")
+
+@app.get("/scheduler/leader")
+def get_scheduler_leader(db: Session = Depends(database.get_db)):
+    """查看当前运行调度器的进程"""
+    lease = leader.current_leader(db)
+    return {
+        "leader": lease.owner if lease else None,
+        "acquired_at": lease.acquired_at if lease else None,
+        "expires_at": lease.expires_at if lease else None,
+        "this_process": election.owner,
+        "is_leader": election.is_leader,
+    }
+
+@app.get("/scheduler/jobs")
+def get_scheduler_jobs():
+    """查看调度器中的周期任务及其下次、最近一次执行时间"""
+    return list_jobs()
+
+@app.get("/ingestion/queue")
+def get_ingestion_queue(limit: int = 50, db: Session = Depends(database.get_db)):
+    """查看抓取队列各通道的排队、执行情况和最近的任务"""
+    return {**ingestion.stats(db), "tasks": ingestion.recent(db, clamp_limit(limit))}
+
+@app.get("/ingestion/tasks/{task_id}")
+def get_ingestion_task(task_id: int, db: Session = Depends(database.get_db)):
+    """查询抓取任务的状态"""
+    task = ingestion.get(db, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return task
+
+@app.get("/ingestion/rate-limits")
+def get_rate_limits():
+    """各商店限速器当前的速率（每秒请求数）、剩余令牌、暂停时间和累计请求/限流次数（当前进程）"""
+    return ratelimit.stats()
+
+@app.get("/ingestion/circuits")
+def get_circuits(include_closed: bool = False, db: Session = Depends(database.get_db)):
+    """查看熔断中的商店和应用（include_closed=true 时包含正常的）及失败计数"""
+    return circuit.list_breakers(db, include_closed)
+
+@app.post("/apps/{app_id}/circuit/reset")
+def reset_app_circuit(
+    app_id: int,
+    platform: Optional[str] = None,
+    db: Session = Depends(database.get_db),
+    auth_code: str = Depends(verify_auth_code)
+):
+    """重置应用的熔断状态，停止抓取的应用恢复轮询"""
+    app = db.query(models.App).filter(models.App.id == app_id, models.App.deleted_at.is_(None)).first()
+    if not app:
+        raise HTTPException(status_code=404, detail="应用不存在")
+    count = circuit.reset(db, app_id, platform)
+    db.commit()
+    return {"reset": count}
+
+@app.get("/ingestion/runs")
+def get_ingestion_runs(
+    app_id: Optional[int] = None,
+    platform: Optional[str] = None,
+    kind: Optional[str] = None,
+    status: Optional[str] = None,
+    slow: Optional[bool] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    db: Session = Depends(database.get_db)
+):
+    """
+    抓取记录，按开始时间倒序
+    :param slow: 只看（或排除）慢抓取
+    :param cursor: 上一页返回的 next_cursor
+    """
+    try:
+        limit = clamp_limit(limit)
+        query = runs.query_runs(db, app_id, platform, kind, status, slow)
+        if cursor:
+            (last_id,) = decode_cursor(cursor, 1)
+            query = query.filter(models.IngestionRun.id < last_id)
+        items = [runs.run_to_dict(run) for run in query.order_by(models.IngestionRun.id.desc()).limit(limit + 1)]
+        return page_response(items, limit, lambda item: encode_cursor(item["id"]))
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"获取抓取记录失败: {str(e)}\n{traceback.format_exc()}")
+        raise DatabaseError(f"获取抓取记录失败: {str(e)}")
+
+@app.get("/ingestion/runs/summary")
+def get_ingestion_runs_summary(hours: int = 24, db: Session = Depends(database.get_db)):
+    """最近 hours 小时各应用平台的抓取耗时汇总，按总耗时从高到低排列，用于找出占用抓取时间最多的应用"""
+    try:
+        return runs.summary(db, max(hours, 1))
+    except Exception as e:
+        logger.error(f"获取抓取耗时汇总失败: {str(e)}\n{traceback.format_exc()}")
+        raise DatabaseError(f"获取抓取耗时汇总失败: {str(e)}")
+
+@app.get("/apps/{app_id}/schedule")
+def get_app_schedule(app_id: int, db: Session = Depends(database.get_db)):
+    """查看应用各平台最近一次抓取和下次抓取的时间"""
+    try:
+        app = db.query(models.App).filter(models.App.id == app_id, models.App.deleted_at.is_(None)).first()
+        if not app:
+            raise HTTPException(status_code=404, detail="应用不存在")
+        result = []
+        for platform in polling.app_platforms(app):
+            state = polling.get_state(db, app.id, platform)
+            result.append({
+                "platform": platform,
+                "last_run_at": state.last_run_at,
+                "last_new_count": state.last_new_count,
+                "next_run_at": state.next_run_at,
+                "interval_minutes": state.interval_minutes,
+                "fetch_limit": state.fetch_limit,
+                "review_rate": round(state.review_rate or 0, 3),
+            })
+        db.commit()
+        return result
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"获取应用抓取计划失败: {str(e)}\n{traceback.format_exc()}")
+        db.rollback()
+        raise DatabaseError(f"获取应用抓取计划失败: {str(e)}")
+
 @app.get("/health")
 def health_check():
     """健康检查接口"""
@@ -116,8 +398,9 @@ async def refresh_app_reviews(
     :param platform: 平台（ios/android），不指定则刷新所有平台
     """
     await verify_auth_code(auth_code)
-    update_reviews(app_id=app_id, platform=refresh_data.platform)
-    return {"message": "更新任务已开始"}
+    # 指定条数时按手动刷新优先执行，不限条数的全量抓取放入 backfill 通道
+    tasks = enqueue_refresh(app_id, platform=refresh_data.platform, limit=refresh_data.limit)
+    return {"message": "更新任务已加入队列", "task_ids": [task["id"] for task in tasks]}
 
 @app.post("/apps/{app_id}/refresh/latest")
 async def refresh_latest_reviews(
@@ -132,8 +415,34 @@ async def refresh_latest_reviews(
     """
     await verify_auth_code(auth_code)
     limit = refresh_data.limit or 100
-    update_latest_reviews(app_id=app_id, limit=limit)
-    return {"message": "最新评论更新任务已开始"}
+    tasks = enqueue_refresh(app_id, platform=refresh_data.platform, limit=limit)
+    return {"message": "最新评论更新任务已加入队列", "task_ids": [task["id"] for task in tasks]}
+
+class BackfillRequest(BaseModel):
+    platform: Optional[str] = None
+    restart: bool = False
+
+@app.post("/apps/{app_id}/backfill")
+def start_app_backfill(
+    app_id: int,
+    backfill_data: BackfillRequest,
+    db: Session = Depends(database.get_db),
+    auth_code: str = Depends(verify_auth_code)
+):
+    """
+    全量抓取应用的历史评论，中断后从上次的位置继续
+    :param restart: 为 true 时从最新的评论重新开始
+    """
+    app = db.query(models.App).filter(models.App.id == app_id, models.App.deleted_at.is_(None)).first()
+    if not app:
+        raise HTTPException(status_code=404, detail="应用不存在")
+    tasks = backfill.start_backfill(app_id, platform=backfill_data.platform, restart=backfill_data.restart)
+    return {"message": "全量抓取任务已加入队列", "task_ids": [task["id"] for task in tasks]}
+
+@app.get("/apps/{app_id}/backfill")
+def get_app_backfill(app_id: int, db: Session = Depends(database.get_db)):
+    """查询全量抓取的进度"""
+    return backfill.backfill_status(db, app_id)
 
 @app.put("/apps/{app_id}")
 def update_app(
@@ -144,12 +453,17 @@ def update_app(
 ):
     try:
         logger.info(f"更新应用: app_id={app_id}, data={app_data}")
-        app = db.query(models.App).filter(models.App.id == app_id).first()
+        app = db.query(models.App).filter(models.App.id == app_id, models.App.deleted_at.is_(None)).first()
         if not app:
             raise HTTPException(status_code=404, detail="应用不存在")
         
+        _normalize_countries(app_data)
         for key, value in app_data.items():
             setattr(app, key, value)
+        if {"app_store_id", "app_store_country", "app_store_countries",
+                "play_store_id", "play_store_country", "play_store_countries"} & set(app_data):
+            # 修改了商店 ID 或地区，之前的失败不再适用
+            circuit.reset(db, app_id)
         
         db.commit()
         db.refresh(app)
@@ -170,18 +484,17 @@ def delete_app(
 ):
     try:
         logger.info(f"删除应用: app_id={app_id}")
-        app = db.query(models.App).filter(models.App.id == app_id).first()
+        app = db.query(models.App).filter(models.App.id == app_id, models.App.deleted_at.is_(None)).first()
         if not app:
             raise HTTPException(status_code=404, detail="应用不存在")
         
-        # 删除关联的评论
-        db.query(models.Review).filter(models.Review.app_id == app_id).delete()
-        # 删除应用
-        db.delete(app)
+        # 先标记删除，评论和索引由后台任务分批清理
+        job = purge.create_purge_job(db, app)
         db.commit()
-        
-        logger.info(f"应用删除成功: {app_id}")
-        return {"message": "应用删除成功"}
+        purge.schedule_purge(job.id)
+
+        logger.info(f"应用已标记删除: app_id={app_id}, job_id={job.id}, reviews={job.total}")
+        return {"message": "应用删除成功", "job_id": job.id}
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -189,25 +502,62 @@ def delete_app(
         db.rollback()
         raise DatabaseError(f"删除应用失败: {str(e)}")
 
+@app.get("/apps/{app_id}/purge")
+def get_purge_progress(app_id: int, db: Session = Depends(database.get_db)):
+    """查询应用删除后的清理进度"""
+    job = purge.latest_purge_job(db, app_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="清理任务不存在")
+    return {
+        "job_id": job.id,
+        "app_id": job.app_id,
+        "status": job.status,
+        "total": job.total,
+        "deleted": job.deleted,
+        "progress": round(job.deleted / job.total, 4) if job.total else 1.0,
+        "error": job.error,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+        "finished_at": job.finished_at,
+    }
+
 @app.get("/apps/{app_id}/export")
-def export_app_reviews(app_id: int, db: Session = Depends(database.get_db)):
-    """导出应用评论为CSV格式"""
+def export_app_reviews(
+    app_id: int,
+    include_archived: bool = False,
+    db: Session = Depends(database.get_db)
+):
+    """
+    导出应用评论为CSV格式
+    :param include_archived: 是否同时导出已归档的历史评论
+    """
     try:
-        logger.info(f"导出应用评论: app_id={app_id}")
-        app = db.query(models.App).filter(models.App.id == app_id).first()
+        logger.info(f"导出应用评论: app_id={app_id}, include_archived={include_archived}")
+        app = db.query(models.App).filter(models.App.id == app_id, models.App.deleted_at.is_(None)).first()
         if not app:
             raise HTTPException(status_code=404, detail="应用不存在")
             
-        reviews = db.query(models.Review).filter(models.Review.app_id == app_id).all()
+        reviews = db.query(models.Review).options(selectinload(models.Review.body)).filter(models.Review.app_id == app_id).all()
         
         # 创建CSV文件
         output = io.StringIO()
         writer = csv.writer(output)
         
         # 写入表头
-        writer.writerow(['ID', '平台', '评分', '评论内容', '作者', '发布时间'])
+        writer.writerow(['ID', '平台', '评分', '评论内容', '作者', '发布时间', '国家/地区'])
         
-        # 写入数据
+        # 写入数据（已归档的评论在前）
+        if include_archived:
+            for review in archive.iter_archived_reviews(app_id):
+                writer.writerow([
+                    review['id'],
+                    '苹果应用商店' if review['platform'] == 'ios' else '谷歌应用商店',
+                    review['rating'],
+                    review['content'],
+                    review['author'],
+                    review['created_at'].strftime('%Y-%m-%d %H:%M:%S'),
+                    review.get('country') or ''
+                ])
         for review in reviews:
             writer.writerow([
                 review.id,
@@ -215,7 +565,8 @@ def export_app_reviews(app_id: int, db: Session = Depends(database.get_db)):
                 review.rating,
                 review.content,
                 review.author,
-                review.created_at.strftime('%Y-%m-%d %H:%M:%S')
+                review.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+                review.country or ''
             ])
         
         # 设置响应
@@ -1,5 +1,8 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Enum, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, Enum, ForeignKey, Index, UniqueConstraint, LargeBinary, Boolean
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+from typing import List
+from . import compression
 
 Base = declarative_base()
 
@@ -13,6 +16,20 @@ class App(Base):
     play_store_id = Column(String, nullable=True)
     app_store_country = Column(String, default="cn")  # 新增字段，默认为中国
     play_store_country = Column(String, default="cn")  # 新增字段，默认为中国
+    # 同时抓取的其他国家/地区（逗号分隔），为空时只抓取上面的主要国家
+    app_store_countries = Column(String, nullable=True)
+    play_store_countries = Column(String, nullable=True)
+    deleted_at = Column(DateTime, nullable=True)  # 标记删除时间，后台清理完成后才真正删除
+    retention_months = Column(Integer, nullable=True)  # 评论保留月数，超出部分归档，为空时使用全局配置
+
+    def countries(self, platform: str) -> List[str]:
+        """该平台抓取的国家/地区，第一个为主要国家"""
+        if platform == "ios":
+            primary, others = self.app_store_country, self.app_store_countries
+        else:
+            primary, others = self.play_store_country, self.play_store_countries
+        primary = primary or "cn"
+        return [primary] + [code for code in (others or "").split(",") if code and code != primary]
     
 class Review(Base):
     __tablename__ = "reviews"
@@ -21,6 +38,258 @@ class Review(Base):
     app_id = Column(Integer, ForeignKey("apps.id"))
     platform = Column(Enum('ios', 'android'), nullable=False)
     rating = Column(Float, nullable=False)
-    content = Column(String)
     author = Column(String) # 用户名
-    created_at = Column(DateTime(timezone=True), nullable=False) 
\ No newline at end of file
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    country = Column(String, nullable=True)  # 抓取时的国家/地区
+    # 评论正文单独存放在 review_contents 表，通过 content 属性透明地压缩/解压
+    body = relationship("ReviewContent", uselist=False, lazy="select", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        # 按应用倒序分页（created_at, id 为分页键）
+        Index("ix_reviews_app_created", "app_id", "created_at", "id"),
+        # 按国家筛选的分页和统计
+        Index("ix_reviews_app_country_created", "app_id", "country", "created_at", "id"),
+    )
+
+    @property
+    def content(self):
+        if not hasattr(self, "_content_cache"):
+            body = self.body
+            self._content_cache = compression.decode(body.codec, body.dict_id, body.data) if body else None
+        return self._content_cache
+
+    @content.setter
+    def content(self, value):
+        self._content_cache = value
+        if value is None:
+            self.body = None
+        else:
+            codec, dict_id, data = compression.encode(value)
+            self.body = ReviewContent(codec=codec, dict_id=dict_id, data=data)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "app_id": self.app_id,
+            "platform": self.platform,
+            "rating": self.rating,
+            "content": self.content,
+            "author": self.author,
+            "created_at": self.created_at,
+            "country": self.country,
+        }
+
+class ReviewContent(Base):
+    """评论正文（可压缩）"""
+    __tablename__ = "review_contents"
+
+    review_id = Column(Integer, ForeignKey("reviews.id"), primary_key=True)
+    codec = Column(String, nullable=False, default="plain")  # plain, zlib, zstd
+    dict_id = Column(Integer, nullable=True)  # 压缩字典 compression_dicts.id
+    data = Column(LargeBinary, nullable=False)
+
+class CompressionDict(Base):
+    """按语言训练的评论正文压缩字典"""
+    __tablename__ = "compression_dicts"
+
+    id = Column(Integer, primary_key=True)
+    language = Column(String, nullable=False)
+    codec = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    sample_count = Column(Integer, default=0)
+    created_at = Column(DateTime, nullable=True)
+
+class AppSyncState(Base):
+    """每个应用、每个平台的抓取状态与自适应轮询参数"""
+    __tablename__ = "app_sync_states"
+
+    id = Column(Integer, primary_key=True)
+    app_id = Column(Integer, nullable=False)
+    platform = Column(String, nullable=False)  # ios, android
+    review_rate = Column(Float, default=0)  # 每小时新增评论数的 EWMA
+    interval_minutes = Column(Integer, nullable=False)  # 当前轮询间隔
+    fetch_limit = Column(Integer, nullable=False)  # 当前每次抓取条数
+    last_new_count = Column(Integer, nullable=True)  # 上次抓取的新增条数
+    last_run_at = Column(DateTime, nullable=True)
+    next_run_at = Column(DateTime, nullable=True, index=True)
+    resume_cursor = Column(String, nullable=True)  # 上次抓取到截止时间中断的位置（JSON），下次轮询从这里继续
+    resume_limit = Column(Integer, nullable=True)  # 中断时还剩的条数
+
+    __table_args__ = (
+        UniqueConstraint("app_id", "platform", name="uq_sync_state_app_platform"),
+    )
+
+class PurgeJob(Base):
+    """应用删除后的后台分批清理任务"""
+    __tablename__ = "app_purge_jobs"
+
+    id = Column(Integer, primary_key=True)
+    app_id = Column(Integer, index=True, nullable=False)
+    status = Column(String, default="pending")  # pending, running, done, failed
+    total = Column(Integer, default=0)  # 待清理评论总数
+    deleted = Column(Integer, default=0)  # 已清理评论数
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+class ReviewRollup(Base):
+    """按月汇总的评论统计，归档后的月份仍由它提供统计数据"""
+    __tablename__ = "review_monthly_rollups"
+
+    id = Column(Integer, primary_key=True)
+    app_id = Column(Integer, nullable=False)
+    platform = Column(String, nullable=False)
+    month = Column(String(7), nullable=False)  # YYYY-MM
+    review_count = Column(Integer, default=0)
+    rating_sum = Column(Float, default=0)
+    star_1 = Column(Integer, default=0)
+    star_2 = Column(Integer, default=0)
+    star_3 = Column(Integer, default=0)
+    star_4 = Column(Integer, default=0)
+    star_5 = Column(Integer, default=0)
+
+    __table_args__ = (
+        UniqueConstraint("app_id", "platform", "month", name="uq_rollup_app_platform_month"),
+    )
+
+class ArchivedReviewKey(Base):
+    """已归档评论的去重字段（平台、作者、时间）：再次抓到已归档的评论时跳过，月度汇总中每条评论只计入一次"""
+    __tablename__ = "archived_review_keys"
+
+    id = Column(Integer, primary_key=True)
+    app_id = Column(Integer, nullable=False)
+    platform = Column(String, nullable=False)
+    author = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_archived_keys_app_created", "app_id", "created_at"),
+    )
+
+class IngestTask(Base):
+    """抓取任务队列，工作进程通过租约领取任务"""
+    __tablename__ = "ingest_tasks"
+
+    id = Column(Integer, primary_key=True)
+    lane = Column(String, nullable=False)  # interactive, scheduled, backfill
+    kind = Column(String, nullable=False)  # 任务类型，对应 ingestion 中注册的处理函数
+    app_id = Column(Integer, nullable=False)
+    platform = Column(String, nullable=False)  # ios, android
+    fetch_limit = Column(Integer, nullable=True)  # 为空表示不限条数
+    status = Column(String, nullable=False, default="queued")  # queued, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    result = Column(Integer, nullable=True)  # 新增评论数
+    error = Column(String, nullable=True)
+    lease_owner = Column(String, nullable=True)  # 持有租约的工作线程
+    lease_expires_at = Column(DateTime, nullable=True)  # 超过该时间未续约，任务可被重新领取
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_ingest_tasks_status_lane", "status", "lane", "id"),
+        Index("ix_ingest_tasks_app_platform", "app_id", "platform", "status"),
+    )
+
+class SchedulerLease(Base):
+    """多进程部署时的调度器领导权租约"""
+    __tablename__ = "scheduler_leases"
+
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)  # 主机名:进程号:随机串
+    acquired_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)  # 超过该时间未续约，其他进程可以接管
+
+class StoreSlot(Base):
+    """商店并发名额（STORE_MAX_IN_FLIGHT）的租约，所有进程共享"""
+    __tablename__ = "store_slots"
+
+    id = Column(Integer, primary_key=True)
+    platform = Column(String, nullable=False)  # ios, android
+    slot = Column(Integer, nullable=False)  # 名额编号，0 到 STORE_MAX_IN_FLIGHT - 1
+    owner = Column(String, nullable=True)  # 占用者（主机名:进程号:随机串），空闲时为空
+    expires_at = Column(DateTime, nullable=True)  # 超过该时间未续约，其他抓取可以占用
+
+    __table_args__ = (
+        UniqueConstraint("platform", "slot", name="uq_store_slot"),
+    )
+
+class RequestBudgetSpend(Base):
+    """轮询请求预算（POLL_REQUEST_BUDGET_PER_HOUR）的记账，所有进程共享，只保留最近一小时"""
+    __tablename__ = "request_budget_spends"
+
+    id = Column(Integer, primary_key=True)
+    spent_at = Column(DateTime, nullable=False, index=True)
+    cost = Column(Integer, nullable=False)
+
+class BackfillCheckpoint(Base):
+    """历史评论全量抓取的进度，中断后从 cursor 继续"""
+    __tablename__ = "backfill_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    app_id = Column(Integer, nullable=False)
+    platform = Column(String, nullable=False)  # ios, android
+    status = Column(String, nullable=False, default="pending")  # pending, running, done, failed
+    cursor = Column(String, nullable=True)  # 下一页的位置（JSON）：App Store 为 offset，Play 为 continuation token
+    pages = Column(Integer, nullable=False, default=0)
+    fetched = Column(Integer, nullable=False, default=0)
+    new_count = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("app_id", "platform", name="uq_backfill_app_platform"),
+    )
+
+class IngestionRun(Base):
+    """每次抓取的耗时与结果"""
+    __tablename__ = "ingestion_runs"
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, nullable=True)  # 对应的 ingest_tasks，直接调用时为空
+    kind = Column(String, nullable=False)  # refresh, poll, backfill
+    lane = Column(String, nullable=True)
+    app_id = Column(Integer, nullable=False)
+    platform = Column(String, nullable=False)
+    fetch_limit = Column(Integer, nullable=True)
+    status = Column(String, nullable=False)  # done, partial（到截止时间或中途失败，只保存了部分）, failed
+    error = Column(String, nullable=True)
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+    duration_ms = Column(Integer, nullable=True)
+    fetch_ms = Column(Integer, default=0)  # 请求商店
+    parse_ms = Column(Integer, default=0)  # 转换为评论字段
+    write_ms = Column(Integer, default=0)  # 写入数据库
+    pages = Column(Integer, default=0)  # 请求数
+    fetched = Column(Integer, default=0)
+    new_count = Column(Integer, default=0)
+    duplicates = Column(Integer, default=0)
+    write_errors = Column(Integer, default=0)
+    slow = Column(Boolean, default=False)  # 明显慢于该应用平台近期的正常耗时
+    partitions = Column(String, nullable=True)  # 分区抓取时各分区的进度（JSON）
+    raw_archive = Column(String, nullable=True)  # 原始响应存档的编号（开启 RAW_ARCHIVE_ENABLED 时）
+
+    __table_args__ = (
+        Index("ix_ingestion_runs_app_started", "app_id", "platform", "started_at"),
+        Index("ix_ingestion_runs_started", "started_at"),
+    )
+
+class CircuitBreaker(Base):
+    """商店和应用的熔断状态与失败计数"""
+    __tablename__ = "circuit_breakers"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String, nullable=False, unique=True)  # 商店为 "store:ios"，应用为 "app:<app_id>:<platform>"
+    scope = Column(String, nullable=False)  # store, app
+    app_id = Column(Integer, nullable=True, index=True)
+    platform = Column(String, nullable=False)
+    state = Column(String, nullable=False, default="closed")  # closed, open, half_open（到期后试探中）, disabled（停止抓取直到修改或重置）
+    consecutive_failures = Column(Integer, default=0)
+    total_failures = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+    last_failure_at = Column(DateTime, nullable=True)
+    last_success_at = Column(DateTime, nullable=True)
+    open_until = Column(DateTime, nullable=True)  # 熔断到期时间，半开时为试探的超时时间
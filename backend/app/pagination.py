@@ -0,0 +1,45 @@
+import base64
+import json
+from typing import Any, List, Optional
+
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def clamp_limit(limit: Optional[int]) -> int:
+    """限制每页条数在 [1, MAX_PAGE_SIZE] 之间"""
+    if not limit or limit < 1:
+        return DEFAULT_PAGE_SIZE
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def encode_cursor(*values: Any) -> str:
+    """将排序键编码为不透明的游标字符串"""
+    raw = json.dumps(list(values), ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    """解码游标，格式不正确时返回 400"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+    return values
+
+
+def page_response(items: list, limit: int, cursor_of) -> dict:
+    """
+    构造分页响应
+    :param items: 多取一条（limit + 1）的查询结果
+    :param limit: 每页条数
+    :param cursor_of: 由最后一条记录生成游标的函数
+    """
+    has_more = len(items) > limit
+    items = items[:limit]
+    next_cursor = cursor_of(items[-1]) if has_more and items else None
+    return {"items": items, "next_cursor": next_cursor}
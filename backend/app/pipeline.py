@@ -0,0 +1,73 @@
+"""
+抓取与写入的流水线
+
+商店的抓取函数按页产出评论（生成器），这里把它们放到后台线程中执行，经有界队列交给写入方：
+写入一页的同时已在抓取下一页；写入跟不上时队列满，抓取线程等待（背压），因此每个抓取来源（国家）在内存中
+平均只保留 STREAM_QUEUE_PAGES 页加上正在抓取、正在写入的各一页，不再先把几千条评论全部抓完再写入。
+"""
+import threading
+from queue import Empty, Full, Queue
+from typing import Dict, Iterable, Iterator, Optional, Tuple, TypeVar
+
+from .config import STREAM_QUEUE_PAGES
+
+T = TypeVar("T")
+
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+def prefetch(sources: Dict[str, Iterable[T]], maxsize: int = STREAM_QUEUE_PAGES
+             ) -> Iterator[Tuple[str, Optional[T], Optional[BaseException]]]:
+    """
+    每个来源在单独的线程中迭代，产出的元素经同一个有界队列按到达顺序交给调用方
+    :param sources: 来源名 -> 可迭代对象（如某个国家的分页生成器）
+    :param maxsize: 平均每个来源预取的元素数（队列容量为 maxsize × 来源数）
+    :return: 依次产出 (来源名, 元素, None)；某个来源抛出异常时产出 (来源名, None, 异常)，其他来源继续
+    """
+    queue: Queue = Queue(maxsize=max(maxsize, 1) * max(len(sources), 1))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=_POLL_SECONDS)
+                return True
+            except Full:
+                continue
+        return False
+
+    def run(key: str, source: Iterable[T]) -> None:
+        iterator = iter(source)
+        try:
+            for item in iterator:
+                if not put((key, item, None)):
+                    break  # 调用方已停止迭代
+        except BaseException as e:
+            put((key, None, e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()  # 提前结束时释放生成器持有的资源（线程池等）
+            put((key, _DONE, None))
+
+    threads = [threading.Thread(target=run, args=(key, source), name=f"prefetch-{key}", daemon=True)
+               for key, source in sources.items()]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            key, item, error = queue.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            yield key, item, error
+    finally:
+        # 调用方提前结束（如写入失败）时通知抓取线程退出，并取走队列中的元素让等待中的线程结束
+        stop.set()
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                break
@@ -0,0 +1,377 @@
+"""
+按评论增速自适应的轮询策略
+
+每个应用、每个平台在 app_sync_states 中保存一份状态。每次抓取后用新增评论数除以距上次
+抓取的小时数得到本轮增速，再做 EWMA 平滑得到 review_rate（条/小时），据此计算：
+
+    轮询间隔 = POLL_TARGET_NEW_PER_RUN / review_rate，限制在 [1 小时, 7 天]
+    抓取条数 = review_rate x 间隔 x 2（留出余量），限制在 [POLL_MIN_LIMIT, POLL_MAX_LIMIT]
+
+如果某次新增条数达到了抓取上限，说明可能有评论没抓到，本轮增速按两倍估计。
+所有到期的抓取共享每小时 POLL_REQUEST_BUDGET_PER_HOUR 次请求的全局预算。
+
+为避免所有应用集中在同一时刻抓取，每个应用、平台根据 crc32 哈希得到一个固定的相位，
+下次抓取时间对齐到离目标时间最近的相位点（周期为 min(轮询间隔, SCHEDULE_WINDOW_MINUTES)），
+再加上 ±SCHEDULE_JITTER_SECONDS 的随机偏移。每个商店同时进行的抓取数由
+STORE_MAX_IN_FLIGHT 限制。
+
+多进程部署时并发名额和请求预算都保存在数据库中，由所有进程共享：名额是 store_slots 表中的租约
+（每 INGEST_HEARTBEAT_SECONDS 续约，进程崩溃后 INGEST_LEASE_SECONDS 过期释放），预算按
+request_budget_spends 表中最近一小时的记账计算。预算只由运行调度器的进程（见 leader）检查，其他进程只记账。
+"""
+import math
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+import uuid
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+
+from .config import (
+    INGEST_HEARTBEAT_SECONDS, INGEST_LEASE_SECONDS, POLL_DEFAULT_INTERVAL_MINUTES, POLL_DEFAULT_LIMIT,
+    POLL_EWMA_ALPHA, POLL_MAX_INTERVAL_MINUTES, POLL_MAX_LIMIT, POLL_MIN_INTERVAL_MINUTES, POLL_MIN_LIMIT,
+    POLL_REQUEST_BUDGET_PER_HOUR, POLL_TARGET_NEW_PER_RUN, SCHEDULE_JITTER_SECONDS, SCHEDULE_WINDOW_MINUTES,
+    STORE_MAX_IN_FLIGHT,
+)
+from .database import SessionLocal
+from .logger import setup_logger
+from .models import App, AppSyncState, RequestBudgetSpend, StoreSlot
+
+logger = setup_logger("polling")
+
+# 各商店每个请求返回的评论数
+PAGE_SIZES = {"ios": 20, "android": 199}
+# App Store 的 token 在进程内缓存（APP_STORE_TOKEN_TTL_SECONDS），不再每次抓取都请求
+SETUP_REQUESTS = {"ios": 0, "android": 0}
+
+
+def app_platforms(app: App, platform: Optional[str] = None) -> List[str]:
+    """应用已配置的平台，可用 platform 过滤"""
+    platforms = []
+    if platform in (None, "ios") and app.platform in ("ios", "both") and app.app_store_id:
+        platforms.append("ios")
+    if platform in (None, "android") and app.platform in ("android", "both") and app.play_store_id:
+        platforms.append("android")
+    return platforms
+
+
+def estimate_requests(platform: str, limit: Optional[int], countries: int = 1) -> int:
+    """估算一次抓取需要的请求数，多个国家时每个国家各抓取 limit 条"""
+    limit = limit or POLL_MAX_LIMIT
+    return (SETUP_REQUESTS[platform] + math.ceil(limit / PAGE_SIZES[platform])) * countries
+
+
+def limit_for_requests(platform: str, requests: int, countries: int = 1) -> int:
+    """estimate_requests 的反函数：requests 次请求最多能抓取的条数（每个国家），至少一页"""
+    pages = requests // max(countries, 1) - SETUP_REQUESTS[platform]
+    return max(pages, 1) * PAGE_SIZES[platform]
+
+
+def _phase_seconds(app_id: int, platform: str, period: int) -> int:
+    return zlib.crc32(f"{app_id}:{platform}".encode("utf-8")) % period
+
+
+def spread_time(app_id: int, platform: str, target: datetime, interval_minutes: int,
+                not_before: Optional[datetime] = None) -> datetime:
+    """
+    把目标时间对齐到该应用固定的相位点，并加上随机偏移
+    :param not_before: 结果不早于该时间（用于首次调度）
+    """
+    period = int(min(SCHEDULE_WINDOW_MINUTES, interval_minutes) * 60)
+    if period <= 0:
+        return target
+    phase = _phase_seconds(app_id, platform, period)
+    ts = target.timestamp()
+    slot = ts - ((ts - phase) % period)
+    if ts - slot > period / 2:
+        slot += period
+    if not_before is not None and slot < not_before.timestamp():
+        slot += period
+    jitter = min(SCHEDULE_JITTER_SECONDS, period / 4)
+    slot += random.uniform(-jitter, jitter)
+    if not_before is not None:
+        slot = max(slot, not_before.timestamp())
+    return datetime.fromtimestamp(slot)
+
+
+def get_state(db, app_id: int, platform: str, now: Optional[datetime] = None) -> AppSyncState:
+    """获取抓取状态，不存在时创建一份默认状态"""
+    state = db.query(AppSyncState).filter(
+        AppSyncState.app_id == app_id, AppSyncState.platform == platform
+    ).first()
+    if not state:
+        now = now or datetime.now()
+        state = AppSyncState(
+            app_id=app_id,
+            platform=platform,
+            review_rate=0,
+            interval_minutes=POLL_DEFAULT_INTERVAL_MINUTES,
+            fetch_limit=POLL_DEFAULT_LIMIT,
+            # 新应用的首次抓取也分散到窗口内
+            next_run_at=spread_time(app_id, platform, now, POLL_DEFAULT_INTERVAL_MINUTES, not_before=now),
+        )
+        db.add(state)
+        db.flush()
+    return state
+
+
+def ensure_states(db, now: Optional[datetime] = None) -> None:
+    """为所有应用已配置的平台补齐抓取状态"""
+    for app in db.query(App).filter(App.deleted_at.is_(None)).all():
+        for platform in app_platforms(app):
+            get_state(db, app.id, platform, now)
+    db.commit()
+
+
+def plan_next_run(state: AppSyncState, now: datetime) -> None:
+    """根据当前的增速估计计算下一次轮询的间隔、抓取条数和时间"""
+    rate = state.review_rate or 0
+    if rate > 0:
+        interval = POLL_TARGET_NEW_PER_RUN / rate * 60
+    else:
+        interval = POLL_MAX_INTERVAL_MINUTES
+    interval = int(min(max(interval, POLL_MIN_INTERVAL_MINUTES), POLL_MAX_INTERVAL_MINUTES))
+    limit = int(math.ceil(rate * interval / 60 * 2))
+    state.interval_minutes = interval
+    state.fetch_limit = min(max(limit, POLL_MIN_LIMIT), POLL_MAX_LIMIT)
+    state.next_run_at = spread_time(state.app_id, state.platform, now + timedelta(minutes=interval), interval)
+
+
+def record_run(db, app_id: int, platform: str, new_count: int, limit: Optional[int],
+               now: Optional[datetime] = None) -> AppSyncState:
+    """记录一次抓取结果并更新增速估计（由调用方提交事务）"""
+    now = now or datetime.now()
+    state = get_state(db, app_id, platform, now)
+    if not limit:
+        # 不限条数的全量抓取会带回历史评论，不能反映增速
+        state.last_new_count = new_count
+        state.last_run_at = now
+        return state
+    if state.last_run_at:
+        hours = max((now - state.last_run_at).total_seconds() / 3600, 1 / 60)
+    else:
+        hours = state.interval_minutes / 60
+    observed = new_count / hours
+    if new_count >= limit:
+        # 抓满了，真实增速可能更高
+        observed *= 2
+    if state.last_run_at is None:
+        state.review_rate = observed
+    else:
+        state.review_rate = POLL_EWMA_ALPHA * observed + (1 - POLL_EWMA_ALPHA) * (state.review_rate or 0)
+    state.last_new_count = new_count
+    state.last_run_at = now
+    plan_next_run(state, now)
+    return state
+
+
+def due_states(db, now: Optional[datetime] = None) -> List[AppSyncState]:
+    """到期的抓取，增速高的优先"""
+    now = now or datetime.now()
+    states = db.query(AppSyncState).join(App, App.id == AppSyncState.app_id).filter(
+        App.deleted_at.is_(None),
+        AppSyncState.next_run_at <= now,
+    ).all()
+    return sorted(states, key=lambda state: (-(state.review_rate or 0), state.next_run_at))
+
+
+def upcoming_plan(db, hours: int = 24, now: Optional[datetime] = None) -> List[Dict]:
+    """未来 hours 小时内的抓取计划（已到期未执行的也包含在内）"""
+    now = now or datetime.now()
+    rows = db.query(AppSyncState, App).join(App, App.id == AppSyncState.app_id).filter(
+        App.deleted_at.is_(None),
+        AppSyncState.next_run_at <= now + timedelta(hours=hours),
+    ).order_by(AppSyncState.next_run_at).all()
+    return [
+        {
+            "app_id": state.app_id,
+            "app_name": app.name,
+            "platform": state.platform,
+            "next_run_at": state.next_run_at,
+            "overdue": state.next_run_at <= now,
+            "interval_minutes": state.interval_minutes,
+            "fetch_limit": state.fetch_limit,
+            "review_rate": round(state.review_rate or 0, 3),
+            "estimated_requests": estimate_requests(state.platform, state.fetch_limit,
+                                                   len(app.countries(state.platform))),
+        }
+        for state, app in rows
+    ]
+
+
+SLOT_WAIT_SECONDS = 1  # 名额用完时重新检查的间隔（本进程释放名额时立即检查）
+
+_process = f"{socket.gethostname()}:{os.getpid()}"
+_held: Dict[int, str] = {}  # 本进程占用的名额 id -> 占用者，由续约线程续约
+_slot_released = threading.Condition()
+_renewer: Optional[threading.Thread] = None
+
+
+def _try_acquire_slot(platform: str, owner: str) -> Optional[int]:
+    """占用一个空闲或租约已过期的名额，返回名额 id；没有空闲名额时返回 None"""
+    limit = STORE_MAX_IN_FLIGHT[platform]
+    db = SessionLocal()
+    try:
+        existing = {slot for slot, in db.query(StoreSlot.slot).filter(StoreSlot.platform == platform)}
+        missing = [slot for slot in range(limit) if slot not in existing]
+        if missing:
+            try:
+                db.add_all(StoreSlot(platform=platform, slot=slot) for slot in missing)
+                db.commit()
+            except IntegrityError:
+                db.rollback()  # 其他进程同时补齐了名额
+        now = datetime.now()
+        free = db.query(StoreSlot.id).filter(
+            StoreSlot.platform == platform, StoreSlot.slot < limit,
+            or_(StoreSlot.owner.is_(None), StoreSlot.expires_at < now),
+        ).order_by(StoreSlot.slot).all()
+        for slot_id, in free:
+            # 条件更新：其他进程先占用时更新 0 行，换下一个
+            claimed = db.query(StoreSlot).filter(
+                StoreSlot.id == slot_id, or_(StoreSlot.owner.is_(None), StoreSlot.expires_at < now)
+            ).update({"owner": owner, "expires_at": now + timedelta(seconds=INGEST_LEASE_SECONDS)},
+                     synchronize_session=False)
+            db.commit()
+            if claimed:
+                return slot_id
+        return None
+    finally:
+        db.close()
+
+
+def _release_slot(slot_id: int, owner: str) -> None:
+    db = SessionLocal()
+    try:
+        db.query(StoreSlot).filter(StoreSlot.id == slot_id, StoreSlot.owner == owner).update(
+            {"owner": None, "expires_at": None}, synchronize_session=False
+        )
+        db.commit()
+    except Exception as e:
+        # 释放失败时名额在租约过期后自动释放
+        logger.error(f"释放商店并发名额失败: {str(e)}\n{traceback.format_exc()}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def _renew_slots() -> None:
+    """续约本进程占用的名额"""
+    while True:
+        time.sleep(INGEST_HEARTBEAT_SECONDS)
+        with _slot_released:
+            owners = list(_held.values())
+        if not owners:
+            continue
+        db = SessionLocal()
+        try:
+            db.query(StoreSlot).filter(StoreSlot.owner.in_(owners)).update(
+                {"expires_at": datetime.now() + timedelta(seconds=INGEST_LEASE_SECONDS)}, synchronize_session=False
+            )
+            db.commit()
+        except Exception as e:
+            logger.error(f"续约商店并发名额失败: {str(e)}")
+            db.rollback()
+        finally:
+            db.close()
+
+
+@contextmanager
+def store_slot(platform: str):
+    """占用商店的一个并发名额（所有进程共享），名额用完时等待"""
+    global _renewer
+    owner = f"{_process}:{uuid.uuid4().hex[:8]}"
+    while True:
+        slot_id = _try_acquire_slot(platform, owner)
+        if slot_id is not None:
+            break
+        with _slot_released:
+            _slot_released.wait(SLOT_WAIT_SECONDS)
+    with _slot_released:
+        _held[slot_id] = owner
+        if _renewer is None:
+            _renewer = threading.Thread(target=_renew_slots, name="store-slot-renewer", daemon=True)
+            _renewer.start()
+    try:
+        yield
+    finally:
+        with _slot_released:
+            _held.pop(slot_id, None)
+        _release_slot(slot_id, owner)
+        with _slot_released:
+            _slot_released.notify_all()
+
+
+def in_flight(db) -> Dict[str, Dict[str, int]]:
+    """各商店正在进行的抓取数（所有进程）"""
+    running = dict(db.query(StoreSlot.platform, func.count(StoreSlot.id)).filter(
+        StoreSlot.owner.isnot(None), StoreSlot.expires_at >= datetime.now(),
+    ).group_by(StoreSlot.platform).all())
+    return {
+        platform: {"running": running.get(platform, 0), "max": STORE_MAX_IN_FLIGHT[platform]}
+        for platform in STORE_MAX_IN_FLIGHT
+    }
+
+
+class RequestBudget:
+    """滚动一小时窗口内的全局请求预算，记账保存在数据库中，所有进程共享"""
+
+    def __init__(self, per_hour: int = POLL_REQUEST_BUDGET_PER_HOUR):
+        self.per_hour = per_hour
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _spent(db, now: datetime) -> int:
+        return db.query(func.coalesce(func.sum(RequestBudgetSpend.cost), 0)).filter(
+            RequestBudgetSpend.spent_at > now - timedelta(hours=1)
+        ).scalar()
+
+    def remaining(self) -> int:
+        db = SessionLocal()
+        try:
+            return self.per_hour - self._spent(db, datetime.now())
+        finally:
+            db.close()
+
+    def spend(self, cost: int) -> None:
+        """记录不受预算限制的请求（如手动刷新），挤占后续轮询的额度"""
+        db = SessionLocal()
+        try:
+            db.add(RequestBudgetSpend(spent_at=datetime.now(), cost=cost))
+            db.commit()
+        except Exception as e:
+            logger.error(f"记录请求预算失败: {str(e)}")
+            db.rollback()
+        finally:
+            db.close()
+
+    def try_spend(self, cost: int) -> bool:
+        """
+        预算足够时记账并返回 True。只在运行调度器的进程中调用（同时只有一个），
+        其他进程的 spend 最多让预算短暂超出一次抓取的请求数
+        """
+        with self._lock:
+            db = SessionLocal()
+            try:
+                now = datetime.now()
+                db.query(RequestBudgetSpend).filter(RequestBudgetSpend.spent_at <= now - timedelta(hours=1)).delete(
+                    synchronize_session=False
+                )
+                if self._spent(db, now) + cost > self.per_hour:
+                    db.commit()
+                    return False
+                db.add(RequestBudgetSpend(spent_at=now, cost=cost))
+                db.commit()
+                return True
+            finally:
+                db.close()
+
+
+budget = RequestBudget()
@@ -0,0 +1,157 @@
+"""
+应用删除的后台清理
+
+删除应用时只把 App.deleted_at 标记上（读接口立即不可见），评论、全文索引、月度汇总和归档文件由后台任务
+按 PURGE_BATCH_SIZE 分批删除，每批一个短事务，批次之间短暂让出 SQLite 写锁，
+避免长时间阻塞评论抓取和其他请求。所有评论清理完后才删除应用本身。
+
+开始删除评论前先删除应用排队中的抓取任务，并等待正在执行的任务结束：抓取每写入一页前检查 App.deleted_at
+（见 sync.save_reviews），已标记删除时中止，因此通常只需等待一页的时间；工作进程中断时等到租约过期。
+"""
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import and_, or_
+
+from .config import PURGE_BATCH_SIZE, PURGE_BATCH_PAUSE, PURGE_WAIT_SECONDS
+from .database import SessionLocal
+from .logger import setup_logger
+from .models import App, AppSyncState, IngestionRun, PurgeJob, Review, ReviewContent
+from . import archive, backfill, circuit, ingestion, search
+
+logger = setup_logger("purge")
+
+STALE_AFTER = timedelta(minutes=5)  # 执行中的任务超过这么久没有进展，视为进程已中断
+
+
+def create_purge_job(db, app: App) -> PurgeJob:
+    """标记应用为已删除并创建清理任务（由调用方提交事务）"""
+    now = datetime.now()
+    app.deleted_at = now
+    job = PurgeJob(
+        app_id=app.id,
+        status="pending",
+        total=db.query(Review).filter(Review.app_id == app.id).count(),
+        deleted=0,
+        created_at=now,
+    )
+    db.add(job)
+    return job
+
+
+def latest_purge_job(db, app_id: int) -> Optional[PurgeJob]:
+    return db.query(PurgeJob).filter(PurgeJob.app_id == app_id).order_by(PurgeJob.id.desc()).first()
+
+
+def _delete_batch(db, app_id: int) -> int:
+    """删除一批评论及其索引，返回删除条数"""
+    ids = [
+        row.id for row in
+        db.query(Review.id).filter(Review.app_id == app_id).order_by(Review.id).limit(PURGE_BATCH_SIZE)
+    ]
+    if not ids:
+        return 0
+    search.unindex_app(db.connection(), app_id, ids)
+    db.query(ReviewContent).filter(ReviewContent.review_id.in_(ids)).delete(synchronize_session=False)
+    db.query(Review).filter(Review.id.in_(ids)).delete(synchronize_session=False)
+    return len(ids)
+
+
+def _wait_for_ingestion(db, job: PurgeJob) -> None:
+    """删除排队中的抓取任务，等待正在执行的结束，之后不会再有评论写入"""
+    ingestion.delete_app_tasks(db, job.app_id)
+    db.commit()
+    while True:
+        running = ingestion.running_app_tasks(db, job.app_id)
+        if not running:
+            return
+        logger.info(f"等待应用 {job.app_id} 正在执行的 {running} 个抓取任务结束")
+        job.updated_at = datetime.now()  # 等待期间不视为中断
+        db.commit()
+        time.sleep(PURGE_WAIT_SECONDS)
+
+
+def purge_app(job_id: int):
+    """执行清理任务，可重复调用（中断后从剩余评论继续）"""
+    db = SessionLocal()
+    try:
+        # 多个进程可能同时尝试执行同一任务，只有把状态改为 running 的那个继续
+        now = datetime.now()
+        claimed = db.query(PurgeJob).filter(
+            PurgeJob.id == job_id,
+            or_(
+                PurgeJob.status.in_(["pending", "failed"]),
+                and_(PurgeJob.status == "running", PurgeJob.updated_at < now - STALE_AFTER),
+            ),
+        ).update({"status": "running", "updated_at": now}, synchronize_session=False)
+        db.commit()
+        if not claimed:
+            return
+        job = db.query(PurgeJob).filter(PurgeJob.id == job_id).first()
+        app_id = job.app_id
+        logger.info(f"开始清理应用: app_id={app_id}, job_id={job_id}, total={job.total}")
+        _wait_for_ingestion(db, job)
+
+        while True:
+            deleted = _delete_batch(db, app_id)
+            job.deleted = (job.deleted or 0) + deleted
+            job.updated_at = datetime.now()
+            db.commit()
+            if deleted < PURGE_BATCH_SIZE:
+                break
+            if PURGE_BATCH_PAUSE:
+                time.sleep(PURGE_BATCH_PAUSE)
+
+        archive.purge_archive(db, app_id)
+        db.query(AppSyncState).filter(AppSyncState.app_id == app_id).delete(synchronize_session=False)
+        ingestion.delete_app_tasks(db, app_id)
+        backfill.delete_app_checkpoints(db, app_id)
+        circuit.delete_app_breakers(db, app_id)
+        db.query(IngestionRun).filter(IngestionRun.app_id == app_id).delete(synchronize_session=False)
+        app = db.query(App).filter(App.id == app_id).first()
+        if app:
+            db.delete(app)
+        job.status = "done"
+        job.finished_at = datetime.now()
+        job.updated_at = job.finished_at
+        db.commit()
+        logger.info(f"应用清理完成: app_id={app_id}, deleted={job.deleted}")
+        archive.incremental_vacuum(db)
+
+    except Exception as e:
+        logger.error(f"清理应用失败: job_id={job_id}, {str(e)}\n{traceback.format_exc()}")
+        db.rollback()
+        job = db.query(PurgeJob).filter(PurgeJob.id == job_id).first()
+        if job:
+            job.status = "failed"
+            job.error = str(e)
+            job.updated_at = datetime.now()
+            db.commit()
+    finally:
+        db.close()
+
+
+def schedule_purge(job_id: int):
+    """在后台线程中立即执行清理任务"""
+    threading.Thread(target=purge_app, args=(job_id,), name=f"purge-{job_id}", daemon=True).start()
+
+
+def resume_purges(include_failed: bool = True):
+    """
+    恢复未完成的清理任务：等待中的、中断（超过 STALE_AFTER 没有进展）的，以及 include_failed 时失败的
+    """
+    db = SessionLocal()
+    try:
+        statuses = ["pending", "running", "failed"] if include_failed else ["pending", "running"]
+        jobs = db.query(PurgeJob).filter(PurgeJob.status.in_(statuses)).all()
+        stale = datetime.now() - STALE_AFTER
+        for job in jobs:
+            if job.status == "running" and job.updated_at and job.updated_at >= stale:
+                continue  # 仍在其他线程中执行
+            logger.info(f"恢复未完成的清理任务: job_id={job.id}, app_id={job.app_id}")
+            schedule_purge(job.id)
+    finally:
+        db.close()
@@ -0,0 +1,135 @@
+"""
+商店请求限速
+
+每个商店一个令牌桶（App Store 的页面和评论接口算同一个商店），轮询、手动刷新、全量抓取的每个 HTTP 请求都先
+取令牌，速率按 AIMD 自适应：
+
+- 请求成功时速率增加 STORE_RATE_INCREASE（每秒请求数），不超过 STORE_RATE_MAX；
+- 收到 429 或 5xx 时速率乘以 STORE_RATE_DECREASE，不低于 STORE_RATE_MIN。并发的请求同时被限流时，
+  一个请求间隔内只降一次；
+- 响应带 Retry-After 时，在该时间内（最多 STORE_RETRY_AFTER_MAX_SECONDS）暂停该商店的所有请求。
+
+限速器在进程内共享。多进程部署时各进程各自限速，速率、突发容量按 STORE_REQUEST_PROCESSES 均分，
+所有进程合计不超过配置的值；Retry-After 的暂停只对收到响应的进程生效。
+"""
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+from .config import (
+    STORE_RATE_BURST, STORE_RATE_DECREASE, STORE_RATE_INCREASE, STORE_RATE_INITIAL, STORE_RATE_MAX,
+    STORE_RATE_MIN, STORE_REQUEST_PROCESSES, STORE_RETRY_AFTER_MAX_SECONDS,
+)
+from .logger import setup_logger
+
+logger = setup_logger("ratelimit")
+
+
+def is_throttled(status: Optional[int]) -> bool:
+    """商店限流或过载的响应"""
+    return status is not None and (status == 429 or status >= 500)
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头（秒数或 HTTP 日期）"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        until = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    return max((until - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class AdaptiveRateLimiter:
+    """令牌桶，速率按 AIMD 调整"""
+
+    def __init__(self, name: str, rate: float, min_rate: float = STORE_RATE_MIN, max_rate: float = STORE_RATE_MAX,
+                 burst: float = STORE_RATE_BURST, increase: float = STORE_RATE_INCREASE):
+        self.name = name
+        self.increase = increase
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, min_rate)
+        self.rate = min(max(rate, self.min_rate), self.max_rate)
+        self.burst = max(burst, 1.0)
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled_count = 0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """取一个令牌；timeout 秒内取不到时返回 False"""
+        end = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.requests += 1
+                    return True
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            if end is not None:
+                if now >= end:
+                    return False
+                wait = min(wait, end - now)
+            time.sleep(wait)
+
+    def success(self) -> None:
+        with self._lock:
+            self.rate = min(self.rate + self.increase, self.max_rate)
+
+    def throttled(self, pause: Optional[float] = None) -> None:
+        """收到 429/5xx：降低速率，有 Retry-After 时暂停"""
+        with self._lock:
+            now = time.monotonic()
+            self.throttled_count += 1
+            if now - self._last_decrease >= 1 / self.rate:
+                self.rate = max(self.rate * STORE_RATE_DECREASE, self.min_rate)
+                self._last_decrease = now
+            self._tokens = min(self._tokens, 0.0)
+            if pause:
+                self._blocked_until = max(self._blocked_until, now + min(pause, STORE_RETRY_AFTER_MAX_SECONDS))
+            rate, blocked = self.rate, max(self._blocked_until - now, 0.0)
+        logger.warning(f"{self.name} 请求被限流，速率降为 {rate:.2f} 次/秒" + (f"，暂停 {blocked:.0f} 秒" if blocked else ""))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                "rate": round(self.rate, 3),
+                "tokens": round(self._tokens, 2),
+                "paused_seconds": round(max(self._blocked_until - now, 0.0), 1),
+                "requests": self.requests,
+                "throttled": self.throttled_count,
+            }
+
+
+def _process_share(platform: str, rate: float) -> AdaptiveRateLimiter:
+    """本进程的限速器：配置的速率按 STORE_REQUEST_PROCESSES 均分"""
+    share = 1 / STORE_REQUEST_PROCESSES
+    return AdaptiveRateLimiter(platform, rate * share, STORE_RATE_MIN * share, STORE_RATE_MAX * share,
+                               STORE_RATE_BURST * share, STORE_RATE_INCREASE * share)
+
+
+limiters = {platform: _process_share(platform, rate) for platform, rate in STORE_RATE_INITIAL.items()}
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    """各商店当前的速率（每秒请求数）、剩余令牌、暂停时间和累计请求/限流次数（本进程，速率为本进程分到的份额）"""
+    return {platform: limiter.snapshot() for platform, limiter in limiters.items()}
@@ -0,0 +1,350 @@
+"""
+商店原始响应存档与离线重新解析
+
+开启 RAW_ARCHIVE_ENABLED 后，每次抓取收到的商店原始响应（App Store 评论接口的 JSON、Google Play 的
+batchexecute 响应）保存到 RAW_ARCHIVE_DIR：
+
+    objects/<sha256 前两位>/<sha256>.<codec>   按内容哈希命名的压缩文件，相同的响应只保存一份
+    runs/<存档编号>.jsonl                       每次抓取一个清单，每行一个响应（哈希、平台、国家、请求位置）
+
+存档编号记录在抓取记录（ingestion_runs.raw_archive）中。修复解析问题后，可以用当前的解析代码从存档重建
+评论，不发出任何网络请求：
+
+    python -m app.rawarchive list [--app-id N]
+    python -m app.rawarchive reparse [--app-id N] [--platform ios|android] [--run 编号 ...]
+                                     [--workers N] [--dry-run] [--replace]
+
+重新解析在多个工作进程中进行，结果在主进程中按页写入（与抓取相同的去重规则）。解析修正影响去重字段
+（如日期）时，旧数据无法按新结果匹配，可加 --replace 用重新解析的结果替换这些应用平台现有的评论（不含
+已归档的）；只有存档覆盖了全部历史时才应这样做。替换时先解析全部响应，有响应解析失败时不做任何修改；
+每个应用平台的删除和写入在同一个事务中，中途失败时回滚，现有评论保持不变。已删除的应用不处理。
+
+设置 SCRAPER_BACKENDS=ios=replay,android=replay 时，抓取任务不请求商店，而是回放存档中的响应（见 replay）。
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import traceback
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .config import PURGE_BATCH_SIZE, RAW_ARCHIVE_DIR, RAW_ARCHIVE_ENABLED
+from .logger import setup_logger
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - 未安装时使用 zlib
+    zstandard = None
+
+logger = setup_logger("rawarchive")
+
+CODEC = "zst" if zstandard is not None else "zlib"
+WRITE_CHUNK = 500  # 重新解析后每次写入的条数
+
+
+def _object_path(digest: str, codec: str) -> str:
+    return os.path.join(RAW_ARCHIVE_DIR, "objects", digest[:2], f"{digest}.{codec}")
+
+
+def _manifest_path(key: str) -> str:
+    return os.path.join(RAW_ARCHIVE_DIR, "runs", f"{key}.jsonl")
+
+
+def _compress(body: bytes) -> bytes:
+    if CODEC == "zst":
+        return zstandard.ZstdCompressor(level=10).compress(body)
+    return zlib.compress(body, 9)
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zst":
+        if zstandard is None:
+            raise RuntimeError("存档使用 zstd 压缩，需要安装 zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def store_object(body: bytes) -> Tuple[str, str]:
+    """保存一个原始响应，已存在时不重复写入，返回 (sha256, codec)"""
+    digest = hashlib.sha256(body).hexdigest()
+    for codec in ("zst", "zlib"):
+        if os.path.exists(_object_path(digest, codec)):
+            return digest, codec
+    path = _object_path(digest, CODEC)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_compress(body))
+    os.replace(tmp, path)  # 先写临时文件再改名，其他进程不会读到写了一半的文件
+    return digest, CODEC
+
+
+def load_object(digest: str, codec: str) -> bytes:
+    with open(_object_path(digest, codec), "rb") as f:
+        return _decompress(f.read(), codec)
+
+
+class RawRecorder:
+    """一次抓取的原始响应存档，多个抓取线程共用"""
+
+    def __init__(self, kind: str, app_id: int, platform: str):
+        self.key = f"{datetime.now():%Y%m%d-%H%M%S}-{kind}-{app_id}-{platform}-{uuid.uuid4().hex[:8]}"
+        self.app_id = app_id
+        self.platform = platform
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, country: str, body: bytes, request: Optional[Dict[str, Any]] = None) -> None:
+        digest, codec = store_object(body)
+        entry = {
+            "sha256": digest,
+            "codec": codec,
+            "app_id": self.app_id,
+            "platform": self.platform,
+            "country": country,
+            "request": request or {},
+            "fetched_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        with self._lock:
+            path = _manifest_path(self.key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.count += 1
+
+
+def start_run(kind: str, app_id: int, platform: str) -> Optional[RawRecorder]:
+    """开启存档时为一次抓取创建存档，否则返回 None"""
+    return RawRecorder(kind, app_id, platform) if RAW_ARCHIVE_ENABLED else None
+
+
+def record(metrics, country: str, body: bytes, **request) -> None:
+    """
+    把一个原始响应存入本次抓取的存档（metrics 为该次抓取的 RunMetrics，未开启存档时什么也不做）；
+    存档失败只记录警告，不影响抓取
+    """
+    recorder = getattr(metrics, "raw", None)
+    if recorder is None:
+        return
+    try:
+        recorder.add(country, body, request)
+    except Exception as e:
+        logger.warning(f"保存原始响应失败: {str(e)}")
+
+
+def list_runs(app_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """已存档的抓取及其响应数"""
+    runs_dir = os.path.join(RAW_ARCHIVE_DIR, "runs")
+    if not os.path.isdir(runs_dir):
+        return []
+    result = []
+    for name in sorted(os.listdir(runs_dir)):
+        if not name.endswith(".jsonl"):
+            continue
+        entries = list(_read_manifest(name[:-len(".jsonl")]))
+        if not entries or (app_id is not None and entries[0]["app_id"] != app_id):
+            continue
+        result.append({
+            "key": name[:-len(".jsonl")],
+            "app_id": entries[0]["app_id"],
+            "platform": entries[0]["platform"],
+            "responses": len(entries),
+            "countries": sorted({entry["country"] for entry in entries}),
+        })
+    return result
+
+
+def _read_manifest(key: str) -> Iterator[Dict[str, Any]]:
+    with open(_manifest_path(key), encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _parse_body(platform: str, country: str, body: bytes) -> list:
+    if platform == "ios":
+        from .scrapers.app_store_concurrent import _parse
+        return _parse(json.loads(body), country)
+    from .scrapers.play_store import _to_reviews, parse_response
+    return _to_reviews(parse_response(body.decode("utf-8")), country)
+
+
+def parse_entry(entry: Dict[str, Any]) -> list:
+    """用当前的解析代码把一个存档的响应转换为评论记录（在工作进程中执行）"""
+    return _parse_body(entry["platform"], entry["country"], load_object(entry["sha256"], entry["codec"]))
+
+
+def replay(app_id: int, platform: str, country: str, limit: Optional[int] = None,
+           metrics=None) -> Iterator[Tuple[list, None]]:
+    """
+    按页回放存档中该应用、平台、国家的响应（新的存档在前，相同的响应只回放一次），产出格式同 scrapers 的
+    iter_reviews；不发出请求，也不续传（继续抓取的位置总是 None）
+    """
+    from .runs import timed
+
+    fetched = 0
+    seen = set()
+    for run in reversed(list_runs(app_id)):
+        if run["platform"] != platform or country not in run["countries"]:
+            continue
+        for entry in _read_manifest(run["key"]):
+            if entry["country"] != country or entry["sha256"] in seen:
+                continue
+            seen.add(entry["sha256"])
+            with timed(metrics, "fetch"):
+                body = load_object(entry["sha256"], entry["codec"])
+            with timed(metrics, "parse"):
+                page = _parse_body(platform, country, body)
+            if limit:
+                page = page[:limit - fetched]
+            fetched += len(page)
+            if metrics is not None:
+                metrics.pages += 1
+                metrics.fetched += len(page)
+            yield page, None
+            if limit and fetched >= limit:
+                return
+
+
+def _delete_live_reviews(db, app_id: int, platform: str, commit: bool = True) -> int:
+    """分批删除应用某个平台现有的评论、正文和索引；commit 为 False 时不提交，由调用方与写入一起提交"""
+    from .models import Review, ReviewContent
+    from . import search
+
+    total = 0
+    while True:
+        ids = [
+            row.id for row in db.query(Review.id).filter(
+                Review.app_id == app_id, Review.platform == platform
+            ).order_by(Review.id).limit(PURGE_BATCH_SIZE)
+        ]
+        if not ids:
+            return total
+        search.unindex_app(db.connection(), app_id, ids)
+        db.query(ReviewContent).filter(ReviewContent.review_id.in_(ids)).delete(synchronize_session=False)
+        db.query(Review).filter(Review.id.in_(ids)).delete(synchronize_session=False)
+        if commit:
+            db.commit()
+        total += len(ids)
+
+
+def reparse(app_id: Optional[int] = None, platform: Optional[str] = None, keys: Optional[List[str]] = None,
+            workers: Optional[int] = None, dry_run: bool = False, replace: bool = False) -> Dict[str, Any]:
+    """
+    从存档重新解析评论并写入
+    :param keys: 只处理这些存档，默认处理全部（可用 app_id、platform 过滤）
+    :param workers: 解析的进程数，默认为 CPU 核数
+    :param dry_run: 只解析，不写入
+    :param replace: 用重新解析的结果替换涉及的应用平台现有的评论；有响应解析失败时不做任何修改（aborted 为 True）
+    :return: 各项统计
+    """
+    from .database import SessionLocal
+    from .models import App
+    from .sync import save_reviews
+
+    if keys is None:
+        keys = [run["key"] for run in list_runs(app_id)]
+    # 同一个响应在多次抓取中出现时只解析一次
+    entries: Dict[Tuple[str, int, str, str], Dict[str, Any]] = {}
+    for key in keys:
+        for entry in _read_manifest(key):
+            if (app_id is None or entry["app_id"] == app_id) and (platform is None or entry["platform"] == platform):
+                entries.setdefault((entry["sha256"], entry["app_id"], entry["platform"], entry["country"]), entry)
+    stats = {"runs": len(keys), "responses": len(entries), "parsed": 0, "deleted": 0, "new_count": 0, "failed": 0,
+             "skipped": 0, "aborted": False}
+    if not entries:
+        return stats
+
+    db = SessionLocal()
+    try:
+        # 已删除（或不存在）的应用不解析也不写入
+        app_ids = {entry["app_id"] for entry in entries.values()}
+        live = {row.id for row in db.query(App.id).filter(App.id.in_(app_ids), App.deleted_at.is_(None))}
+        skipped = sorted({(entry["app_id"], entry["platform"]) for entry in entries.values()
+                          if entry["app_id"] not in live})
+        if skipped:
+            logger.warning(f"跳过已删除或不存在的应用: {skipped}")
+            stats["skipped"] = len(skipped)
+
+        # 先解析全部响应，再写入
+        parsed: Dict[Tuple[int, str], list] = {}
+        ordered = [entry for entry in entries.values() if entry["app_id"] in live]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(parse_entry, entry) for entry in ordered]
+            for entry, future in zip(ordered, futures):
+                try:
+                    records = future.result()
+                except Exception as e:
+                    logger.error(f"解析存档的响应失败: {entry['sha256']}: {str(e)}\n{traceback.format_exc()}")
+                    stats["failed"] += 1
+                    continue
+                stats["parsed"] += len(records)
+                parsed.setdefault((entry["app_id"], entry["platform"]), []).extend(records)
+        if replace and stats["failed"] and not dry_run:
+            logger.error(f"{stats['failed']} 个响应解析失败，不替换现有评论")
+            stats["aborted"] = True
+
+        for (target_app_id, target_platform), records in sorted(parsed.items()):
+            if dry_run or stats["aborted"]:
+                break
+            if replace and not records:
+                logger.warning(f"应用 {target_app_id} ({target_platform}) 的存档没有解析出评论，保留现有评论")
+                continue
+            if not replace:
+                for i in range(0, len(records), WRITE_CHUNK):
+                    stats["new_count"] += save_reviews(db, target_app_id, records[i:i + WRITE_CHUNK])
+                continue
+            # 删除和写入在同一个事务中，失败时回滚，现有评论保持不变
+            try:
+                deleted = _delete_live_reviews(db, target_app_id, target_platform, commit=False)
+                new_count = sum(
+                    save_reviews(db, target_app_id, records[i:i + WRITE_CHUNK], commit=False)
+                    for i in range(0, len(records), WRITE_CHUNK)
+                )
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            stats["deleted"] += deleted
+            stats["new_count"] += new_count
+    finally:
+        db.close()
+    logger.info(f"重新解析完成: {stats}")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.rawarchive", description="商店原始响应存档")
+    sub = parser.add_subparsers(dest="command", required=True)
+    listing = sub.add_parser("list", help="列出已存档的抓取")
+    listing.add_argument("--app-id", type=int)
+    parse = sub.add_parser("reparse", help="从存档重新解析评论（不发出网络请求）")
+    parse.add_argument("--app-id", type=int)
+    parse.add_argument("--platform", choices=("ios", "android"))
+    parse.add_argument("--run", action="append", dest="keys", help="只处理指定的存档，可重复")
+    parse.add_argument("--workers", type=int, help="解析的进程数（默认：CPU 核数）")
+    parse.add_argument("--dry-run", action="store_true", help="只解析并统计，不写入数据库")
+    parse.add_argument("--replace", action="store_true",
+                       help="用重新解析的结果替换涉及的应用平台现有的评论（不含已归档的）；有响应解析失败时不修改")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        for run in list_runs(args.app_id):
+            print(f"{run['key']}  app_id={run['app_id']} {run['platform']:8} {run['responses']:6} 个响应  "
+                  f"{','.join(run['countries'])}")
+    elif args.command == "reparse":
+        stats = reparse(args.app_id, args.platform, args.keys, args.workers, args.dry_run, args.replace)
+        print(f"存档 {stats['runs']} 个，响应 {stats['responses']} 个，解析出 {stats['parsed']} 条评论，"
+              f"删除 {stats['deleted']} 条，新增 {stats['new_count']} 条，解析失败 {stats['failed']} 个，"
+              f"跳过已删除的应用平台 {stats['skipped']} 个")
+        if stats["aborted"]:
+            print("有响应解析失败，没有替换现有评论")
+
+
+if __name__ == "__main__":
+    main()
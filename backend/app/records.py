@@ -0,0 +1,50 @@
+"""
+抓取中的评论记录
+
+商店返回的评论在抓取函数中转换为 ReviewRecord，按页一路传到写入（sync.save_reviews）。ReviewRecord 用
+__slots__ 保存字段，没有实例字典，每条占用的内存比等价的 dict 小得多；写入时直接生成 INSERT 的参数，
+不再为每条评论构造 ORM 对象。
+
+去重按 (平台, 作者, 时间) 与数据库中读回的值比较，时间在构造时统一为不带时区的 UTC 并去掉微秒（商店的
+时间精确到秒），来源不同（如带时区的解析结果、从存档重新解析）的同一条评论得到相同的键。
+"""
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+
+def normalize_time(value: datetime) -> datetime:
+    """带时区的时间转换为不带时区的 UTC，并去掉微秒"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(microsecond=0)
+
+
+class ReviewRecord:
+    """一条已转换为 Review 字段的评论（尚未写入数据库）"""
+
+    __slots__ = ("platform", "rating", "content", "author", "created_at", "country")
+
+    def __init__(self, platform: str, rating: float, content: Optional[str], author: Optional[str],
+                 created_at: datetime, country: Optional[str] = None):
+        self.platform = platform
+        self.rating = rating
+        self.content = content
+        self.author = author
+        self.created_at = normalize_time(created_at)
+        self.country = country
+
+    def key(self) -> Tuple[str, Optional[str], datetime]:
+        """去重用的 (平台, 作者, 时间)"""
+        return self.platform, self.author, self.created_at
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ReviewRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        return (f"ReviewRecord(platform={self.platform!r}, rating={self.rating!r}, author={self.author!r}, "
+                f"created_at={self.created_at!r}, country={self.country!r})")
@@ -0,0 +1,251 @@
+"""
+抓取记录
+
+每次抓取（手动刷新、轮询、全量抓取的一个任务）写入一条 ingestion_runs，耗时拆分为：
+
+    fetch - 请求商店（含 App Store 获取 token）
+    parse - 把商店返回的数据转换为评论字段
+    write - 去重并写入数据库
+
+抓取与写入按页流水线进行（见 pipeline），多个国家并发抓取，各阶段的耗时是累计值，相加可能超过总耗时。
+
+耗时超过该应用平台近 SLOW_RUN_BASELINE 次成功抓取中位数的 SLOW_RUN_FACTOR 倍（且不少于
+SLOW_RUN_MIN_SECONDS 秒），或达到 INGEST_TASK_DEADLINE_SECONDS 被截断时，标记为慢任务并记录警告。
+"""
+import json
+import statistics
+import time
+import traceback
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import case, func
+
+from .config import SLOW_RUN_BASELINE, SLOW_RUN_FACTOR, SLOW_RUN_MIN_SECONDS
+from .database import SessionLocal
+from .logger import setup_logger
+from .models import App, IngestionRun
+from . import ingestion, rawarchive
+
+logger = setup_logger("runs")
+
+PHASES = ("fetch", "parse", "write")
+
+
+class RunMetrics:
+    """一次抓取过程中累计的耗时和计数"""
+
+    def __init__(self, kind: str, app_id: int, platform: str, limit: Optional[int] = None):
+        task = ingestion.current_task()
+        self.task_id = task["id"] if task else None
+        self.lane = task["lane"] if task else None
+        self.kind = kind
+        self.app_id = app_id
+        self.platform = platform
+        self.limit = limit
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        self.duration_ms: Optional[int] = None
+        self.ms = {phase: 0.0 for phase in PHASES}
+        self.pages = 0
+        self.fetched = 0
+        self.new_count = 0
+        self.duplicates = 0
+        self.write_errors = 0
+        self.status = "running"
+        self.error: Optional[str] = None
+        self.deadline_exceeded = False  # 达到任务截止时间，只保存了部分结果
+        self.interrupted: Optional[BaseException] = None  # 请求中途失败、只保存了部分结果时的异常（计入熔断）
+        self.partitions: Optional[Dict[str, Any]] = None  # 分区抓取时各分区的页数、条数和是否完成
+        self.raw = rawarchive.start_run(kind, app_id, platform)  # 原始响应存档，未开启时为 None
+
+    @contextmanager
+    def timer(self, phase: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.ms[phase] += (time.perf_counter() - started) * 1000
+
+    def merge(self, other: "RunMetrics", prefix: str = "") -> None:
+        """合并并发抓取（如多个国家）各自累计的计数和耗时"""
+        for phase in PHASES:
+            self.ms[phase] += other.ms[phase]
+        self.pages += other.pages
+        self.fetched += other.fetched
+        self.new_count += other.new_count
+        self.duplicates += other.duplicates
+        self.write_errors += other.write_errors
+        self.interrupted = self.interrupted or other.interrupted
+        if other.partitions:
+            self.partitions = {**(self.partitions or {}),
+                               **{f"{prefix}{key}": value for key, value in other.partitions.items()}}
+
+    def finish(self, error: Optional[BaseException] = None, partial: Optional[str] = None) -> None:
+        """partial: 抓取到截止时间或中途失败、只保存了部分结果时的说明"""
+        self.duration_ms = int((time.perf_counter() - self._started) * 1000)
+        if error:
+            self.status, self.error = "failed", str(error)
+        elif partial:
+            self.status, self.error = "partial", partial
+        else:
+            self.status, self.error = "done", None
+
+
+def timed(metrics: Optional[RunMetrics], phase: str):
+    """metrics 为 None（不记录指标的调用方）时不计时"""
+    return metrics.timer(phase) if metrics is not None else nullcontext()
+
+
+def _is_slow(db, run: IngestionRun) -> bool:
+    if run.status != "done" or run.duration_ms is None or run.duration_ms < SLOW_RUN_MIN_SECONDS * 1000:
+        return False
+    recent = [
+        row.duration_ms for row in db.query(IngestionRun.duration_ms).filter(
+            IngestionRun.app_id == run.app_id,
+            IngestionRun.platform == run.platform,
+            IngestionRun.kind == run.kind,
+            IngestionRun.status == "done",
+            IngestionRun.duration_ms.isnot(None),
+        ).order_by(IngestionRun.id.desc()).limit(SLOW_RUN_BASELINE)
+    ]
+    if len(recent) < 3:
+        return False  # 历史太少，无法判断
+    return run.duration_ms > statistics.median(recent) * SLOW_RUN_FACTOR
+
+
+def record(metrics: RunMetrics) -> None:
+    """保存抓取记录（使用独立的会话，抓取失败回滚时也能写入）；记录失败不影响抓取"""
+    if metrics.duration_ms is None:
+        metrics.finish()
+    db = SessionLocal()
+    try:
+        run = IngestionRun(
+            task_id=metrics.task_id,
+            kind=metrics.kind,
+            lane=metrics.lane,
+            app_id=metrics.app_id,
+            platform=metrics.platform,
+            fetch_limit=metrics.limit,
+            status=metrics.status,
+            error=metrics.error,
+            started_at=metrics.started_at,
+            finished_at=datetime.now(),
+            duration_ms=metrics.duration_ms,
+            fetch_ms=int(metrics.ms["fetch"]),
+            parse_ms=int(metrics.ms["parse"]),
+            write_ms=int(metrics.ms["write"]),
+            pages=metrics.pages,
+            fetched=metrics.fetched,
+            new_count=metrics.new_count,
+            duplicates=metrics.duplicates,
+            write_errors=metrics.write_errors,
+            partitions=json.dumps(metrics.partitions) if metrics.partitions else None,
+            raw_archive=metrics.raw.key if metrics.raw is not None and metrics.raw.count else None,
+        )
+        run.slow = metrics.deadline_exceeded or _is_slow(db, run)
+        db.add(run)
+        db.commit()
+        if run.slow:
+            logger.warning(
+                f"慢抓取: app_id={run.app_id} ({run.platform}) {run.kind} 耗时 {run.duration_ms / 1000:.1f}s "
+                f"(fetch {run.fetch_ms}ms, parse {run.parse_ms}ms, write {run.write_ms}ms, {run.pages} 次请求)"
+            )
+    except Exception as e:
+        logger.error(f"保存抓取记录失败: {str(e)}\n{traceback.format_exc()}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def run_to_dict(run: IngestionRun) -> Dict[str, Any]:
+    return {
+        "id": run.id,
+        "task_id": run.task_id,
+        "kind": run.kind,
+        "lane": run.lane,
+        "app_id": run.app_id,
+        "platform": run.platform,
+        "limit": run.fetch_limit,
+        "status": run.status,
+        "error": run.error,
+        "started_at": run.started_at,
+        "finished_at": run.finished_at,
+        "duration_ms": run.duration_ms,
+        "fetch_ms": run.fetch_ms,
+        "parse_ms": run.parse_ms,
+        "write_ms": run.write_ms,
+        "pages": run.pages,
+        "fetched": run.fetched,
+        "new_count": run.new_count,
+        "duplicates": run.duplicates,
+        "write_errors": run.write_errors,
+        "slow": bool(run.slow),
+        "partitions": json.loads(run.partitions) if run.partitions else None,
+        "raw_archive": run.raw_archive,
+    }
+
+
+def query_runs(db, app_id: Optional[int] = None, platform: Optional[str] = None, kind: Optional[str] = None,
+               status: Optional[str] = None, slow: Optional[bool] = None):
+    query = db.query(IngestionRun)
+    if app_id is not None:
+        query = query.filter(IngestionRun.app_id == app_id)
+    if platform:
+        query = query.filter(IngestionRun.platform == platform)
+    if kind:
+        query = query.filter(IngestionRun.kind == kind)
+    if status:
+        query = query.filter(IngestionRun.status == status)
+    if slow is not None:
+        query = query.filter(IngestionRun.slow.is_(slow))
+    return query
+
+
+def summary(db, hours: int = 24) -> List[Dict[str, Any]]:
+    """最近 hours 小时内各应用平台的抓取耗时汇总，按总耗时从高到低排列"""
+    since = datetime.now() - timedelta(hours=hours)
+    rows = db.query(
+        IngestionRun.app_id,
+        App.name,
+        IngestionRun.platform,
+        func.count(IngestionRun.id),
+        func.sum(IngestionRun.duration_ms),
+        func.max(IngestionRun.duration_ms),
+        func.sum(IngestionRun.fetch_ms),
+        func.sum(IngestionRun.parse_ms),
+        func.sum(IngestionRun.write_ms),
+        func.sum(IngestionRun.pages),
+        func.sum(IngestionRun.new_count),
+        func.sum(IngestionRun.duplicates),
+        func.sum(case((IngestionRun.status == "failed", 1), else_=0)),
+        func.sum(case((IngestionRun.slow.is_(True), 1), else_=0)),
+    ).outerjoin(App, App.id == IngestionRun.app_id).filter(
+        IngestionRun.started_at >= since
+    ).group_by(IngestionRun.app_id, App.name, IngestionRun.platform).all()
+
+    total_ms = sum(row[4] or 0 for row in rows)
+    result = []
+    for (app_id, name, platform, runs, duration, longest, fetch_ms, parse_ms, write_ms, pages,
+         new_count, duplicates, failed, slow) in rows:
+        result.append({
+            "app_id": app_id,
+            "app_name": name,
+            "platform": platform,
+            "runs": runs,
+            "total_ms": duration or 0,
+            "avg_ms": int((duration or 0) / runs) if runs else 0,
+            "max_ms": longest or 0,
+            "fetch_ms": fetch_ms or 0,
+            "parse_ms": parse_ms or 0,
+            "write_ms": write_ms or 0,
+            "pages": pages or 0,
+            "new_count": new_count or 0,
+            "duplicates": duplicates or 0,
+            "failed": failed or 0,
+            "slow": slow or 0,
+            "share": round((duration or 0) / total_ms, 4) if total_ms else 0,
+        })
+    return sorted(result, key=lambda item: item["total_ms"], reverse=True)
+
@@ -1,105 +1,187 @@
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MISSED
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
-from .scrapers import app_store, play_store
-from .database import SessionLocal
-from .models import Review, App
+from apscheduler.schedulers.base import STATE_RUNNING, STATE_STOPPED
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from .database import SessionLocal, engine
+from .models import App
+from .archive import apply_retention
+from .backup import scheduled_backup
+from .config import (
+    BACKUP_INTERVAL_HOURS, POLL_TICK_MINUTES, SCHEDULER_MISFIRE_GRACE_SECONDS,
+)
+from . import backfill, circuit, ingestion, polling, purge
+from .leader import LeaderElection
+from .sync import update_reviews, update_latest_reviews  # noqa: F401  兼容原有的导入路径
 from .logger import setup_logger
-from datetime import datetime, timedelta
-from sqlalchemy import desc
+from datetime import datetime
+from typing import Any, Dict, List
 import traceback
 
 logger = setup_logger("scheduler")
 
-def update_reviews(app_id: int = None, platform: str = None, limit: int = None):
+def enqueue_refresh(app_id: int, platform: str = None, limit: int = None) -> List[Dict[str, Any]]:
     """
-    更新应用评论
-    :param app_id: 指定应用ID，为None时更新所有应用
-    :param platform: 指定平台 (ios/android)，为None时更新所有平台
-    :param limit: 限制获取的评论数量
+    把手动刷新加入抓取队列：指定条数的刷新走 interactive 通道；不限条数时改为可续传的全量抓取，
+    在 backfill 通道中执行。手动刷新不受请求预算限制，但会计入预算，挤占后续轮询的额度
     """
+    if not limit:
+        return backfill.start_backfill(app_id, platform)
     db = SessionLocal()
     try:
-        logger.info(f"开始更新应用评论: app_id={app_id}, platform={platform}, limit={limit}")
-        
-        # 查询需要更新的应用
-        query = db.query(App)
-        if app_id:
-            query = query.filter(App.id == app_id)
-        apps = query.all()
-        
-        for app in apps:
-            try:
-                # 获取 App Store 评论
-                if (platform in [None, 'ios'] and 
-                    app.platform in ['ios', 'both'] and 
-                    app.app_store_id):
-                    logger.info(f"更新 App Store 评论: app_id={app.id}")
-                    reviews = app_store.fetch_reviews(
-                        app.app_store_id, 
-                        country=app.app_store_country,
-                        limit=limit
-                    )
-                    save_reviews(db, app.id, reviews)
-
-                # 获取 Google Play 评论
-                if (platform in [None, 'android'] and 
-                    app.platform in ['android', 'both'] and 
-                    app.play_store_id):
-                    logger.info(f"更新 Google Play 评论: app_id={app.id}")
-                    reviews = play_store.fetch_reviews(
-                        app.play_store_id, 
-                        country=app.play_store_country,
-                        limit=limit
-                    )
-                    save_reviews(db, app.id, reviews)
+        app = db.query(App).filter(App.id == app_id, App.deleted_at.is_(None)).first()
+        platforms = polling.app_platforms(app, platform) if app else []
+    finally:
+        db.close()
+    tasks = []
+    for app_platform in platforms:
+        polling.budget.spend(polling.estimate_requests(app_platform, limit, len(app.countries(app_platform))))
+        tasks.append(ingestion.submit("interactive", "refresh", app_id, app_platform, limit))
+    return tasks
 
-            except Exception as e:
-                logger.error(f"更新应用 {app.id} 的评论失败: {str(e)}\n{traceback.format_exc()}")
+def poll_due_apps():
+    """把到期的应用加入抓取队列的 scheduled 通道，受每小时请求预算限制"""
+    db = SessionLocal()
+    try:
+        now = datetime.now()
+        polling.ensure_states(db, now)
+        open_stores, open_apps = circuit.blocked(db, now)
+        jobs = []
+        deferred = 0
+        due = polling.due_states(db, now)
+        apps = {app.id: app for app in db.query(App).filter(App.id.in_({state.app_id for state in due}))}
+        for state in due:
+            if state.platform in open_stores or (state.app_id, state.platform) in open_apps:
+                continue  # 熔断中，不占用请求预算
+            if ingestion.pending(db, state.app_id, state.platform):
+                continue  # 上一轮的任务还在排队或执行
+            app = apps.get(state.app_id)
+            countries = len(app.countries(state.platform)) if app else 1
+            limit = state.fetch_limit
+            cost = polling.estimate_requests(state.platform, limit, countries)
+            if cost > polling.budget.per_hour:
+                # 单次抓取就超过整小时的预算，永远放不下：按预算能覆盖的条数抓取
+                limit = polling.limit_for_requests(state.platform, polling.budget.per_hour, countries)
+                logger.warning(f"应用 {state.app_id} ({state.platform}) 预计 {cost} 次请求，超过每小时预算 "
+                               f"{polling.budget.per_hour}，本次只抓取 {limit} 条")
+                cost = min(polling.estimate_requests(state.platform, limit, countries), polling.budget.per_hour)
+            if not polling.budget.try_spend(cost):
+                # 预算不够这个应用，请求数更少的应用可能还放得下，继续检查；本应用顺延
+                deferred += 1
                 continue
-
-        logger.info("评论更新完成")
-        
+            jobs.append((state.app_id, state.platform, limit))
+        if deferred:
+            logger.info(f"本小时请求预算不足（剩余 {polling.budget.remaining()}），{deferred} 个到期应用顺延")
     except Exception as e:
-        logger.error(f"更新评论时出错: {str(e)}\n{traceback.format_exc()}")
+        logger.error(f"轮询应用时出错: {str(e)}\n{traceback.format_exc()}")
         db.rollback()
+        return
     finally:
         db.close()
 
-def update_latest_reviews(app_id: int, limit: int = 100):
+    for app_id, platform, limit in jobs:
+        ingestion.submit("scheduled", "poll", app_id, platform, limit)
+    if jobs:
+        logger.info(f"已将 {len(jobs)} 个到期的应用加入抓取队列")
+
+# 创建定时任务
+JOB_TABLE = "apscheduler_jobs"
+# 任务保存在数据库的 apscheduler_jobs 表中：重启后沿用持久化的下次执行时间；停机期间错过的
+# 执行在 SCHEDULER_MISFIRE_GRACE_SECONDS 内合并为一次补跑，超过则跳到下一个周期
+scheduler = BackgroundScheduler(
+    jobstores={"default": SQLAlchemyJobStore(engine=engine, tablename=JOB_TABLE)},
+    job_defaults={
+        "coalesce": True,
+        "max_instances": 1,
+        "misfire_grace_time": SCHEDULER_MISFIRE_GRACE_SECONDS,
+    },
+)
+
+# 周期任务最近一次的执行结果（只保存在内存中）
+job_runs: Dict[str, Dict[str, Any]] = {}
+
+def _record_job_run(event):
+    job_runs[event.job_id] = {
+        "last_run_at": event.scheduled_run_time.replace(tzinfo=None) if event.scheduled_run_time else None,
+        "status": "error" if event.exception else ("missed" if event.code == EVENT_JOB_MISSED else "ok"),
+        "error": str(event.exception) if event.exception else None,
+    }
+
+def ensure_job(job_id: str, func, trigger, name: str):
     """
-    更新最新的评论
-    :param app_id: 应用ID
-    :param limit: 获取的评论数量限制
+    登记周期任务。任务已存在时保留持久化的下次执行时间，只有触发规则变化时才重新计算；
+    trigger 为 None 时删除任务
     """
-    update_reviews(app_id=app_id, limit=limit)
+    job = scheduler.get_job(job_id)
+    if trigger is None:
+        if job:
+            scheduler.remove_job(job_id)
+        return
+    if job is None:
+        scheduler.add_job(func, trigger=trigger, id=job_id, name=name)
+    elif str(job.trigger) != str(trigger):
+        logger.info(f"任务 {job_id} 的触发规则由 {job.trigger} 变为 {trigger}，重新计算执行时间")
+        scheduler.reschedule_job(job_id, trigger=trigger)
 
-def save_reviews(db, app_id: int, reviews: list):
-    """保存评论到数据库"""
-    for review_data in reviews:
-        try:
-            existing_review = db.query(Review).filter(
-                Review.app_id == app_id,
-                Review.platform == review_data['platform'],
-                Review.author == review_data['author'],
-                Review.created_at == review_data['created_at']
-            ).first()
-            
-            if not existing_review:
-                new_review = Review(app_id=app_id, **review_data)
-                db.add(new_review)
-                db.commit()
-                
-        except Exception as e:
-            logger.error(f"保存评论失败: {str(e)}")
-            db.rollback()
+def _stored_jobs():
+    """本进程不是领导者时调度器没有运行，直接从任务表读取"""
+    store = SQLAlchemyJobStore(engine=engine, tablename=JOB_TABLE)
+    store.start(scheduler, "default")
+    return store.get_all_jobs()
 
-# 创建定时任务
-scheduler = BackgroundScheduler()
-# 每天凌晨2点增量更新最新评论
-scheduler.add_job(
-    lambda: update_reviews(limit=100),  # 每个平台获取最新100条评论
-    'cron',
-    hour=2,  # 凌晨2点执行
-    minute=0,
-    next_run_time=datetime.now() + timedelta(minutes=5)  # 启动5分钟后执行第一次
-)
-scheduler.start() 
\ No newline at end of file
+def list_jobs() -> List[Dict[str, Any]]:
+    """调度器中的任务及其下次、最近一次执行时间（最近一次执行只在领导者进程中有记录）"""
+    jobs = []
+    for job in (scheduler.get_jobs() if scheduler.running else _stored_jobs()):
+        run = job_runs.get(job.id, {})
+        jobs.append({
+            "id": job.id,
+            "name": job.name,
+            "trigger": str(job.trigger),
+            "next_run_at": job.next_run_time.replace(tzinfo=None) if job.next_run_time else None,
+            "last_run_at": run.get("last_run_at"),
+            "last_status": run.get("status"),
+            "last_error": run.get("error"),
+        })
+    return jobs
+
+def start_scheduler():
+    """启动或恢复调度器（成为领导者时调用）"""
+    if scheduler.state == STATE_STOPPED:
+        # 先以暂停状态启动以便读取已持久化的任务，登记完成后再恢复
+        scheduler.start(paused=True)
+        # 按评论增速自适应轮询各应用（取代每天凌晨2点统一抓取100条）
+        ensure_job("poll_due_apps", poll_due_apps, IntervalTrigger(minutes=POLL_TICK_MINUTES), "自适应轮询")
+        # 每天凌晨3点按保留策略归档旧评论
+        ensure_job("apply_retention", apply_retention, CronTrigger(hour=3, minute=0), "评论归档")
+        # 定期在线备份数据库
+        ensure_job(
+            "scheduled_backup",
+            scheduled_backup,
+            IntervalTrigger(hours=BACKUP_INTERVAL_HOURS) if BACKUP_INTERVAL_HOURS > 0 else None,
+            "数据库备份",
+        )
+        # 定期接手中断的应用清理任务
+        ensure_job("resume_purges", resume_stalled_purges, IntervalTrigger(minutes=10), "恢复应用清理")
+        # 恢复上次未完成的清理任务
+        purge.resume_purges()
+    scheduler.resume()
+    logger.info("定时调度器已启动")
+
+def pause_scheduler():
+    """暂停调度器（失去领导权时调用），不再触发新的任务"""
+    if scheduler.state == STATE_RUNNING:
+        scheduler.pause()
+        logger.info("定时调度器已暂停")
+
+def shutdown_scheduler():
+    if scheduler.state != STATE_STOPPED:
+        scheduler.shutdown(wait=False)
+
+def resume_stalled_purges():
+    purge.resume_purges(include_failed=False)
+
+scheduler.add_listener(_record_job_run, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+# 多进程部署时只有一个进程运行调度器
+election = LeaderElection("scheduler", on_elected=start_scheduler, on_demoted=pause_scheduler)
@@ -1,64 +1,206 @@
 from app_store_scraper import AppStore
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import Callable, Iterator, List, Dict, Any, Optional, Tuple
 from ..logger import setup_logger
 from ..exceptions import AppStoreError
+from ..config import APP_STORE_TOKEN_TTL_SECONDS, STORE_REQUEST_TIMEOUT_SECONDS
+from ..deadline import Deadline
+from ..records import ReviewRecord
+from ..runs import RunMetrics, timed
+from .. import circuit, httpclient, rawarchive
 from functools import wraps
+import requests
+import threading
+import time
 
 logger = setup_logger("app_store_scraper")
 
-def fetch_reviews(app_id: str, country: str = "cn", limit: int = None) -> List[Dict[str, Any]]:
+PAGE_SIZE = 20  # App Store 每页返回的评论数
+
+def _to_review(review: Dict[str, Any], country: str) -> Optional[ReviewRecord]:
+    """转换为评论记录，日期格式无法识别时返回 None"""
+    # 检查日期格式
+    created_at = review['date']
+    if isinstance(created_at, str):
+        created_at = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+    elif not isinstance(created_at, datetime):
+        logger.warning(f"未知的日期格式: {created_at}, type: {type(created_at)}")
+        return None
+    return ReviewRecord('ios', review['rating'], review['review'], review['userName'], created_at, country)
+
+class _TokenCache:
+    """
+    App Store 网页的 bearer token 与应用、国家无关，在进程内缓存 APP_STORE_TOKEN_TTL_SECONDS，
+    每次抓取不必再请求一次应用页面；并发的请求只有一个去获取，其余等待结果
+    """
+
+    def __init__(self, ttl: float = APP_STORE_TOKEN_TTL_SECONDS):
+        self.ttl = ttl
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, fetch: Callable[[], Optional[str]]) -> Optional[str]:
+        with self._lock:
+            if self._token and time.monotonic() < self._expires_at:
+                return self._token
+            token = fetch()
+            if token:
+                self._token, self._expires_at = token, time.monotonic() + self.ttl
+            return token
+
+    def invalidate(self, token: Optional[str]) -> None:
+        """token 失效（401）时丢弃，已被其他线程刷新的不受影响"""
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+_token_cache = _TokenCache()
+
+class _Client(AppStore):
     """
-    获取 App Store 评论
+    app_store_scraper 每个请求都新建连接且没有超时，响应卡住时会一直等待；这里改为：
+    - 使用共享的连接池，每个请求带超时；
+    - 经过 App Store 的限速器（429/5xx 时降速，按 Retry-After 暂停后重试）；
+    - token 从缓存获取，401 时刷新一次
+    """
+
+    def __init__(self, timeout: float = STORE_REQUEST_TIMEOUT_SECONDS, **kwargs):
+        self.timeout = timeout  # 构造时就会获取 token，需要先设置
+        super().__init__(**kwargs)
+
+    def _token(self):
+        return _token_cache.get(super()._token)
+
+    def _get(self, url, headers=None, params=None, **kwargs):
+        self._response = httpclient.request("ios", "GET", url, self.timeout, headers=headers, params=params)
+        if self._response.status_code == 401 and headers:
+            # 缓存的 token 已过期：刷新后重试一次
+            _token_cache.invalidate(headers.get("Authorization"))
+            headers["Authorization"] = self._token()
+            self._response = httpclient.request("ios", "GET", url, self.timeout, headers=headers, params=params)
+
+def open_client(app_id: str, country: str = "cn", timeout: Optional[float] = None) -> AppStore:
+    """创建 App Store 客户端（token 未缓存时会请求一次应用页面获取），用于逐页抓取"""
+    if not app_id.isdigit():
+        raise AppStoreError(f"无效的 App Store ID: {app_id}", not_found=True)
+    try:
+        return _Client(timeout=timeout or STORE_REQUEST_TIMEOUT_SECONDS,
+                       country=country.lower(), app_id=app_id, app_name="temp")
+    except Exception as e:
+        raise AppStoreError(f"初始化 App Store 客户端失败: {str(e)}", transient=circuit.is_transient(e))
+
+def fetch_page(client: AppStore, offset: int = 0, metrics: Optional[RunMetrics] = None,
+               timeout: Optional[float] = None) -> Tuple[List[ReviewRecord], Optional[int]]:
+    """
+    抓取一页评论（PAGE_SIZE 条）
+    :param timeout: 本次请求的超时秒数，默认 STORE_REQUEST_TIMEOUT_SECONDS
+    :return: (评论列表, 下一页的 offset；没有下一页时为 None)
+    """
+    client.reviews = []
+    client.reviews_count = 0
+    client._request_params["offset"] = offset  # 保留 app_store_scraper 的其他参数（limit、platform 等）
+    client._request_offset = offset  # 解析失败时 app_store_scraper 不更新，据此判断
+    client.timeout = timeout or STORE_REQUEST_TIMEOUT_SECONDS
+    client._response = requests.Response()
+    with timed(metrics, "fetch"):
+        # app_store_scraper 会吞掉请求和解析的异常（包括超时），需要自己检查响应
+        client.review(how_many=1)
+    response = client._response
+    if response.status_code is None:
+        raise AppStoreError(f"App Store 评论请求超时或连接失败: offset={offset}", transient=True)
+    if response.status_code != 200:
+        raise AppStoreError(f"App Store 评论请求失败: status={response.status_code}, offset={offset}",
+                            transient=circuit.transient_status(response.status_code),
+                            not_found=response.status_code == 404)
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict) or not isinstance(body.get("data"), list):
+        raise AppStoreError(f"App Store 评论响应无法解析: offset={offset}")
+    next_offset = client._request_offset
+    if next_offset is not None and next_offset <= offset:
+        # 解析中途出错，或响应中的下一页位置没有前进：继续请求只会一直重复这一页
+        raise AppStoreError(f"App Store 评论响应解析失败或下一页位置没有前进: offset={offset}, next={next_offset}")
+    rawarchive.record(metrics, client.country, response.content, offset=offset)
+    with timed(metrics, "parse"):
+        page = [item for item in (_to_review(review, client.country) for review in client.reviews) if item is not None]
+    if metrics is not None:
+        metrics.pages += 1
+        metrics.fetched += len(page)
+    return page, next_offset
+
+def iter_reviews(app_id: str, country: str = "cn", limit: int = None,
+                 metrics: Optional[RunMetrics] = None, cursor: Optional[Dict[str, Any]] = None,
+                 deadline: Optional[Deadline] = None) -> Iterator[Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]]:
+    """
+    按页获取 App Store 评论，每抓到一页就产出，不在内存中累积。通过 app_store_scraper 逐页串行请求，
+    并发请求的方式见 app_store_concurrent，抓取时使用哪种由 scrapers/backends 选择
     :param app_id: App Store ID
     :param country: 国家/地区代码
-    :param limit: 限制获取的评论数量
+    :param limit: 限制获取的评论数量（最多 3000），不限时抓取全部历史
+    :param metrics: 记录请求和解析耗时
+    :param cursor: 从上次中断的位置继续
+    :param deadline: 截止时间，到期后停止
+    :return: 依次产出 (一页评论, 这一页之后继续抓取的位置；抓取完整时为 None)。中途失败或到达截止时间时
+             最后产出 ([], 继续抓取的位置)；一页都没抓到就失败时抛出异常
     """
     try:
-        logger.info(f"开始获取 App Store 评论: app_id={app_id}, country={country}, limit={limit}")
-        
-        # 检查 app_id 格式
-        if not app_id.isdigit():
-            raise ValueError(f"无效的 App Store ID: {app_id}")
-        
-        app = AppStore(
-            country=country.lower(),
-            app_id=app_id,
-            app_name="temp"  # app_name 是必需的，但实际上我们不需要它
-        )
-        
-        # 打印请求信息
-        logger.info(f"App Store 请求参数: country={country}, app_id={app_id}, limit={limit}")
-        # 获取评论前记录
-        logger.info("开始发送 App Store 评论请求...")
-        how_many = min(limit, 3000) if limit else 3000  # 限制最大获取数量为3000
-        app.review(how_many=how_many)
-        logger.info(f"App Store 评论请求完成，评论数={app.reviews_count}")
-        reviews = []
-        
-        for review in app.reviews:
-            # 检查日期格式
-            created_at = review['date']
-            if isinstance(created_at, str):
-                created_at = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
-            elif not isinstance(created_at, datetime):
-                logger.warning(f"未知的日期格式: {created_at}, type: {type(created_at)}")
-                continue
-            
-            reviews.append({
-                'platform': 'ios',
-                'rating': review['rating'],
-                'content': review['review'],
-                'author': review['userName'],
-                'created_at': created_at
-            })
-            
-            if limit and len(reviews) >= limit:
-                break
-        
-        logger.info(f"成功获取 {len(reviews)} 条 App Store 评论")
-        return reviews
-        
+        logger.info(f"开始获取 App Store 评论: app_id={app_id}, country={country}, limit={limit}, cursor={cursor}")
+        deadline = deadline or Deadline(None)
+        with timed(metrics, "fetch"):
+            client = circuit.call_with_retry(
+                lambda: open_client(app_id, country, deadline.timeout()), deadline, "App Store 获取 token"
+            )
+
+        # 指定条数时最多获取 3000 条；不限条数（全量抓取）时翻到最后一页
+        how_many = min(limit, 3000) if limit else None
+        offset = cursor["offset"] if cursor else 0
+        fetched = 0
+        while True:
+            if deadline.expired():
+                logger.warning(f"App Store 抓取达到截止时间: app_id={app_id}, 已获取 {fetched} 条, offset={offset}")
+                yield [], {"offset": offset}
+                return
+            try:
+                page, next_offset = circuit.call_with_retry(
+                    lambda: fetch_page(client, offset, metrics, deadline.timeout()), deadline, "App Store 评论请求"
+                )
+            except AppStoreError as e:
+                if not fetched:
+                    raise
+                # 已抓取的部分已经交给写入方，下次从失败的位置继续
+                logger.warning(f"App Store 抓取中断: app_id={app_id}, 已获取 {fetched} 条, offset={offset}: {str(e)}")
+                if metrics is not None:
+                    metrics.interrupted = e
+                yield [], {"offset": offset}
+                return
+            if how_many is not None:
+                page = page[:how_many - fetched]
+            fetched += len(page)
+            if next_offset is None or (how_many is not None and fetched >= how_many):
+                logger.info(f"成功获取 {fetched} 条 App Store 评论")
+                yield page, None
+                return
+            offset = next_offset
+            yield page, {"offset": offset}
+
+    except AppStoreError as e:
+        logger.error(str(e))
+        raise
     except Exception as e:
         logger.error(f"从 App Store 获取评论失败: {str(e)}")
-        raise AppStoreError(f"从 App Store 获取评论失败: {str(e)}") 
\ No newline at end of file
+        raise AppStoreError(f"从 App Store 获取评论失败: {str(e)}", transient=circuit.is_transient(e))
+
+def fetch_reviews(app_id: str, country: str = "cn", limit: int = None,
+                  metrics: Optional[RunMetrics] = None, cursor: Optional[Dict[str, Any]] = None,
+                  deadline: Optional[Deadline] = None) -> Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]:
+    """
+    获取 App Store 评论，参数同 iter_reviews，把所有页合并后返回
+    :return: (评论列表, 中断时继续抓取的位置；抓取完整时为 None)
+    """
+    reviews, resume = [], None
+    for page, resume in iter_reviews(app_id, country, limit, metrics, cursor, deadline):
+        reviews.extend(page)
+    return reviews, resume
@@ -0,0 +1,221 @@
+"""
+App Store 评论的并发客户端
+
+app_store_scraper 逐页串行请求（每页 20 条），3000 条评论要连续发出 150 个请求。这里直接调用评论接口：
+各页的 offset 可以事先算出（0、20、40……），最多 APP_STORE_CONCURRENCY 个请求同时进行，请求仍经过
+App Store 的限速器；响应直接解析为评论记录（ReviewRecord），按 offset 顺序逐页产出。
+
+请求是阻塞的 requests 调用，在线程池中通过共享的连接池发出，用 concurrent.futures.wait 等待先完成的请求。
+"""
+import itertools
+import re
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from ..config import APP_STORE_CONCURRENCY
+from ..deadline import Deadline
+from ..exceptions import AppStoreError
+from ..logger import setup_logger
+from ..records import ReviewRecord
+from ..runs import RunMetrics, timed
+from .. import circuit, httpclient, rawarchive
+from .app_store import PAGE_SIZE, _token_cache
+
+logger = setup_logger("app_store_concurrent")
+
+LANDING_URL = "https://apps.apple.com/{country}/app/temp/id{app_id}"
+REVIEWS_URL = "https://amp-api.apps.apple.com/v1/catalog/{country}/apps/{app_id}/reviews"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+TOKEN_PATTERN = re.compile(r"token%22%3A%22(.+?)%22")
+MAX_REVIEWS = 3000  # 指定条数时最多获取的条数
+
+
+def _fetch_token(app_id: str, country: str, timeout: float) -> str:
+    """从应用页面中取出 bearer token"""
+    response = httpclient.request("ios", "GET", LANDING_URL.format(country=country, app_id=app_id), timeout,
+                                  headers={"User-Agent": USER_AGENT})
+    if response.status_code == 404:
+        raise AppStoreError(f"App Store 应用不存在: {app_id}", not_found=True)
+    if response.status_code != 200:
+        raise AppStoreError(f"获取 App Store token 失败: status={response.status_code}",
+                            transient=circuit.transient_status(response.status_code))
+    match = TOKEN_PATTERN.search(response.text)
+    if not match:
+        raise AppStoreError("App Store 页面中没有找到 token")
+    return f"bearer {match.group(1)}"
+
+
+def _get_page(app_id: str, country: str, offset: int, timeout: float,
+              metrics: Optional[RunMetrics] = None) -> Dict[str, Any]:
+    """请求一页评论，返回接口的 JSON；401 时刷新 token 重试一次。原始响应存入 metrics 对应的存档"""
+    params = {
+        "l": "en-GB",
+        "offset": offset,
+        "limit": PAGE_SIZE,
+        "platform": "web",
+        "additionalPlatforms": "appletv,ipad,iphone,mac",
+    }
+    for attempt in range(2):
+        token = _token_cache.get(lambda: _fetch_token(app_id, country, timeout))
+        headers = {
+            "Accept": "application/json",
+            "Authorization": token,
+            "Origin": "https://apps.apple.com",
+            "Referer": LANDING_URL.format(country=country, app_id=app_id),
+            "User-Agent": USER_AGENT,
+        }
+        try:
+            response = httpclient.request("ios", "GET", REVIEWS_URL.format(country=country, app_id=app_id), timeout,
+                                          headers=headers, params=params)
+        except requests.RequestException as e:
+            raise AppStoreError(f"App Store 评论请求超时或连接失败: offset={offset}: {str(e)}",
+                                transient=circuit.is_transient(e))
+        if response.status_code == 401 and attempt == 0:
+            _token_cache.invalidate(token)
+            continue
+        if response.status_code != 200:
+            raise AppStoreError(f"App Store 评论请求失败: status={response.status_code}, offset={offset}",
+                                transient=circuit.transient_status(response.status_code),
+                                not_found=response.status_code == 404)
+        rawarchive.record(metrics, country, response.content, offset=offset)
+        return response.json()
+
+
+def _parse(data: Dict[str, Any], country: str) -> List[ReviewRecord]:
+    """把接口返回的一页转换为评论记录（日期与 app_store_scraper 一致，按原样保存为不带时区的 UTC 时间）"""
+    return [
+        ReviewRecord('ios', review['rating'], review['review'], review['userName'],
+                     datetime.strptime(review['date'], '%Y-%m-%dT%H:%M:%SZ'), country)
+        for review in (item["attributes"] for item in data.get("data", []))
+    ]
+
+
+def iter_reviews(app_id: str, country: str = "cn", limit: int = None,
+                 metrics: Optional[RunMetrics] = None, cursor: Optional[Dict[str, Any]] = None,
+                 deadline: Optional[Deadline] = None,
+                 concurrency: int = APP_STORE_CONCURRENCY) -> Iterator[Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]]:
+    """
+    按页获取 App Store 评论，参数和产出与 app_store.iter_reviews 相同
+
+    按 offset 的顺序并发请求，同时进行的请求不超过 concurrency 个；各页按 offset 顺序产出（先返回的后面的页
+    暂存，最多 concurrency 页）。某页没有下一页时不再发出之后的请求；有请求失败或到达截止时间时停止发出新请求，
+    进行中的请求结束后，失败位置之后已抓到的页也会产出（写入时去重），下次从第一个没有抓到的页继续
+    :param concurrency: 同时进行的请求数
+    """
+    if not app_id.isdigit():
+        raise AppStoreError(f"无效的 App Store ID: {app_id}", not_found=True)
+    logger.info(f"开始获取 App Store 评论: app_id={app_id}, country={country}, limit={limit}, cursor={cursor}")
+    deadline = deadline or Deadline(None)
+    country = country.lower()
+    how_many = min(limit, MAX_REVIEWS) if limit else None  # 不限条数（全量抓取）时翻到最后一页
+    start = cursor["offset"] if cursor else 0
+    stop_at = start + how_many if how_many else None  # 最后一页之后的 offset（按条数上限）
+    concurrency = max(concurrency, 1)
+
+    def fetch(offset: int) -> Dict[str, Any]:
+        return circuit.call_with_retry(
+            lambda: _get_page(app_id, country, offset, deadline.timeout(), metrics), deadline, "App Store 评论请求"
+        )
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="app-store")
+    pending = iter(range(start, stop_at, PAGE_SIZE)) if stop_at is not None else itertools.count(start, PAGE_SIZE)
+    in_flight: Dict[Future, int] = {}
+    pages: Dict[int, Dict[str, Any]] = {}  # 已抓到、还没产出的页
+    failed: Dict[int, Exception] = {}
+    end: Optional[int] = None  # 没有下一页的那一页之后的 offset
+    stopped = False
+    position = start  # 下一个要产出的页
+    fetched = 0
+    try:
+        while True:
+            while not stopped and len(in_flight) < concurrency:
+                offset = next(pending, None)
+                if offset is None or (end is not None and offset >= end) or deadline.expired():
+                    stopped = True
+                    break
+                in_flight[executor.submit(fetch, offset)] = offset
+            if not in_flight:
+                break
+            with timed(metrics, "fetch"):
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                offset = in_flight.pop(future)
+                if metrics is not None:
+                    metrics.pages += 1
+                if future.exception() is not None:
+                    failed[offset] = future.exception()
+                    stopped = True
+                    continue
+                data = future.result()
+                pages[offset] = data
+                if not data.get("next"):
+                    end = min(end, offset + PAGE_SIZE) if end is not None else offset + PAGE_SIZE
+
+            # 已连续抓到的页按顺序产出
+            while position in pages:
+                with timed(metrics, "parse"):
+                    page = _parse(pages.pop(position), country)
+                if how_many is not None:
+                    page = page[:how_many - fetched]
+                position += PAGE_SIZE
+                fetched += len(page)
+                if metrics is not None:
+                    metrics.fetched += len(page)
+                last = min((offset for offset in (end, stop_at) if offset is not None), default=None)
+                if last is not None and position >= last:
+                    logger.info(f"成功获取 {fetched} 条 App Store 评论")
+                    yield page, None
+                    return
+                yield page, {"offset": position}
+
+        # 中断：position 是第一个没有抓到的页，之后已抓到的页也产出，下次从 position 继续
+        resume = {"offset": position}
+        for offset in sorted(pages):
+            if end is None or offset < end:
+                with timed(metrics, "parse"):
+                    page = _parse(pages.pop(offset), country)
+                fetched += len(page)
+                if metrics is not None:
+                    metrics.fetched += len(page)
+                yield page, resume
+    except AppStoreError:
+        raise
+    except Exception as e:
+        logger.error(f"从 App Store 获取评论失败: {str(e)}")
+        raise AppStoreError(f"从 App Store 获取评论失败: {str(e)}", transient=circuit.is_transient(e))
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if failed:
+        error = failed[min(failed)]
+        if not isinstance(error, AppStoreError):
+            error = AppStoreError(f"从 App Store 获取评论失败: {str(error)}", transient=circuit.is_transient(error))
+        if not fetched:
+            logger.error(str(error))
+            raise error
+        logger.warning(f"App Store 抓取中断: app_id={app_id}, 已获取 {fetched} 条, offset={position}: {str(error)}")
+        if metrics is not None:
+            metrics.interrupted = error
+    else:
+        logger.warning(f"App Store 抓取达到截止时间: app_id={app_id}, 已获取 {fetched} 条, offset={position}")
+    yield [], resume
+
+
+def fetch_reviews(app_id: str, country: str = "cn", limit: int = None,
+                  metrics: Optional[RunMetrics] = None, cursor: Optional[Dict[str, Any]] = None,
+                  deadline: Optional[Deadline] = None,
+                  concurrency: int = APP_STORE_CONCURRENCY) -> Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]:
+    """
+    获取 App Store 评论，参数和返回值与 app_store.fetch_reviews 相同
+    :param concurrency: 同时进行的请求数
+    :return: (评论列表, 中断时继续抓取的位置；抓取完整时为 None)
+    """
+    reviews, resume = [], None
+    for page, resume in iter_reviews(app_id, country, limit, metrics, cursor, deadline, concurrency):
+        reviews.extend(page)
+    return reviews, resume
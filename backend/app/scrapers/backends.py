@@ -0,0 +1,153 @@
+"""
+抓取方式（后端）的注册表
+
+每个商店可以有多种抓取方式，如基于第三方库逐页抓取、内置的并发客户端、从原始响应存档回放。每种方式声明
+适用的商店、相对速度和能力：
+
+    incremental  支持续传：中断时产出继续抓取的位置，下次从该位置继续（同一商店的方式使用相同格式的位置）；
+                 全量抓取（backfill）要求支持续传
+    live         向商店发出请求；为 False 的方式（如回放）只在 SCRAPER_BACKENDS 中指定时使用
+
+抓取（sync.ReviewStream）和全量抓取（backfill）都按商店调用 select()：SCRAPER_BACKENDS 为该商店指定了方式时
+使用指定的方式，否则在可用、满足要求（续传时要求 incremental）的方式中选 speed 最大的。新增数据来源（如 RSS、
+新的商店）只需实现 ScraperBackend 并调用 register()，不需要修改调度和写入的代码。
+"""
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from ..config import RAW_ARCHIVE_DIR, SCRAPER_BACKENDS
+from ..deadline import Deadline
+from ..logger import setup_logger
+from ..records import ReviewRecord
+from ..runs import RunMetrics
+
+logger = setup_logger("scraper_backends")
+
+
+class Capabilities:
+    def __init__(self, incremental: bool = False, live: bool = True):
+        self.incremental = incremental
+        self.live = live
+
+    def __repr__(self):
+        return "Capabilities(" + ", ".join(f"{name}={value}" for name, value in vars(self).items()) + ")"
+
+
+class ScraperBackend:
+    """
+    一种抓取方式。iter_reviews 的参数和产出与 scrapers 中各模块的 iter_reviews 相同：依次产出
+    (一页评论, 这一页之后继续抓取的位置；抓取完整时为 None)，中途失败或到达截止时间时最后产出
+    ([], 继续抓取的位置)，一页都没抓到就失败时抛出异常。limit 为 None 时抓取全部历史。
+    发出的请求数累计到 metrics.pages（全量抓取据此限速）
+    """
+    name = ""
+    store = ""  # 平台：ios / android
+    speed = 0  # 相对速度，自动选择时取最大的
+    capabilities = Capabilities()
+
+    def available(self) -> bool:
+        """依赖的库或数据是否可用"""
+        return True
+
+    def iter_reviews(self, app, country: str, limit: Optional[int], metrics: Optional[RunMetrics],
+                     cursor: Optional[Dict[str, Any]], deadline: Optional[Deadline]
+                     ) -> Iterator[Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]]:
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"<{self.store}/{self.name}>"
+
+
+_backends: Dict[str, Dict[str, ScraperBackend]] = {}
+_RENAMED = {"async": "concurrent"}  # 改名前的抓取方式名称，兼容旧配置
+
+
+def register(backend: ScraperBackend) -> ScraperBackend:
+    """注册一种抓取方式，同一商店同名的方式会被替换"""
+    _backends.setdefault(backend.store, {})[backend.name] = backend
+    return backend
+
+
+def backends(store: str) -> List[ScraperBackend]:
+    """该商店已注册的抓取方式，按速度从快到慢"""
+    return sorted(_backends.get(store, {}).values(), key=lambda backend: backend.speed, reverse=True)
+
+
+def select(store: str, resume: bool = False) -> ScraperBackend:
+    """
+    为商店选择抓取方式
+    :param resume: 要从上次中断的位置继续，需要支持续传
+    """
+    name = SCRAPER_BACKENDS.get(store)
+    name = _RENAMED.get(name, name)
+    if name:
+        backend = _backends.get(store, {}).get(name)
+        if backend is not None and backend.available():
+            return backend
+        logger.error(f"SCRAPER_BACKENDS 指定的抓取方式 {store}={name} 不存在或不可用，改为自动选择")
+    candidates = [backend for backend in backends(store) if backend.capabilities.live and backend.available()]
+    if not candidates:
+        raise ValueError(f"没有可用于 {store} 的抓取方式")
+    if resume:
+        for backend in candidates:
+            if backend.capabilities.incremental:
+                return backend
+    return candidates[0]
+
+
+class AppStoreScraperBackend(ScraperBackend):
+    """app_store_scraper 逐页串行抓取"""
+    name = "scraper"
+    store = "ios"
+    speed = 1
+    capabilities = Capabilities(incremental=True)
+
+    def iter_reviews(self, app, country, limit, metrics, cursor, deadline):
+        from . import app_store
+        return app_store.iter_reviews(app.app_store_id, country, limit, metrics, cursor, deadline)
+
+
+class AppStoreConcurrentBackend(ScraperBackend):
+    """内置客户端并发请求各页（见 app_store_concurrent）"""
+    name = "concurrent"
+    store = "ios"
+    speed = 10
+    capabilities = Capabilities(incremental=True)
+
+    def iter_reviews(self, app, country, limit, metrics, cursor, deadline):
+        from . import app_store_concurrent
+        return app_store_concurrent.iter_reviews(app.app_store_id, country, limit, metrics, cursor, deadline)
+
+
+class PlayLibraryBackend(ScraperBackend):
+    """google_play_scraper 按 continuation token 逐页抓取，全量抓取时按星级分区并发（见 PLAY_PARTITIONED_CRAWL）"""
+    name = "library"
+    store = "android"
+    speed = 10
+    capabilities = Capabilities(incremental=True)
+
+    def iter_reviews(self, app, country, limit, metrics, cursor, deadline):
+        from . import play_store
+        return play_store.iter_reviews(app.play_store_id, country, limit, metrics, cursor, deadline)
+
+
+class ReplayBackend(ScraperBackend):
+    """从原始响应存档回放（见 rawarchive.replay），不发出请求，用于离线调试和压测写入"""
+    name = "replay"
+    speed = 100
+    capabilities = Capabilities(live=False)
+
+    def __init__(self, store: str):
+        self.store = store
+
+    def available(self) -> bool:
+        return os.path.isdir(os.path.join(RAW_ARCHIVE_DIR, "runs"))
+
+    def iter_reviews(self, app, country, limit, metrics, cursor, deadline):
+        from .. import rawarchive
+        return rawarchive.replay(app.id, self.store, country, limit, metrics)
+
+
+for _backend in (AppStoreScraperBackend(), AppStoreConcurrentBackend(), PlayLibraryBackend(),
+                 ReplayBackend("ios"), ReplayBackend("android")):
+    register(_backend)
@@ -1,79 +1,368 @@
 from google_play_scraper import Sort, reviews_all, reviews
 from datetime import datetime, timezone
-from typing import List, Dict, Any
+from google_play_scraper.features import reviews as reviews_feature
+from google_play_scraper.constants.element import ElementSpecs
+from google_play_scraper.constants.regex import Regex
+from google_play_scraper.features.reviews import MAX_COUNT_EACH_FETCH, _ContinuationToken
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Dict, Any, Optional, Sequence, Set, Tuple, Union
 from ..logger import setup_logger
 from ..exceptions import PlayStoreError
+from ..config import (
+    PLAY_PARTITION_CONCURRENCY, PLAY_PARTITION_SORTS, PLAY_PARTITIONED_CRAWL, STORE_REQUEST_TIMEOUT_SECONDS,
+)
+from ..deadline import Deadline
+from ..records import ReviewRecord
+from ..runs import RunMetrics, timed
+from .. import circuit, httpclient, rawarchive
+import copy
+import json
+import threading
 
 logger = setup_logger("play_store_scraper")
 
-def fetch_reviews(app_id: str, country: str = "cn", limit: int = None) -> List[Dict[str, Any]]:
+# 国家代码映射
+COUNTRY_LANG = {
+    "cn": ("cn", "zh-CN"),
+    "us": ("us", "en-US"),
+    "jp": ("jp", "ja-JP"),
+    "kr": ("kr", "ko-KR"),
+    "hk": ("hk", "zh-HK"),
+    "tw": ("tw", "zh-TW"),
+    "sg": ("sg", "en-SG"),
+    "my": ("my", "ms-MY"),
+    "id": ("id", "id-ID"),
+    "ph": ("ph", "en-PH"),
+    "mm": ("mm", "my-MM"),
+    "th": ("th", "th-TH"),
+    "vn": ("vn", "vi-VN")
+}
+
+PAGE_SIZE = MAX_COUNT_EACH_FETCH  # Play 每个请求最多返回的评论数
+
+# 分区全量抓取
+PARTITION_SCORES = (5, 4, 3, 2, 1)
+SORTS = {"newest": Sort.NEWEST, "most_relevant": Sort.MOST_RELEVANT}
+
+# 当前线程的请求超时，由 fetch_page 设置
+_request = threading.local()
+
+def _post(url: str, data: Union[str, bytes], headers: dict) -> str:
+    """
+    替换 google_play_scraper 的 post：原实现每次用 urlopen 新建连接且没有超时，响应卡住时会一直等待。
+    这里使用共享的连接池并带超时，请求经过 Google Play 的限速器（429/5xx 时降速，按 Retry-After 暂停后重试）
+    """
+    timeout = getattr(_request, "timeout", STORE_REQUEST_TIMEOUT_SECONDS)
+    resp = httpclient.request("android", "POST", url, timeout, data=data, headers=headers)
+    if resp.status_code == 404:
+        raise PlayStoreError("从 Play Store 获取评论失败: 应用不存在（404）", not_found=True)
+    if resp.status_code >= 400:
+        raise PlayStoreError(f"从 Play Store 获取评论失败: status={resp.status_code}",
+                             transient=circuit.transient_status(resp.status_code))
+    bodies = getattr(_request, "bodies", None)
+    if bodies is not None:
+        bodies.append(resp.content)  # 由 _request_page 存入原始响应存档
+    return resp.content.decode("UTF-8")
+
+reviews_feature.post = _post
+
+def parse_response(dom: str) -> List[Dict[str, Any]]:
+    """
+    把评论接口的原始响应解析为 google_play_scraper 格式的评论（与 reviews() 的解析相同），
+    用于从原始响应存档离线重新解析
+    """
+    try:
+        match = json.loads(Regex.REVIEWS.findall(dom)[0])
+        items = json.loads(match[0][2])[0]
+    except (TypeError, IndexError):
+        return []
+    return [{key: spec.extract_content(item) for key, spec in ElementSpecs.Review.items()} for item in items]
+
+def _to_review(review: Dict[str, Any], country: str) -> ReviewRecord:
+    # 确保 review['at'] 是时间戳
+    timestamp = review['at']
+    if isinstance(timestamp, datetime):
+        timestamp = int(timestamp.replace(tzinfo=timezone.utc).timestamp())
+    return ReviewRecord('android', review['score'], review['content'], review['userName'],
+                        datetime.fromtimestamp(timestamp), country)
+
+def _cursor(token: _ContinuationToken) -> Optional[Dict[str, Any]]:
+    """continuation token 转为可 JSON 序列化的游标，没有下一页时为 None"""
+    if token.token is None:
+        return None
+    return {
+        "token": token.token,
+        "lang": token.lang,
+        "country": token.country,
+        "sort": int(token.sort),
+        "count": token.count,
+        "filter_score_with": token.filter_score_with,
+    }
+
+def _request_page(app_id: str, country: str, cursor: Optional[Dict[str, Any]], timeout: Optional[float],
+                  score: Optional[int] = None, sort: Sort = Sort.NEWEST,
+                  metrics: Optional[RunMetrics] = None) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    请求一页，返回 google_play_scraper 的原始评论和下一页的游标；score 只抓取该星级的评论。
+    原始响应存入 metrics 对应的存档
+    """
+    # 排序方式以 int 传入：Python 3.11 起 str.format 把 Sort.NEWEST 格式化为 "Sort.NEWEST" 而不是 2，
+    # google_play_scraper 拼出的请求体无效
+    if cursor is not None:
+        token = _ContinuationToken(cursor["token"], cursor["lang"], cursor["country"], int(cursor["sort"]),
+                                   cursor["count"], cursor.get("filter_score_with"))
+    else:
+        country_code, lang = COUNTRY_LANG.get(country.lower(), (country.lower(), "en"))
+        token = None
+    _request.timeout = timeout or STORE_REQUEST_TIMEOUT_SECONDS
+    _request.bodies = [] if getattr(metrics, "raw", None) is not None else None
+    try:
+        if token is None:
+            result, next_token = reviews(app_id, lang=lang, country=country_code, sort=int(sort), count=PAGE_SIZE,
+                                         filter_score_with=score)
+        else:
+            result, next_token = reviews(app_id, continuation_token=token)
+    except PlayStoreError:
+        raise
+    except Exception as e:
+        raise PlayStoreError(f"从 Play Store 获取评论失败: {str(e)}", transient=circuit.is_transient(e))
+    finally:
+        bodies, _request.bodies = _request.bodies, None
+    for body in bodies or []:
+        rawarchive.record(metrics, country.lower(), body, score=score,
+                          sort=cursor["sort"] if cursor is not None else int(sort))
+    return result, _cursor(next_token)
+
+def _to_reviews(result: List[Dict[str, Any]], country: str) -> List[ReviewRecord]:
+    page = []
+    for review in result:
+        try:
+            page.append(_to_review(review, country.lower()))
+        except Exception as e:
+            logger.warning(f"处理评论时出错: {str(e)}, review={review}")
+    return page
+
+def fetch_page(app_id: str, country: str = "cn", cursor: Optional[Dict[str, Any]] = None,
+               metrics: Optional[RunMetrics] = None, timeout: Optional[float] = None
+               ) -> Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]:
     """
-    从 Google Play 抓取评论数据
+    按时间从新到旧抓取一页评论
+    :param cursor: 上一页返回的游标（可 JSON 序列化），为 None 时从最新的评论开始
+    :param timeout: 本次请求的超时秒数，默认 STORE_REQUEST_TIMEOUT_SECONDS
+    :return: (评论列表, 下一页的游标；没有下一页时为 None)
+    """
+    with timed(metrics, "fetch"):
+        result, next_cursor = _request_page(app_id, country, cursor, timeout, metrics=metrics)
+    with timed(metrics, "parse"):
+        page = _to_reviews(result, country)
+    if metrics is not None:
+        metrics.pages += 1
+        metrics.fetched += len(page)
+    return page, next_cursor
+
+def new_partitions(sorts: Sequence[str] = PLAY_PARTITION_SORTS) -> Dict[str, Dict[str, Any]]:
+    """
+    全量抓取的分区：每种排序方式 × 每个星级，key 为 "<星级>:<排序>"（如 5:newest），
+    值为该分区的游标和进度（可 JSON 序列化，用作续传位置）
+    """
+    sorts = [sort for sort in sorts if sort in SORTS] or ["newest"]
+    return {
+        f"{score}:{sort}": {"cursor": None, "done": False, "pages": 0, "fetched": 0, "error": None}
+        for sort in sorts for score in PARTITION_SCORES
+    }
+
+def partition_progress(partitions: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """各分区的进度（去掉游标）"""
+    return {key: {name: value for name, value in partition.items() if name != "cursor"}
+            for key, partition in partitions.items()}
+
+def _fetch_partition_page(app_id: str, country: str, key: str, cursor: Optional[Dict[str, Any]],
+                          deadline: Deadline, before_request: Optional[Callable[[], None]],
+                          metrics: Optional[RunMetrics] = None):
+    score, sort = key.split(":")
+    if before_request is not None:
+        before_request()
+    return circuit.call_with_retry(
+        lambda: _request_page(app_id, country, cursor, deadline.timeout(), int(score), SORTS[sort], metrics),
+        deadline, f"Play Store 评论请求（分区 {key}）"
+    )
+
+def fetch_partition_pages(app_id: str, country: str, partitions: Dict[str, Dict[str, Any]], keys: Sequence[str],
+                          deadline: Deadline, metrics: Optional[RunMetrics] = None, seen: Optional[Set[str]] = None,
+                          before_request: Optional[Callable[[], None]] = None,
+                          concurrency: int = PLAY_PARTITION_CONCURRENCY, max_per_partition: Optional[int] = None
+                          ) -> Tuple[List[ReviewRecord], Dict[str, PlayStoreError]]:
+    """
+    keys 中的分区各自并发抓取一页，原地更新 partitions 中的游标和进度
+    :param seen: 已抓到的评论 ID，按排序方式拆分的分区之间会有重复，据此去重
+    :param before_request: 每个请求前调用（如全量抓取的限速）
+    :param max_per_partition: 每个分区最多抓取的条数，达到后标记为完成；默认不限（抓取全部历史）
+    :return: (评论列表, 失败的分区 -> 异常)
+    """
+    seen = seen if seen is not None else set()
+    results, errors = {}, {}
+    with timed(metrics, "fetch"), ThreadPoolExecutor(max_workers=max(min(concurrency, len(keys)), 1)) as pool:
+        futures = {
+            key: pool.submit(_fetch_partition_page, app_id, country, key, partitions[key]["cursor"], deadline,
+                             before_request, metrics)
+            for key in keys
+        }
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except PlayStoreError as e:
+                errors[key] = e
+                partitions[key]["error"] = e.detail
+
+    page = []
+    with timed(metrics, "parse"):
+        for key, (result, next_cursor) in results.items():
+            partition = partitions[key]
+            partition["pages"] += 1
+            partition["fetched"] += len(result)
+            partition["cursor"] = next_cursor
+            partition["error"] = None
+            partition["done"] = next_cursor is None or not result or (
+                max_per_partition is not None and partition["fetched"] >= max_per_partition
+            )
+            fresh = [review for review in result if review.get("reviewId") not in seen]
+            seen.update(review.get("reviewId") for review in fresh)
+            page.extend(_to_reviews(fresh, country))
+    if metrics is not None:
+        metrics.pages += len(keys)
+        metrics.fetched += len(page)
+        metrics.partitions = partition_progress(partitions)
+    return page, errors
+
+def iter_reviews_partitioned(app_id: str, country: str = "cn", metrics: Optional[RunMetrics] = None,
+                             cursor: Optional[Dict[str, Any]] = None, deadline: Optional[Deadline] = None,
+                             sorts: Sequence[str] = PLAY_PARTITION_SORTS, max_per_partition: Optional[int] = None
+                             ) -> Iterator[Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]]:
+    """
+    全量抓取：按星级（以及 sorts 中的排序方式）拆成相互独立的 continuation token 链，每轮各抓取一页并产出，
+    直到各分区都翻到最后一页；结果按评论 ID 去重，各分区的进度记录到 metrics.partitions
+    :param cursor: 上次中断时返回的各分区位置，已完成的分区不再抓取
+    :param max_per_partition: 每个分区最多抓取的条数，默认不限
+    :return: 依次产出 (一轮的评论, 这一轮之后各分区继续抓取的位置；全部完成时为 None)
+    """
+    logger.info(f"开始分区抓取 Play Store 评论: app_id={app_id}, country={country}, resume={cursor is not None}")
+    deadline = deadline or Deadline(None)
+    partitions = copy.deepcopy(cursor["partitions"]) if cursor else new_partitions(sorts)
+    fetched = 0
+    seen = set()
+    failed = {}
+    while not deadline.expired():
+        # 本次失败的分区不再重试，下次从失败的位置继续
+        keys = [key for key, partition in partitions.items() if not partition["done"] and key not in failed]
+        if not keys:
+            break
+        page, errors = fetch_partition_pages(app_id, country, partitions, keys, deadline, metrics, seen,
+                                             max_per_partition=max_per_partition)
+        failed.update(errors)
+        fetched += len(page)
+        if all(partition["done"] for partition in partitions.values()):
+            logger.info(f"成功获取 {fetched} 条 Play Store 评论（{len(partitions)} 个分区）")
+            yield page, None
+            return
+        # 写入方可能还在处理这一轮时下一轮已开始更新分区，产出一份快照
+        yield page, {"partitions": copy.deepcopy(partitions)}
+
+    unfinished = [key for key, partition in partitions.items() if not partition["done"]]
+    if failed and not fetched:
+        error = next(iter(failed.values()))
+        logger.error(str(error))
+        raise error
+    logger.warning(f"Play Store 分区抓取未完成: app_id={app_id}, 已获取 {fetched} 条, 未完成的分区: {unfinished}")
+    if failed and metrics is not None:
+        metrics.interrupted = next(iter(failed.values()))
+    yield [], {"partitions": partitions}
+
+def fetch_reviews_partitioned(app_id: str, country: str = "cn", metrics: Optional[RunMetrics] = None,
+                              cursor: Optional[Dict[str, Any]] = None, deadline: Optional[Deadline] = None,
+                              sorts: Sequence[str] = PLAY_PARTITION_SORTS
+                              ) -> Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]:
+    """全量抓取，参数同 iter_reviews_partitioned，把所有轮次合并后返回 (评论列表, 续传位置)"""
+    reviews, resume = [], None
+    for page, resume in iter_reviews_partitioned(app_id, country, metrics, cursor, deadline, sorts):
+        reviews.extend(page)
+    return reviews, resume
+
+def iter_reviews(app_id: str, country: str = "cn", limit: int = None,
+                 metrics: Optional[RunMetrics] = None, cursor: Optional[Dict[str, Any]] = None,
+                 deadline: Optional[Deadline] = None) -> Iterator[Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]]:
+    """
+    按页从 Google Play 抓取评论，每抓到一页就产出，不在内存中累积
     
     参数:
         app_id: Play Store ID
         country: 国家/地区代码
-        limit: 限制获取的评论数量
+        limit: 限制获取的评论数量（最多 7000）；不限时抓取全部历史，开启 PLAY_PARTITIONED_CRAWL 时按星级分区并发抓取
+        metrics: 记录请求和解析耗时
+        cursor: 从上次中断的位置继续
+        deadline: 截止时间，到期后停止
+
+    产出:
+        (一页评论, 这一页之后继续抓取的位置；抓取完整时为 None)。中途失败或到达截止时间时最后产出
+        ([], 继续抓取的位置)；一页都没抓到就失败时抛出异常
     """
+    # 续传时沿用中断前的方式（分区或单个 continuation token）
+    if ("partitions" in cursor) if cursor is not None else (limit is None and PLAY_PARTITIONED_CRAWL):
+        yield from iter_reviews_partitioned(app_id, country, metrics, cursor, deadline)
+        return
     try:
-        logger.info(f"开始获取 Play Store 评论: app_id={app_id}, country={country}, limit={limit}")
-        
-        # 国家代码映射
-        country_lang = {
-            "cn": ("cn", "zh-CN"),
-            "us": ("us", "en-US"),
-            "jp": ("jp", "ja-JP"),
-            "kr": ("kr", "ko-KR"),
-            "hk": ("hk", "zh-HK"),
-            "tw": ("tw", "zh-TW"),
-            "sg": ("sg", "en-SG"),
-            "my": ("my", "ms-MY"),
-            "id": ("id", "id-ID"),
-            "ph": ("ph", "en-PH"),
-            "mm": ("mm", "my-MM"),
-            "th": ("th", "th-TH"),
-            "vn": ("vn", "vi-VN")
-        }
-        
-        country_code, lang = country_lang.get(country.lower(), ("us", "en-US"))
-        
-        # 打印请求参数
-        logger.info(f"Play Store 请求参数: lang={lang}, country={country_code}, sort=newest, count={limit or 7000}")
-        # 获取评论前记录
-        logger.info("开始发送 Play Store 评论请求...")
-        result, _ = reviews(
-            app_id,
-            count=min(limit, 7000) if limit else 7000,  # 限制最大获取数量为7000
-            continuation_token=None # defaults to None(load from the beginning)
-        )
-        logger.info("Play Store 评论请求完成")
-        
-        app_reviews = []
-        for review in result:
+        logger.info(f"开始获取 Play Store 评论: app_id={app_id}, country={country}, limit={limit}, "
+                    f"resume={cursor is not None}")
+        deadline = deadline or Deadline(None)
+        # 指定条数时最多获取 7000 条；不限条数（全量抓取）时翻到最后一页
+        how_many = min(limit, 7000) if limit else None
+
+        fetched = 0
+        while True:
+            if deadline.expired():
+                logger.warning(f"Play Store 抓取达到截止时间: app_id={app_id}, 已获取 {fetched} 条")
+                yield [], cursor
+                return
             try:
-                # 确保 review['at'] 是时间戳
-                timestamp = review['at']
-                if isinstance(timestamp, datetime):
-                    timestamp = int(timestamp.replace(tzinfo=timezone.utc).timestamp())
-                
-                app_reviews.append({
-                    'platform': 'android',
-                    'rating': review['score'],
-                    'content': review['content'],
-                    'author': review['userName'],
-                    'created_at': datetime.fromtimestamp(timestamp)
-                })
-                
-                if limit and len(app_reviews) >= limit:
-                    break
-                    
-            except Exception as e:
-                logger.warning(f"处理评论时出错: {str(e)}, review={review}")
-                continue
-        
-        logger.info(f"成功获取 {len(app_reviews)} 条 Play Store 评论")
-        return app_reviews
+                page, next_cursor = circuit.call_with_retry(
+                    lambda: fetch_page(app_id, country, cursor, metrics, deadline.timeout()), deadline,
+                    "Play Store 评论请求"
+                )
+            except PlayStoreError as e:
+                if not fetched:
+                    raise
+                # 已抓取的部分已经交给写入方，下次从失败的位置继续
+                logger.warning(f"Play Store 抓取中断: app_id={app_id}, 已获取 {fetched} 条: {str(e)}")
+                if metrics is not None:
+                    metrics.interrupted = e
+                yield [], cursor
+                return
+            if how_many is not None:
+                page = page[:how_many - fetched]
+            fetched += len(page)
+            if next_cursor is None or not page or (how_many is not None and fetched >= how_many):
+                logger.info(f"成功获取 {fetched} 条 Play Store 评论")
+                yield page, None
+                return
+            cursor = next_cursor
+            yield page, cursor
         
+    except PlayStoreError as e:
+        logger.error(str(e))
+        raise
     except Exception as e:
         logger.error(f"从 Play Store 获取评论失败: {str(e)}")
-        raise PlayStoreError(f"从 Play Store 获取评论失败: {str(e)}") 
\ No newline at end of file
+        raise PlayStoreError(f"从 Play Store 获取评论失败: {str(e)}", transient=circuit.is_transient(e))
+
+def fetch_reviews(app_id: str, country: str = "cn", limit: int = None,
+                  metrics: Optional[RunMetrics] = None, cursor: Optional[Dict[str, Any]] = None,
+                  deadline: Optional[Deadline] = None) -> Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]:
+    """
+    从 Google Play 抓取评论数据，参数同 iter_reviews，把所有页合并后返回
+
+    返回:
+        (评论列表, 中断时继续抓取的位置；抓取完整时为 None)
+    """
+    reviews, resume = [], None
+    for page, resume in iter_reviews(app_id, country, limit, metrics, cursor, deadline):
+        reviews.extend(page)
+    return reviews, resume
@@ -0,0 +1,257 @@
+"""
+评论全文检索
+
+基于 SQLite FTS5 建立 review_fts 索引。FTS5 自带的 unicode61 分词器会把一整段
+连续的中文当成一个词，trigram 分词器又无法匹配两个字的查询（如"闪退"），因此这里
+在 Python 侧把中日韩文字切成重叠的二元组（bigram），再交给 unicode61 建索引：
+
+    "闪退严重" -> "闪退 退严 严重 重"
+
+每段连续 CJK 文字末尾额外保留一个单字，使单字查询可以用前缀匹配 ("闪" *) 命中。
+查询时使用同样的切分方式生成短语查询，相邻 bigram 必须连续出现，语义等价于子串匹配。
+"""
+import html
+import re
+from typing import Dict, List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Connection, Engine
+
+from .logger import setup_logger
+from .models import Review
+from . import compression
+
+logger = setup_logger("search")
+
+FTS_TABLE = "review_fts"
+INDEX_BATCH_SIZE = 1000
+
+# 中日韩统一表意文字、日文假名、韩文音节
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_TOKEN_RE = re.compile(rf"([{_CJK}]+)|([^\W{_CJK}]+)")
+_CJK_RE = re.compile(rf"[{_CJK}]")
+
+# 每个进程只检查一次索引表是否存在
+_index_ready: Optional[bool] = None
+
+
+def _cjk_bigrams(run: str) -> List[str]:
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(content: Optional[str]) -> str:
+    """把评论内容转换为写入 FTS 索引的分词文本"""
+    if not content:
+        return ""
+    tokens = []
+    for cjk, word in _TOKEN_RE.findall(content):
+        if cjk:
+            tokens.extend(_cjk_bigrams(cjk))
+            if len(cjk) > 1:
+                tokens.append(cjk[-1])
+        else:
+            tokens.append(word)
+    return " ".join(tokens)
+
+
+def _query_terms(q: str) -> List[str]:
+    """拆分用户输入，去掉标点，只保留可检索的片段"""
+    return [cjk or word for cjk, word in _TOKEN_RE.findall(q)]
+
+
+def build_match_query(app_id: int, q: str) -> Optional[str]:
+    """
+    构造 FTS5 MATCH 表达式，多个关键词之间为 AND 关系
+    返回 None 表示查询中没有可检索的内容
+    """
+    phrases = []
+    for term in q.split():
+        tokens = []
+        for cjk, word in _TOKEN_RE.findall(term):
+            tokens.extend(_cjk_bigrams(cjk) if cjk else [word])
+        if not tokens:
+            continue
+        if len(tokens) == 1 and len(tokens[0]) == 1 and _CJK_RE.match(tokens[0]):
+            # 单个汉字：匹配以它开头的 bigram 或段末的单字
+            phrases.append(f'"{tokens[0]}" *')
+        else:
+            phrases.append('"' + " ".join(tokens) + '"')
+    if not phrases:
+        return None
+    return f"app_key : app{int(app_id)} AND tokens : ({' AND '.join(phrases)})"
+
+
+def highlight(content: Optional[str], q: str, tag: str = "mark") -> str:
+    """对命中的关键词加上高亮标签，内容会先做 HTML 转义"""
+    if not content:
+        return ""
+    terms = sorted(set(_query_terms(q)), key=len, reverse=True)
+    if not terms:
+        return html.escape(content)
+    pattern = re.compile("|".join(re.escape(t) for t in terms), re.IGNORECASE)
+    parts = []
+    last = 0
+    for match in pattern.finditer(content):
+        parts.append(html.escape(content[last:match.start()]))
+        parts.append(f"<{tag}>{html.escape(match.group(0))}</{tag}>")
+        last = match.end()
+    parts.append(html.escape(content[last:]))
+    return "".join(parts)
+
+
+def _has_index(connection: Connection) -> bool:
+    global _index_ready
+    if _index_ready is None:
+        if connection.dialect.name != "sqlite":
+            _index_ready = False
+        else:
+            _index_ready = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": FTS_TABLE},
+            ).first() is not None
+    return _index_ready
+
+
+def index_rows(connection: Connection, rows: List[Dict]) -> None:
+    """批量写入索引，rows 需包含 id、app_id、content"""
+    if not rows or not _has_index(connection):
+        return
+    connection.execute(
+        text(f"INSERT OR REPLACE INTO {FTS_TABLE}(rowid, app_key, tokens) VALUES (:id, :app_key, :tokens)"),
+        [
+            {"id": row["id"], "app_key": f"app{row['app_id']}", "tokens": tokenize(row["content"])}
+            for row in rows
+        ],
+    )
+
+
+def unindex_app(connection: Connection, app_id: int, review_ids: Optional[List[int]] = None) -> None:
+    """删除索引条目；不指定 review_ids 时删除整个应用的索引"""
+    if not _has_index(connection):
+        return
+    if review_ids is None:
+        connection.execute(
+            text(f"DELETE FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match"),
+            {"match": f"app_key : app{int(app_id)}"},
+        )
+    elif review_ids:
+        connection.execute(
+            text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"),
+            [{"id": review_id} for review_id in review_ids],
+        )
+
+
+@event.listens_for(Review, "after_insert")
+def _index_new_review(mapper, connection, target):
+    index_rows(connection, [{"id": target.id, "app_id": target.app_id, "content": target.content}])
+
+
+@event.listens_for(Review, "after_delete")
+def _unindex_review(mapper, connection, target):
+    unindex_app(connection, target.app_id, [target.id])
+
+
+def ensure_search_index(engine: Engine) -> None:
+    """创建 FTS 索引表；首次创建时为已有评论补建索引"""
+    global _index_ready
+    if engine.dialect.name != "sqlite":
+        logger.warning(f"数据库 {engine.dialect.name} 不支持 FTS5，评论搜索将退化为逐条扫描")
+        _index_ready = False
+        return
+
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": FTS_TABLE},
+        ).first()
+        if exists:
+            _index_ready = True
+            return
+        conn.execute(text(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "app_key, tokens, tokenize = 'unicode61 remove_diacritics 2', detail = 'full')"
+        ))
+    _index_ready = True
+
+    logger.info("已创建评论全文索引，开始为已有评论建立索引")
+    last_id = 0
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text("SELECT r.id, r.app_id, c.codec, c.dict_id, c.data FROM reviews r "
+                     "LEFT JOIN review_contents c ON c.review_id = r.id "
+                     "WHERE r.id > :last_id ORDER BY r.id LIMIT :limit"),
+                {"last_id": last_id, "limit": INDEX_BATCH_SIZE},
+            ).all()
+            if not rows:
+                break
+            index_rows(conn, [
+                {"id": row.id, "app_id": row.app_id, "content": compression.decode(row.codec, row.dict_id, row.data)}
+                for row in rows
+            ])
+        last_id = rows[-1].id
+        total += len(rows)
+    logger.info(f"评论全文索引建立完成，共 {total} 条")
+
+
+def search_reviews(connection: Connection, app_id: int, q: str, limit: int,
+                   after_score: Optional[float] = None, after_id: Optional[int] = None,
+                   platform: Optional[str] = None) -> List[Dict]:
+    """
+    按相关度检索评论，使用 (score, id) 作为分页键
+    返回最多 limit 条记录，每条包含 id 与 score（bm25，越小越相关）
+    """
+    if not _has_index(connection):
+        return _scan_reviews(connection, app_id, q, limit, after_id, platform)
+
+    match = build_match_query(app_id, q)
+    if match is None:
+        return []
+    params = {"app_id": app_id, "limit": limit, "match": match}
+    platform_filter = ""
+    if platform:
+        platform_filter = "AND r.platform = :platform"
+        params["platform"] = platform
+
+    keyset = ""
+    if after_id is not None:
+        keyset = "AND (m.score > :after_score OR (m.score = :after_score AND m.id > :after_id))"
+        params.update({"after_score": after_score, "after_id": after_id})
+
+    sql = (
+        f"SELECT m.id, m.score FROM ("
+        f"SELECT rowid AS id, bm25({FTS_TABLE}, 0.0, 1.0) AS score "
+        f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match"
+        f") AS m JOIN reviews r ON r.id = m.id "
+        f"WHERE r.app_id = :app_id {platform_filter} {keyset} "
+        "ORDER BY m.score, m.id LIMIT :limit"
+    )
+    return [dict(row) for row in connection.execute(text(sql), params).mappings()]
+
+
+def _scan_reviews(connection: Connection, app_id: int, q: str, limit: int,
+                  after_id: Optional[int], platform: Optional[str]) -> List[Dict]:
+    """没有全文索引时逐条解压正文做子串匹配（仅用于非 SQLite 数据库）"""
+    terms = [term.lower() for term in _query_terms(q)]
+    if not terms:
+        return []
+    sql = (
+        "SELECT r.id, c.codec, c.dict_id, c.data FROM reviews r "
+        "JOIN review_contents c ON c.review_id = r.id "
+        "WHERE r.app_id = :app_id AND r.id > :after_id"
+    )
+    params = {"app_id": app_id, "after_id": after_id or 0}
+    if platform:
+        sql += " AND r.platform = :platform"
+        params["platform"] = platform
+    hits = []
+    for row in connection.execute(text(sql + " ORDER BY r.id"), params):
+        content = (compression.decode(row.codec, row.dict_id, row.data) or "").lower()
+        if all(term in content for term in terms):
+            hits.append({"id": row.id, "score": 0.0})
+            if len(hits) >= limit:
+                break
+    return hits
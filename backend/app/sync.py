@@ -0,0 +1,381 @@
+"""
+评论抓取与保存
+
+供抓取队列的工作线程调用（API 进程内或独立的 python -m app.worker 进程），不依赖定时调度器。
+"""
+from .scrapers import backends
+from .database import SessionLocal
+from .models import Review, ReviewContent, App
+from .records import ReviewRecord
+from . import archive, compression, search  # search 同时注册 ORM 写入时的全文索引钩子
+from .config import COUNTRY_FANOUT_CONCURRENCY, POLL_MIN_INTERVAL_MINUTES
+from .deadline import Deadline
+from .exceptions import AppDeletedError, CircuitOpenError, ReviewFetchError
+from . import circuit, ingestion, pipeline, polling, runs
+from .logger import setup_logger
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+import json
+import threading
+import traceback
+
+logger = setup_logger("sync")
+
+EXISTING_QUERY_CHUNK = 500  # 去重查询每次最多带的时间数（SQLite 的参数个数有上限）
+
+def sync_app_platform(db, app: App, platform: str, limit: int = None, kind: str = "refresh",
+                      probe: bool = False) -> int:
+    """
+    抓取并保存单个应用单个平台的评论，记录到自适应轮询状态、抓取记录和熔断状态
+
+    评论按页边抓边写（见 ReviewStream），应用设置了多个国家/地区时各国家并发抓取。抓取受
+    INGEST_TASK_DEADLINE_SECONDS 限制：到期（或中途请求失败）时保存已抓取的部分，并在抓取状态中记录中断的
+    位置，下次轮询从该位置继续抓取剩余的条数。
+    :param probe: 手动刷新，不受应用熔断限制
+    :return: 新增评论数
+    """
+    # 熔断中直接失败，不占用商店的并发名额
+    circuit.check(db, app.id, platform, probe)
+    metrics = runs.RunMetrics(kind, app.id, platform, limit)
+    deadline = Deadline()
+    try:
+        state = polling.get_state(db, app.id, platform)
+        cursor = None
+        if kind == "poll" and state.resume_cursor:
+            # 继续上次中断的抓取；手动刷新总是从最新的评论开始
+            cursor = json.loads(state.resume_cursor)
+            limit = state.resume_limit
+            logger.info(f"应用 {app.id} ({platform}) 从上次中断的位置继续抓取，剩余 {limit or '不限'} 条")
+        # 同一商店同时进行的抓取数受 STORE_MAX_IN_FLIGHT 限制。名额在独立的会话中领取，先提交新建的抓取状态，
+        # 不在等待名额时占着写锁
+        db.commit()
+        with polling.store_slot(platform):
+            # 每抓到一页就写入，写入的同时后台线程继续抓取下一页
+            stream = ReviewStream(app, platform, limit, metrics, cursor, deadline)
+            logger.info(f"更新 {'App Store' if platform == 'ios' else 'Google Play'} 评论: app_id={app.id}, "
+                        f"countries={app.countries(platform)}, backend={stream.backend.name}")
+            new_count = 0
+            for page in stream:
+                new_count += save_reviews(db, app.id, page, metrics)
+        resume = stream.resume
+        with metrics.timer("write"):
+            state = polling.record_run(db, app.id, platform, new_count, limit)
+            if resume is not None:
+                state.resume_cursor = json.dumps(resume)
+                # 多个国家时每个国家各抓取 limit 条，未完成的国家续传时重新按 limit 计算
+                state.resume_limit = (limit if "countries" in resume else limit - stream.fetched) if limit else None
+                # 尽快继续，不等正常的轮询间隔
+                now = datetime.now()
+                state.next_run_at = polling.spread_time(
+                    app.id, platform, now + timedelta(minutes=POLL_MIN_INTERVAL_MINUTES), POLL_MIN_INTERVAL_MINUTES
+                )
+            elif cursor is not None:
+                state.resume_cursor = state.resume_limit = None
+            db.commit()
+        if resume is not None:
+            metrics.deadline_exceeded = deadline.expired()
+            metrics.finish(partial="达到截止时间" if metrics.deadline_exceeded else "请求失败，已保存已抓取的部分")
+            if not metrics.deadline_exceeded:
+                metrics.interrupted = metrics.interrupted or ReviewFetchError("抓取中途失败")
+        else:
+            metrics.finish()
+    except AppDeletedError as e:
+        # 抓取期间应用被删除：已写入的评论由清理任务删除，不计入熔断
+        db.rollback()
+        metrics.finish(e)
+        logger.info(f"应用 {app.id} ({platform}) 已删除，停止抓取")
+        return 0
+    except Exception as e:
+        # 先回滚，释放写锁，熔断状态和抓取记录用独立的会话写入
+        db.rollback()
+        metrics.finish(e)
+        circuit.record_failure(app.id, platform, e)
+        raise
+    finally:
+        runs.record(metrics)
+    if resume is not None and not metrics.deadline_exceeded:
+        # 请求中途失败：已抓取的部分照常保存，但商店和应用并没有恢复，计入熔断
+        circuit.record_failure(app.id, platform, metrics.interrupted)
+    else:
+        circuit.record_success(app.id, platform)
+    logger.info(
+        f"应用 {app.id} ({platform}) 新增 {new_count} 条评论，"
+        f"增速 {state.review_rate:.2f} 条/小时，下次 {state.next_run_at:%Y-%m-%d %H:%M} 抓取 {state.fetch_limit} 条"
+        + ("（上次抓取未完成，将从中断的位置继续）" if resume is not None else "")
+    )
+    return new_count
+
+class ReviewStream:
+    """
+    应用在该平台所有国家/地区的评论，按页产出。每个国家在后台线程中抓取（最多 COUNTRY_FANOUT_CONCURRENCY 个
+    同时进行），经 pipeline.prefetch 的有界队列交给写入方，写入与下一页的请求重叠进行；每个国家各抓取 limit 条。
+    抓取方式由 scrapers.backends.select 按平台选择，所有国家使用同一种方式。
+    迭代结束后 resume 为续传位置：只有一个国家时为该国家的游标，多个国家时为 {"countries": {国家: 游标}}，
+    只包含未完成的国家；全部完成时为 None。部分国家失败时其他国家照常写入，全部失败时抛出第一个异常
+    """
+
+    def __init__(self, app: App, platform: str, limit: Optional[int], metrics: runs.RunMetrics,
+                 cursor: Optional[Dict[str, Any]], deadline: Deadline):
+        self.app = app
+        self.platform = platform
+        self.limit = limit
+        self.metrics = metrics
+        self.deadline = deadline
+        self.resume: Optional[Dict[str, Any]] = None
+        self.fetched = 0
+        self.backend = backends.select(platform, resume=cursor is not None)
+        if cursor is not None and not self.backend.capabilities.incremental:
+            logger.warning(f"应用 {app.id} ({platform}) 的抓取方式 {self.backend.name} 不支持续传，从头开始抓取")
+            cursor = None
+        codes = app.countries(platform)
+        self.multi = len(codes) > 1 or (cursor is not None and "countries" in cursor)
+        if cursor is not None and "countries" in cursor:
+            self.pending = {code: position for code, position in cursor["countries"].items() if code in codes}
+        else:
+            self.pending = {code: None for code in codes}
+            if cursor is not None:
+                self.pending[codes[0]] = cursor  # 只抓取主要国家时中断的位置
+
+    def __iter__(self) -> Iterator[List[ReviewRecord]]:
+        if not self.pending:
+            return
+        # 国家之间的并发数有上限：多出的国家排队，等前面的国家抓完再开始
+        slots = threading.BoundedSemaphore(max(COUNTRY_FANOUT_CONCURRENCY, 1))
+        children = {
+            code: runs.RunMetrics(self.metrics.kind, self.app.id, self.platform, self.limit) if self.multi
+            else self.metrics
+            for code in self.pending
+        }
+        for child in children.values():
+            child.raw = self.metrics.raw  # 各国家的原始响应存入同一个存档
+
+        def source(code: str) -> Iterator[Tuple[List[ReviewRecord], Optional[Dict[str, Any]]]]:
+            with slots:
+                yield from self.backend.iter_reviews(self.app, code, self.limit, children[code],
+                                                     self.pending[code], self.deadline)
+
+        positions = dict(self.pending)
+        errors = {}
+        try:
+            for code, item, error in pipeline.prefetch({code: source(code) for code in self.pending}):
+                if error is not None:
+                    if self.multi:
+                        logger.warning(f"应用 {self.app.id} ({self.platform}) 国家 {code} 抓取失败: {str(error)}")
+                    errors[code] = error
+                    continue
+                page, positions[code] = item
+                self.fetched += len(page)
+                yield page
+        finally:
+            if self.multi:
+                for code, child in children.items():
+                    self.metrics.merge(child, prefix=f"{code}/")
+        if len(errors) == len(self.pending):
+            raise next(iter(errors.values()))
+        if errors:
+            self.metrics.interrupted = self.metrics.interrupted or next(iter(errors.values()))
+        if not self.multi:
+            self.resume = positions[next(iter(self.pending))]
+            return
+        # 失败的国家没有产出过任何一页，下次仍从原来的位置开始
+        remaining = {code: position for code, position in positions.items() if position is not None or code in errors}
+        self.resume = {"countries": remaining} if remaining else None
+
+def update_reviews(app_id: int = None, platform: str = None, limit: int = None):
+    """
+    更新应用评论
+    :param app_id: 指定应用ID，为None时更新所有应用
+    :param platform: 指定平台 (ios/android)，为None时更新所有平台
+    :param limit: 限制获取的评论数量
+    """
+    db = SessionLocal()
+    try:
+        logger.info(f"开始更新应用评论: app_id={app_id}, platform={platform}, limit={limit}")
+        
+        # 查询需要更新的应用
+        query = db.query(App).filter(App.deleted_at.is_(None))
+        if app_id:
+            query = query.filter(App.id == app_id)
+        apps = query.all()
+        
+        for app in apps:
+            for app_platform in polling.app_platforms(app, platform):
+                try:
+                    # 熔断中的应用和商店直接跳过，不占用请求预算
+                    circuit.check(db, app.id, app_platform, claim=False)
+                    polling.budget.spend(polling.estimate_requests(app_platform, limit, len(app.countries(app_platform))))
+                    sync_app_platform(db, app, app_platform, limit)
+                except CircuitOpenError as e:
+                    logger.info(f"跳过应用 {app.id} ({app_platform}): {e.detail}")
+                except Exception as e:
+                    logger.error(f"更新应用 {app.id} ({app_platform}) 的评论失败: {str(e)}\n{traceback.format_exc()}")
+                    db.rollback()
+
+        logger.info("评论更新完成")
+        
+    except Exception as e:
+        logger.error(f"更新评论时出错: {str(e)}\n{traceback.format_exc()}")
+        db.rollback()
+    finally:
+        db.close()
+
+def refresh_app_platform(app_id: int, platform: str, limit: int = None) -> int:
+    """在独立的数据库会话中执行一次手动刷新或全量抓取"""
+    db = SessionLocal()
+    try:
+        app = db.query(App).filter(App.id == app_id, App.deleted_at.is_(None)).first()
+        if not app:
+            return 0
+        return sync_app_platform(db, app, platform, limit, probe=True)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def poll_app_platform(app_id: int, platform: str, limit: int) -> int:
+    """在独立的数据库会话中执行一次到期的轮询"""
+    now = datetime.now()
+    db = SessionLocal()
+    try:
+        app = db.query(App).filter(App.id == app_id, App.deleted_at.is_(None)).first()
+        if not app:
+            # 领取任务后应用被删除（或已清理），不抓取，也不记录失败
+            return 0
+        try:
+            return sync_app_platform(db, app, platform, limit, kind="poll")
+        except Exception:
+            db.rollback()
+            # 失败后按最短间隔重试，避免每次检查都重复请求；熔断中的等到熔断结束
+            state = polling.get_state(db, app_id, platform, now)
+            state.next_run_at = polling.spread_time(
+                app_id, platform, now + timedelta(minutes=POLL_MIN_INTERVAL_MINUTES), POLL_MIN_INTERVAL_MINUTES
+            )
+            resume_at = circuit.open_until(db, app_id, platform)
+            if resume_at and resume_at > state.next_run_at:
+                state.next_run_at = resume_at
+            db.commit()
+            raise
+    finally:
+        db.close()
+
+def update_latest_reviews(app_id: int, limit: int = 100):
+    """
+    更新最新的评论
+    :param app_id: 应用ID
+    :param limit: 获取的评论数量限制
+    """
+    update_reviews(app_id=app_id, limit=limit)
+
+def _existing_keys(db, app_id: int, records: List[ReviewRecord]) -> Set[Tuple[str, Optional[str], datetime]]:
+    """这批评论中已在数据库里或已归档的 (平台, 作者, 时间)"""
+    times = sorted({record.created_at for record in records})
+    keys = archive.archived_keys(db, app_id, times)
+    for i in range(0, len(times), EXISTING_QUERY_CHUNK):
+        keys.update(
+            (row.platform, row.author, row.created_at)
+            for row in db.query(Review.platform, Review.author, Review.created_at).filter(
+                Review.app_id == app_id,
+                Review.created_at.in_(times[i:i + EXISTING_QUERY_CHUNK]),
+            )
+        )
+    return keys
+
+def _insert_records(db, app_id: int, records: List[ReviewRecord]) -> None:
+    """
+    不经过 ORM 批量写入评论、正文和全文索引（由调用方提交事务）。ORM 写入时由 Review 的 after_insert
+    钩子更新索引，这里直接调用 search.index_rows
+    """
+    if not records:
+        return
+    connection = db.connection()
+    ids = connection.execute(
+        insert(Review.__table__).returning(Review.__table__.c.id, sort_by_parameter_order=True),
+        [
+            {"app_id": app_id, "platform": record.platform, "rating": record.rating, "author": record.author,
+             "created_at": record.created_at, "country": record.country}
+            for record in records
+        ],
+    ).scalars().all()
+    contents = []
+    for review_id, record in zip(ids, records):
+        if record.content is not None:
+            codec, dict_id, data = compression.encode(record.content)
+            contents.append({"review_id": review_id, "codec": codec, "dict_id": dict_id, "data": data})
+    if contents:
+        connection.execute(insert(ReviewContent.__table__), contents)
+    search.index_rows(connection, [
+        {"id": review_id, "app_id": app_id, "content": record.content} for review_id, record in zip(ids, records)
+    ])
+
+def _save_one_by_one(db, app_id: int, records: List[ReviewRecord]) -> Tuple[int, int, int]:
+    """逐条查重、写入并提交，单条失败不影响其他评论"""
+    new_count = duplicates = errors = 0
+    for record in records:
+        try:
+            existing_review = db.query(Review).filter(
+                Review.app_id == app_id,
+                Review.platform == record.platform,
+                Review.author == record.author,
+                Review.created_at == record.created_at
+            ).first()
+            archived = record.key() in archive.archived_keys(db, app_id, [record.created_at])
+
+            if not existing_review and not archived:
+                new_review = Review(app_id=app_id, **record.to_dict())
+                db.add(new_review)
+                db.commit()
+                new_count += 1
+            else:
+                duplicates += 1
+                
+        except Exception as e:
+            logger.error(f"保存评论失败: {str(e)}")
+            db.rollback()
+            errors += 1
+    return new_count, duplicates, errors
+
+def save_reviews(db, app_id: int, records: List[ReviewRecord], metrics: runs.RunMetrics = None,
+                 commit: bool = True) -> int:
+    """
+    保存一批评论（通常是一页）到数据库，返回新增条数。整批用一次查询去重，不构造 ORM 对象直接批量写入，
+    一次提交；提交失败时回滚并改为逐条写入，跳过出错的评论。应用已删除（或不存在）时抛出 AppDeletedError，
+    清理任务删除评论前会等待正在执行的抓取结束
+    :param commit: 为 False 时不提交，由调用方在同一个事务中提交；写入失败时直接抛出，不改为逐条写入
+    """
+    app = db.query(App.deleted_at).filter(App.id == app_id).first()
+    if app is None or app.deleted_at is not None:
+        raise AppDeletedError(f"应用 {app_id} 已删除")
+    new_count = duplicates = errors = 0
+    with runs.timed(metrics, "write"):
+        if records:
+            try:
+                existing = _existing_keys(db, app_id, records)
+                batch = []
+                for record in records:
+                    key = record.key()
+                    if key in existing:
+                        duplicates += 1
+                        continue
+                    existing.add(key)  # 同一批中重复的评论（如多个国家都能看到的）也只写入一次
+                    batch.append(record)
+                _insert_records(db, app_id, batch)
+                if commit:
+                    db.commit()
+                new_count = len(batch)
+            except Exception as e:
+                if not commit:
+                    raise
+                logger.warning(f"批量保存评论失败，改为逐条保存: {str(e)}")
+                db.rollback()
+                new_count, duplicates, errors = _save_one_by_one(db, app_id, records)
+    if metrics is not None:
+        metrics.new_count += new_count
+        metrics.duplicates += duplicates
+        metrics.write_errors += errors
+    return new_count
+
+# 抓取队列的任务类型
+ingestion.register_handler("refresh", refresh_app_platform)
+ingestion.register_handler("poll", poll_app_platform)
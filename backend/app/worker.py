@@ -0,0 +1,51 @@
+"""
+独立的抓取工作进程
+
+从 ingest_tasks 表领取并执行抓取任务，可以在多台机器上同时运行多个，共享同一个数据库中的队列。
+使用独立工作进程时，API 进程设置 INGEST_EMBEDDED_WORKER=false，只负责把任务加入队列。
+
+命令行:
+    python -m app.worker                          # 使用 INGEST_WORKERS 个线程处理所有通道
+    python -m app.worker --threads 2 --lanes backfill
+"""
+import argparse
+import signal
+import threading
+
+from .config import INGEST_WORKERS
+from .ingestion import LANES, IngestionWorker
+from .logger import setup_logger
+from . import backfill, sync  # noqa: F401  注册抓取任务的处理函数
+
+logger = setup_logger("worker")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.worker", description="评论抓取工作进程")
+    parser.add_argument("--threads", type=int, default=INGEST_WORKERS, help="工作线程数")
+    parser.add_argument("--lanes", default=",".join(LANES), help="处理的通道，以逗号分隔")
+    args = parser.parse_args(argv)
+
+    lanes = [lane.strip() for lane in args.lanes.split(",") if lane.strip()]
+    unknown = [lane for lane in lanes if lane not in LANES]
+    if unknown:
+        parser.error(f"未知的通道: {', '.join(unknown)}")
+
+    stopping = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info(f"收到信号 {signum}，等待执行中的任务完成后退出")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    worker = IngestionWorker(threads=args.threads, lanes=lanes)
+    worker.start()
+    stopping.wait()
+    worker.stop()
+    logger.info("工作进程已退出")
+
+
+if __name__ == "__main__":
+    main()
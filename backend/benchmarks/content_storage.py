@@ -0,0 +1,144 @@
+"""
+评论正文存储方式对比：正文内联在 reviews 表 vs. 压缩后放在 review_contents 表
+
+生成一批模拟评论，分别写入两种表结构的 SQLite 数据库，比较数据库文件大小以及
+只用到评分和日期的统计查询（月度统计、每日评分趋势）的耗时。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.content_storage --reviews 200000
+    REVIEW_CONTENT_CODEC=zlib python -m benchmarks.content_storage
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+WORDS_ZH = (
+    "这个 应用 非常 好用 闪退 严重 无法 登录 更新 以后 卡顿 客服 态度 很差 推荐 大家 下载 广告 太多 界面 "
+    "简洁 功能 强大 希望 改进 一直 提示 网络 错误 支付 失败 会员 价格 太贵 体验 不错 流畅 耗电 发热 手机"
+).split()
+WORDS_EN = (
+    "app crash login update great love hate slow fast ads support please fix bug after latest version "
+    "battery works fine cannot open payment subscription price"
+).split()
+
+STATS_SQL = (
+    "SELECT strftime('%Y-%m', created_at) AS month, platform, COUNT(*), AVG(rating) "
+    "FROM reviews WHERE app_id = 1 GROUP BY month, platform"
+)
+TREND_SQL = (
+    "SELECT date(created_at) AS day, AVG(rating), COUNT(*) FROM reviews "
+    "WHERE app_id = 1 AND created_at >= :since GROUP BY day"
+)
+
+
+def fake_reviews(count: int, seed: int = 42):
+    rnd = random.Random(seed)
+    start = datetime(2022, 1, 1)
+    for i in range(count):
+        if rnd.random() < 0.8:
+            content = "".join(rnd.choices(WORDS_ZH, k=rnd.randint(4, 60))) + "。"
+        else:
+            content = " ".join(rnd.choices(WORDS_EN, k=rnd.randint(4, 50))) + "."
+        yield (
+            1,
+            rnd.choice(("ios", "android")),
+            float(rnd.randint(1, 5)),
+            content,
+            f"user{rnd.randint(1, count)}",
+            (start + timedelta(minutes=i * 7)).isoformat(" "),
+        )
+
+
+def build_inline(path: str, rows) -> None:
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE reviews (id INTEGER PRIMARY KEY, app_id INTEGER, platform VARCHAR(7) NOT NULL, "
+        "rating FLOAT NOT NULL, content VARCHAR, author VARCHAR, created_at DATETIME NOT NULL)"
+    )
+    conn.executemany(
+        "INSERT INTO reviews(app_id, platform, rating, content, author, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.execute("CREATE INDEX ix_reviews_app_created ON reviews(app_id, created_at, id)")
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+
+
+def build_side_table(path: str, rows) -> None:
+    from app import compression
+    from app.database import engine
+    from app.models import Base
+
+    Base.metadata.create_all(bind=engine)
+    compression.train_dictionaries(compression.group_samples(row[3] for row in rows[:20000]))
+
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO reviews(id, app_id, platform, rating, author, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [(i + 1, row[0], row[1], row[2], row[4], row[5]) for i, row in enumerate(rows)],
+    )
+    conn.executemany(
+        "INSERT INTO review_contents(review_id, codec, dict_id, data) VALUES (?, ?, ?, ?)",
+        [(i + 1, *compression.encode(row[3])) for i, row in enumerate(rows)],
+    )
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+
+
+def time_query(path: str, sql: str, params: dict, repeat: int) -> float:
+    """返回多次执行的中位数耗时（毫秒），每次使用新连接避免 SQLite 页缓存"""
+    timings = []
+    for _ in range(repeat):
+        conn = sqlite3.connect(path)
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+        conn.close()
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reviews", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="content-bench-")
+    inline_path = os.path.join(workdir, "inline.db")
+    side_path = os.path.join(workdir, "side.db")
+    # compression 模块通过 DATABASE_URL 读写压缩字典，需在导入 app 之前设置
+    os.environ["DATABASE_URL"] = f"sqlite:///{side_path}"
+
+    rows = list(fake_reviews(args.reviews))
+    build_inline(inline_path, rows)
+    build_side_table(side_path, rows)
+
+    from app import compression
+    since = {"since": (datetime(2022, 1, 1) + timedelta(minutes=len(rows) * 7 - 90 * 24 * 60)).isoformat(" ")}
+    print(f"评论数: {len(rows)}, 压缩格式: {compression.CODEC}")
+    print(f"{'':24}{'内联正文':>12}{'压缩副表':>12}")
+    inline_size = os.path.getsize(inline_path) / 1024 / 1024
+    side_size = os.path.getsize(side_path) / 1024 / 1024
+    print(f"{'数据库大小 (MB)':24}{inline_size:>12.1f}{side_size:>12.1f}")
+    for name, sql, params in (("月度统计 (ms)", STATS_SQL, {}), ("近 90 天趋势 (ms)", TREND_SQL, since)):
+        inline_ms = time_query(inline_path, sql, params, args.repeat)
+        side_ms = time_query(side_path, sql, params, args.repeat)
+        print(f"{name:24}{inline_ms:>12.1f}{side_ms:>12.1f}")
+
+    conn = sqlite3.connect(side_path)
+    stored = conn.execute("SELECT SUM(LENGTH(data)) FROM review_contents").fetchone()[0]
+    conn.close()
+    raw = sum(len(row[3].encode("utf-8")) for row in rows)
+    print(f"正文原始大小 {raw / 1024 / 1024:.1f} MB，压缩后 {stored / 1024 / 1024:.1f} MB ({stored / raw:.0%})")
+    print(f"临时文件位于 {workdir}")
+
+
+if __name__ == "__main__":
+    main()
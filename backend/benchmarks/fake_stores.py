@@ -0,0 +1,230 @@
+"""
+本地的 App Store / Google Play 替身服务
+
+模拟抓取用到的三个接口，供压测和回归测试使用，不向真实商店发出请求：
+
+    apps.apple.com/<国家>/app/<名称>/id<应用>        应用页面（含 bearer token）
+    amp-api.apps.apple.com/v1/catalog/<国家>/apps/<应用>/reviews   App Store 评论（offset/limit 分页）
+    play.google.com/_/PlayStoreUi/data/batchexecute   Google Play 评论（continuation token 分页，支持按星级筛选）
+
+后端设置 STORE_STAND_IN_URL=http://127.0.0.1:<端口> 后，商店请求按 <替身地址>/<原主机><原路径> 发到这里。
+每个应用、国家有 --reviews 条评论（从新到旧，评分按 1～5 循环），内容由序号确定，多次抓取结果一致。
+可以模拟延迟、5xx 错误和带 Retry-After 的 429。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.fake_stores --port 8765 --reviews 5000 --latency-ms 80 --throttle-rate 0.02
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+TOKEN = "stand-in-token"
+LANDING_PAGE = (
+    '<html><head><meta name="web-experience-app/config/environment" '
+    f'content="%7B%22MEDIA_API%22%3A%7B%22token%22%3A%22{TOKEN}%22%7D%7D"></head><body></body></html>'
+)
+NEWEST = datetime(2026, 1, 1)
+WORDS = "好用 闪退 更新 以后 卡顿 登录 失败 推荐 广告 太多 界面 简洁 great app crash after update please fix".split()
+
+
+class StoreConfig:
+    """替身服务的行为，可在运行中修改（如压测中途提高 429 比例）"""
+
+    def __init__(self, reviews: int = 2000, ios_page_size: int = 20, play_page_size: int = 199,
+                 latency_ms: float = 0, error_rate: float = 0, throttle_rate: float = 0,
+                 retry_after: float = 1, interval_minutes: float = 37, seed: Optional[int] = None):
+        self.reviews = reviews  # 每个应用、国家的评论数
+        self.ios_page_size = ios_page_size  # 每页最多返回的条数（不超过请求的 limit/count）
+        self.play_page_size = play_page_size
+        self.latency_ms = latency_ms  # 平均延迟，实际在 50%～150% 之间随机
+        self.error_rate = error_rate  # 返回 500 的比例
+        self.throttle_rate = throttle_rate  # 返回 429 的比例
+        self.retry_after = retry_after  # 429 响应的 Retry-After 秒数
+        self.interval_minutes = interval_minutes  # 相邻两条评论的时间间隔
+        self.random = random.Random(seed)
+
+
+def _review(app_id: str, country: str, index: int, interval_minutes: float) -> Tuple[int, str, str, datetime]:
+    """第 index 条评论（0 为最新）：(评分, 作者, 正文, 时间)"""
+    rnd = random.Random(f"{app_id}:{country}:{index}")
+    content = "".join(rnd.choices(WORDS, k=rnd.randint(3, 30)))
+    return index % 5 + 1, f"user-{country}-{index}", content, NEWEST - timedelta(minutes=index * interval_minutes)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], config: StoreConfig):
+        super().__init__(address, _Handler)
+        self.config = config
+        self.requests = Counter()  # (接口, 状态码) -> 请求数
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, route: str, status: int) -> None:
+        with self._lock:
+            self.requests[(route, status)] += 1
+
+    def start(self) -> "StandInServer":
+        """在后台线程中运行"""
+        threading.Thread(target=self.serve_forever, name="fake-stores", daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 保持连接，与真实商店一致
+    server: StandInServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        parts = urlsplit(self.path)
+        host, _, path = parts.path.lstrip("/").partition("/")
+        query = parse_qs(parts.query)
+        if host == "apps.apple.com":
+            route, handler = "ios_landing", lambda: (200, "text/html", LANDING_PAGE.encode())
+        elif host == "amp-api.apps.apple.com":
+            route, handler = "ios_reviews", lambda: self._ios_reviews(path, query)
+        elif host == "play.google.com":
+            route, handler = "play_reviews", lambda: self._play_reviews(query, body)
+        else:
+            self._send("unknown", 404, "text/plain", b"not found")
+            return
+
+        config = self.server.config
+        if config.latency_ms:
+            time.sleep(config.latency_ms / 1000 * config.random.uniform(0.5, 1.5))
+        if route != "ios_landing":
+            roll = config.random.random()
+            if roll < config.throttle_rate:
+                self._send(route, 429, "text/plain", b"too many requests",
+                           {"Retry-After": f"{config.retry_after:g}"})
+                return
+            if roll < config.throttle_rate + config.error_rate:
+                self._send(route, 500, "text/plain", b"internal error")
+                return
+        try:
+            status, content_type, payload = handler()
+        except (KeyError, IndexError, ValueError) as e:
+            status, content_type, payload = 400, "text/plain", str(e).encode()
+        self._send(route, status, content_type, payload)
+
+    def _send(self, route: str, status: int, content_type: str, payload: bytes,
+              headers: Optional[Dict[str, str]] = None) -> None:
+        self.server.count(route, status)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _ios_reviews(self, path: str, query: Dict[str, List[str]]):
+        # v1/catalog/<国家>/apps/<应用>/reviews
+        segments = path.split("/")
+        country, app_id = segments[2], segments[4]
+        config = self.server.config
+        offset = int(query.get("offset", ["0"])[0])
+        limit = min(int(query.get("limit", ["20"])[0]), config.ios_page_size)
+        indexes = range(offset, min(offset + limit, config.reviews))
+        data = []
+        for index in indexes:
+            rating, author, content, created_at = _review(app_id, country, index, config.interval_minutes)
+            data.append({"id": f"{app_id}-{country}-{index}", "type": "user-reviews", "attributes": {
+                "rating": rating, "review": content, "userName": author, "title": "",
+                "isEdited": False, "date": created_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }})
+        result: Dict[str, Any] = {"data": data}
+        if offset + limit < config.reviews:
+            result["next"] = f"/v1/catalog/{country}/apps/{app_id}/reviews?offset={offset + limit}"
+        return 200, "application/json", json.dumps(result).encode()
+
+    def _play_reviews(self, query: Dict[str, List[str]], body: bytes):
+        # f.req 为 [[["UsvDTd", "<请求参数 JSON>", null, "generic"]]]，参数为
+        # [null, null, [2, sort, [count, null, token], null, [null, score]], [app_id, 7]]
+        request = json.loads(json.loads(parse_qs(body.decode())["f.req"][0])[0][0][1])
+        country = query.get("gl", ["us"])[0]
+        app_id = request[3][0]
+        count_spec = request[2][2]
+        score = request[2][4][1] if len(request[2]) > 4 and request[2][4] else None
+        token = count_spec[2] if len(count_spec) > 2 else None
+        config = self.server.config
+        position = int(token) if token else 0  # 在（按星级筛选后的）列表中的位置
+        count = min(int(count_spec[0]), config.play_page_size)
+
+        if score is None:
+            total = config.reviews
+            index_of = lambda i: i  # noqa: E731
+        else:
+            # 评分为 score 的评论序号为 score - 1, score + 4, score + 9 ...
+            total = max(0, (config.reviews - score + 5) // 5)
+            index_of = lambda i: i * 5 + score - 1  # noqa: E731
+        items = []
+        for i in range(position, min(position + count, total)):
+            index = index_of(i)
+            rating, author, content, created_at = _review(app_id, country, index, config.interval_minutes)
+            items.append([
+                f"gp:{app_id}:{country}:{index}", [author, [None, None, None, [None, None, "https://example.invalid/a.png"]]],
+                rating, None, content, [int(created_at.timestamp()), 0], 0, None, None, None, "1.0.0",
+            ])
+        next_position = position + count
+        # 还有下一页时末尾是 [null, token]，否则没有这一项
+        inner = [items, None, [None, str(next_position)]] if next_position < total else [items]
+        envelope = [["wrb.fr", "UsvDTd", json.dumps(inner), None, None, None, "generic"]]
+        return 200, "application/json", (")]}'\n\n" + json.dumps(envelope)).encode()
+
+
+def serve(host: str = "127.0.0.1", port: int = 0, config: Optional[StoreConfig] = None) -> StandInServer:
+    """在后台线程中启动替身服务，port 为 0 时自动选择端口"""
+    return StandInServer((host, port), config or StoreConfig()).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--reviews", type=int, default=2000, help="每个应用、国家的评论数")
+    parser.add_argument("--ios-page-size", type=int, default=20)
+    parser.add_argument("--play-page-size", type=int, default=199)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    args = parser.parse_args()
+
+    config = StoreConfig(args.reviews, args.ios_page_size, args.play_page_size, args.latency_ms,
+                         args.error_rate, args.throttle_rate, args.retry_after)
+    server = StandInServer((args.host, args.port), config)
+    print(f"商店替身服务已启动: {server.url}（后端设置 STORE_STAND_IN_URL={server.url}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for (route, status), count in sorted(server.requests.items()):
+            print(f"{route:14} {status}  {count}")
+
+
+if __name__ == "__main__":
+    main()
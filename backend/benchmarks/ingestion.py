@@ -0,0 +1,112 @@
+"""
+抓取吞吐量基准：对本地的商店替身服务（benchmarks/fake_stores.py）执行完整的 sync.update_reviews
+
+在临时数据库中创建 --apps 个应用（双平台，可设置多个国家），启动替身服务并把商店请求改发过去，
+然后调用 update_reviews（抓取、解析、去重写入、抓取记录，与线上相同的代码路径），统计：
+
+    评论/秒、请求/秒（含 429、5xx）、各阶段耗时（来自 ingestion_runs），以及替身服务收到的请求分布
+
+每次修改抓取流程后运行一次，与之前的结果比较。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.ingestion --apps 4 --reviews 3000 --limit 1000
+    python -m benchmarks.ingestion --latency-ms 80 --throttle-rate 0.05 --countries us,jp
+    python -m benchmarks.ingestion --limit 0     # 不限条数（Play 按星级分区抓取）
+"""
+import argparse
+import os
+import tempfile
+import time
+from collections import Counter
+
+from benchmarks.fake_stores import StoreConfig, serve
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apps", type=int, default=4)
+    parser.add_argument("--countries", default="us", help="每个应用抓取的国家，逗号分隔")
+    parser.add_argument("--limit", type=int, default=1000, help="每个应用、平台、国家抓取的条数，0 表示不限")
+    parser.add_argument("--passes", type=int, default=1, help="重复执行的次数，第二次起评论都已存在（只测去重）")
+    parser.add_argument("--rate", type=float, default=200, help="每个商店每秒的请求数上限")
+    parser.add_argument("--rate-min", type=float, default=5,
+                        help="被限流后降到的最低速率（线上默认 0.05；模拟 429 时若按线上值，降速后耗时很长）")
+    parser.add_argument("--reviews", type=int, default=3000, help="替身服务中每个应用、国家的评论数")
+    parser.add_argument("--ios-page-size", type=int, default=20)
+    parser.add_argument("--play-page-size", type=int, default=199)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=float, default=0.2)
+    args = parser.parse_args()
+
+    server = serve(config=StoreConfig(args.reviews, args.ios_page_size, args.play_page_size, args.latency_ms,
+                                      args.error_rate, args.throttle_rate, args.retry_after, seed=42))
+    workdir = tempfile.mkdtemp(prefix="ingestion-bench-")
+    # 需在导入 app 之前设置
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "STORE_STAND_IN_URL": server.url,
+        "STORE_RATE_IOS": str(args.rate),
+        "STORE_RATE_ANDROID": str(args.rate),
+        "STORE_RATE_MAX": str(args.rate),
+        "STORE_RATE_MIN": str(min(args.rate_min, args.rate)),
+        "STORE_RATE_BURST": str(max(args.rate / 10, 3)),
+        "RAW_ARCHIVE_ENABLED": "false",
+    })
+    from app.database import SessionLocal, engine
+    from app.models import App, Base, IngestionRun, Review
+    from app.search import ensure_search_index
+    from app.sync import update_reviews
+
+    Base.metadata.create_all(bind=engine)
+    ensure_search_index(engine)
+    countries = [code.strip().lower() for code in args.countries.split(",") if code.strip()]
+    db = SessionLocal()
+    db.add_all([
+        App(name=f"bench-{i}", platform="both", app_store_id=str(100000 + i), play_store_id=f"com.bench.app{i}",
+            app_store_country=countries[0], play_store_country=countries[0],
+            app_store_countries=",".join(countries), play_store_countries=",".join(countries))
+        for i in range(args.apps)
+    ])
+    db.commit()
+    db.close()
+
+    print(f"应用 {args.apps} 个 × 2 个平台 × {len(countries)} 个国家，每次抓取 {args.limit or '不限'} 条，"
+          f"延迟 {args.latency_ms:g}ms，5xx {args.error_rate:.0%}，429 {args.throttle_rate:.0%}")
+    print(f"{'':6}{'耗时(s)':>9}{'抓取':>8}{'新增':>8}{'请求':>7}{'评论/s':>9}{'请求/s':>8}"
+          f"{'fetch(s)':>10}{'parse(s)':>10}{'write(s)':>10}")
+    for n in range(1, args.passes + 1):
+        served_before = sum(server.requests.values())
+        db = SessionLocal()
+        last_run = db.query(IngestionRun.id).order_by(IngestionRun.id.desc()).limit(1).scalar() or 0
+        db.close()
+
+        started = time.perf_counter()
+        update_reviews(limit=args.limit or None)
+        elapsed = time.perf_counter() - started
+
+        db = SessionLocal()
+        runs = db.query(IngestionRun).filter(IngestionRun.id > last_run).all()
+        statuses = Counter(run.status for run in runs)
+        fetched = sum(run.fetched or 0 for run in runs)
+        new_count = sum(run.new_count or 0 for run in runs)
+        ms = {phase: sum(getattr(run, f"{phase}_ms") or 0 for run in runs) / 1000 for phase in ("fetch", "parse", "write")}
+        db.close()
+        served = sum(server.requests.values()) - served_before
+        print(f"第{n}次{elapsed:>9.2f}{fetched:>8}{new_count:>8}{served:>7}{fetched / elapsed:>9.0f}"
+              f"{served / elapsed:>8.1f}{ms['fetch']:>10.2f}{ms['parse']:>10.2f}{ms['write']:>10.2f}"
+              f"  {dict(statuses)}")
+
+    db = SessionLocal()
+    print(f"数据库中共 {db.query(Review).count()} 条评论")
+    db.close()
+    print("替身服务收到的请求:", ", ".join(f"{route} {status}: {count}"
+                                  for (route, status), count in sorted(server.requests.items())))
+    print("fetch/parse/write 为各抓取累计的耗时，抓取与写入重叠、多个国家并发，相加可能超过总耗时")
+    print(f"临时文件位于 {workdir}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+抓取中的评论表示方式对比：dict + ORM 写入 vs. ReviewRecord（__slots__）+ 批量 INSERT
+
+生成一批模拟的 Google Play 原始评论，按页（每页 199 条，与 Play 每个请求返回的条数相同）分别走两条路径：
+
+    dict    - 转换为字段 dict，写入时为每条评论构造 Review / ReviewContent ORM 对象，每页提交一次
+    record  - 转换为 ReviewRecord，写入时由 sync.save_reviews 直接生成 INSERT 的参数，每页提交一次
+
+比较每 1 万条评论的转换耗时、转换结果占用的内存，以及写入的 CPU 耗时和内存峰值（含去重查询、正文压缩
+和全文索引）。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.review_records --reviews 50000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from benchmarks.content_storage import WORDS_EN, WORDS_ZH
+
+PAGE_SIZE = 199
+
+
+def fake_raw_reviews(count: int, seed: int = 42):
+    """google_play_scraper 返回的原始评论格式"""
+    rnd = random.Random(seed)
+    start = datetime(2022, 1, 1)
+    for i in range(count):
+        if rnd.random() < 0.8:
+            content = "".join(rnd.choices(WORDS_ZH, k=rnd.randint(4, 60))) + "。"
+        else:
+            content = " ".join(rnd.choices(WORDS_EN, k=rnd.randint(4, 50))) + "."
+        yield {
+            "reviewId": f"gp:{i}",
+            "userName": f"user{i}",
+            "userImage": "https://play-lh.googleusercontent.com/a/default-user",
+            "content": content,
+            "score": rnd.randint(1, 5),
+            "thumbsUpCount": rnd.randint(0, 50),
+            "reviewCreatedVersion": "1.0.0",
+            "at": start + timedelta(minutes=i * 7),
+            "replyContent": None,
+            "repliedAt": None,
+            "appVersion": "1.0.0",
+        }
+
+
+ReviewRecord = None  # 设置 DATABASE_URL 后再导入 app
+
+
+def to_dict(review, country):
+    """改为 ReviewRecord 之前的转换结果"""
+    return {
+        "platform": "android",
+        "rating": review["score"],
+        "content": review["content"],
+        "author": review["userName"],
+        "created_at": review["at"],
+        "country": country,
+    }
+
+
+def to_record(review, country):
+    return ReviewRecord("android", review["score"], review["content"], review["userName"], review["at"], country)
+
+
+def measure_convert(raw, convert):
+    """返回 (每 1 万条的转换耗时 ms, 转换结果占用的内存 MB)；计时与统计内存分两次进行，避免 tracemalloc 影响耗时"""
+    started = time.process_time()
+    converted = [convert(review, "us") for review in raw]
+    elapsed = time.process_time() - started
+    del converted
+    tracemalloc.start()
+    converted = [convert(review, "us") for review in raw]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del converted
+    return elapsed * 1000 * 10000 / len(raw), size / 1024 / 1024
+
+
+def save_with_orm(db, app_id, page):
+    """改为批量 INSERT 之前的写入方式：一次查询去重，为每条评论构造 ORM 对象"""
+    from app.models import Review
+    from app.sync import _existing_keys
+
+    existing = _existing_keys(db, app_id, [ReviewRecord(**review) for review in page])
+    batch = []
+    for review in page:
+        key = (review["platform"], review["author"], review["created_at"])
+        if key not in existing:
+            existing.add(key)
+            batch.append(Review(app_id=app_id, **review))
+    db.add_all(batch)
+    db.commit()
+
+
+def measure_write(app_id, pages, save):
+    """返回 (每 1 万条的写入 CPU 耗时 ms, 写入过程中的内存峰值 MB)"""
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    count = sum(len(page) for page in pages)
+    tracemalloc.start()
+    started = time.process_time()
+    for page in pages:
+        save(db, app_id, page)
+    elapsed = time.process_time() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.close()
+    return elapsed * 1000 * 10000 / count, peak / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reviews", type=int, default=10000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="records-bench-")
+    # 需在导入 app 之前设置
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    global ReviewRecord
+    from app.database import SessionLocal, engine
+    from app.records import ReviewRecord
+    from app.models import App, Base
+    from app.search import ensure_search_index
+    from app.sync import save_reviews
+
+    Base.metadata.create_all(bind=engine)
+    ensure_search_index(engine)
+    db = SessionLocal()
+    apps = [App(name=name, platform="android", play_store_id=f"com.example.{name}") for name in ("dict", "record")]
+    db.add_all(apps)
+    db.commit()
+    app_ids = [app.id for app in apps]
+    db.close()
+
+    raw = list(fake_raw_reviews(args.reviews))
+    dict_ms, dict_mb = measure_convert(raw, to_dict)
+    record_ms, record_mb = measure_convert(raw, to_record)
+
+    def paged(convert):
+        converted = [convert(review, "us") for review in raw]
+        return [converted[i:i + PAGE_SIZE] for i in range(0, len(converted), PAGE_SIZE)]
+
+    orm_ms, orm_peak = measure_write(app_ids[0], paged(to_dict), save_with_orm)
+    bulk_ms, bulk_peak = measure_write(app_ids[1], paged(to_record), save_reviews)
+
+    print(f"评论数: {len(raw)}, 每页 {PAGE_SIZE} 条")
+    print(f"{'':28}{'dict + ORM':>14}{'ReviewRecord':>14}")
+    print(f"{'转换耗时 (ms / 万条)':28}{dict_ms:>14.1f}{record_ms:>14.1f}")
+    print(f"{'转换结果内存 (MB / 万条)':28}{dict_mb * 10000 / len(raw):>14.2f}{record_mb * 10000 / len(raw):>14.2f}")
+    print(f"{'写入 CPU 耗时 (ms / 万条)':28}{orm_ms:>14.1f}{bulk_ms:>14.1f}")
+    print(f"{'写入内存峰值 (MB)':28}{orm_peak:>14.2f}{bulk_peak:>14.2f}")
+    print(f"临时文件位于 {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,5 +9,15 @@ echo "正在初始化数据库..."
 export PYTHONPATH="/app"
 python /app/app/database/init_db.py
 
-# 启动应用
-exec uvicorn app.main:app --host 0.0.0.0 --port 8000
\ No newline at end of file
+# 启动应用：WEB_CONCURRENCY 大于 1 时由 gunicorn 管理多个 uvicorn 进程，
+# 定时调度器只在竞选到领导权的一个进程中运行
+WORKERS="${WEB_CONCURRENCY:-1}"
+if [ "$WORKERS" -gt 1 ]; then
+    exec gunicorn app.main:app \
+        --worker-class uvicorn.workers.UvicornWorker \
+        --workers "$WORKERS" \
+        --bind 0.0.0.0:8000 \
+        --graceful-timeout 30
+else
+    exec uvicorn app.main:app --host 0.0.0.0 --port 8000
+fi
\ No newline at end of file